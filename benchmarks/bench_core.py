@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmarks of the per-call overhead of s3m compared to plain sqlite3.
+
+Usage: python benchmarks/bench_core.py [-n NUMBER] [-r REPEAT] [--compare PATH]
+
+Each benchmark runs against an in-memory database (no-op locks) and a database file
+(real DBState locks). --compare runs the same benchmarks with another copy of s3m.py,
+for example the one from the baseline commit:
+
+    git show <baseline>:s3m.py > /tmp/s3m_baseline.py
+    python benchmarks/bench_core.py --compare /tmp/s3m_baseline.py
+"""
+
+import argparse
+import importlib.util
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import s3m
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location("s3m_compare", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+def make_connection(connect, path):
+    conn = connect(path, isolation_level=None, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS a(id INTEGER PRIMARY KEY, value TEXT)")
+    conn.execute("DELETE FROM a")
+    conn.executemany("INSERT INTO a VALUES(?, ?)", [(i, str(i)) for i in range(1000)])
+
+    return conn
+
+def make_benchmarks(conn):
+    cursor = conn.cursor()
+
+    def execute():
+        cursor.execute("SELECT value FROM a WHERE id = ?", (1,))
+
+    def execute_fetchone():
+        cursor.execute("SELECT value FROM a WHERE id = ?", (1,)).fetchone()
+
+    def connection_execute():
+        conn.execute("SELECT value FROM a WHERE id = ?", (1,)).fetchone()
+
+    if isinstance(conn, sqlite3.Connection):
+        def with_connection():
+            pass
+    else:
+        def with_connection():
+            with conn:
+                pass
+
+    return [("cursor.execute", execute),
+            ("cursor.execute + fetchone", execute_fetchone),
+            ("connection.execute + fetchone", connection_execute),
+            ("with connection", with_connection)]
+
+def measure(func, args):
+    return min(timeit.repeat(func, number=args.number, repeat=args.repeat)) / args.number
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=20000, help="calls per measurement")
+    parser.add_argument("-r", "--repeat", type=int, default=10, help="number of measurements")
+    parser.add_argument("--compare", metavar="PATH", help="another s3m.py to compare with")
+
+    args = parser.parse_args(argv)
+
+    implementations = [("sqlite3", sqlite3.connect), ("s3m", s3m.connect)]
+
+    if args.compare:
+        implementations.append(("compared", load_module(args.compare).connect))
+
+    directory = tempfile.mkdtemp(prefix="s3m-bench-")
+
+    try:
+        for database in (":memory:", "file"):
+            print("database: %s" % (database,))
+
+            header = "%-32s" + " %12s" * len(implementations) + " %12s"
+            print(header % (("benchmark",) + tuple(name for name, _ in implementations) + ("overhead",)))
+
+            connections = []
+            results = []
+
+            for i, (name, connect) in enumerate(implementations):
+                path = database if database == ":memory:" else os.path.join(directory, "%d.db" % (i,))
+                conn = make_connection(connect, path)
+                connections.append(conn)
+                results.append([measure(func, args) for _, func in make_benchmarks(conn)])
+
+            names = [name for name, _ in make_benchmarks(connections[0])]
+
+            for j, name in enumerate(names):
+                times = [result[j] for result in results]
+                row = (name,) + tuple(t * 1e9 for t in times) + ((times[1] - times[0]) * 1e9,)
+                print(("%-32s" + " %10.0fns" * (len(times) + 1)) % row)
+
+            for conn in connections:
+                conn.close()
+
+            print()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
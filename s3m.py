@@ -21,12 +21,38 @@ S3M - sqlite3 wrapper for multithreaded applications
 # You should have received a copy of the GNU General Public License
 # along with this library. If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import contextlib
+import datetime
+import decimal
+import json
 import os
+import pickle
+import re
 import sqlite3
+import struct
+import sys
+import tempfile
 import threading
+import time
+import urllib.parse
 import weakref
-
-__all__ = ["connect", "Connection", "Cursor", "S3MError", "LockTimeoutError"]
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+__all__ = ["connect", "Connection", "Cursor", "S3MError", "LockTimeoutError", "LockOrderError",
+           "StatementCollector", "IndexAdvisor", "IndexRecommendation",
+           "normalize_statement", "format_index_report", "CheckpointScheduler",
+           "MaintenanceScheduler", "ConverterRegistry", "convert_timestamps",
+           "convert_json", "convert_decimals", "cached_converter", "StatementRecorder",
+           "read_recording", "replay", "ReplayReport", "Change", "AdmissionController",
+           "OverloadedError", "Compressor", "ZlibCompressor", "LzmaCompressor", "DictCompressor",
+           "Migration", "Pipeline", "DeferredResult", "HandleManager", "HANDLE_MANAGER",
+           "Warmup"]
 
 __version__ = "1.1.0"
 
@@ -54,7 +80,59 @@ class LockTimeoutError(S3MError):
 
         self.connection = conn
 
-def normalize_path(path):
+class LockOrderError(LockTimeoutError):
+    """
+        Thrown when a lock is taken by another connection and waiting for it could deadlock,
+        because the lock precedes the locks the connection already holds in the locking order.
+        Transactions started with ``BEGIN``, ``SAVEPOINT`` or an implicit ``BEGIN``
+        take the transaction locks of all the attached databases up front, so this only happens
+        when the locks are held with ``with connection:`` or another database is attached later.
+        Rolling back the transaction and retrying it resolves the conflict.
+    """
+
+    def __init__(self, conn, msg=None):
+        if msg is None:
+            msg = "Lock is taken by another connection and waiting for it could deadlock"
+
+        LockTimeoutError.__init__(self, conn, msg)
+
+class OverloadedError(S3MError):
+    """Thrown when the admission controller refuses to queue a thread for a lock, see :any:`AdmissionController`"""
+
+    def __init__(self, conn, queue_depth, estimated_wait, msg=None):
+        if msg is None:
+            msg = "Database is overloaded (%d waiting, estimated wait %.3fs)" % (queue_depth, estimated_wait)
+
+        S3MError.__init__(self, msg)
+
+        self.connection = conn
+        self.queue_depth = queue_depth
+        self.estimated_wait = estimated_wait
+
+def split_uri(uri):
+    """
+        Split an SQLite URI filename into the path and the query parameters.
+
+        >>> split_uri("file:data.db?mode=ro&cache=private")
+        ('data.db', [('mode', 'ro'), ('cache', 'private')])
+        >>> split_uri("file:///a/b%20c.db")
+        ('/a/b c.db', [])
+
+        :param uri: `str`, URI starting with ``file:``
+
+        :returns: (path, params), where `params` is a `list` of (key, value) pairs
+    """
+
+    split = urllib.parse.urlsplit(uri)
+
+    if split.netloc not in ("", "localhost"):
+        raise ValueError("Invalid URI authority: %r" % (split.netloc,))
+
+    params = urllib.parse.parse_qsl(split.query, keep_blank_values=True)
+
+    return urllib.parse.unquote(split.path), params
+
+def normalize_path(path, uri=False):
     """
     >>> normalize_path("/a/b/c/")
     '/a/b/c'
@@ -68,24 +146,157 @@ def normalize_path(path):
     '/a/b/c'
     >>> normalize_path(":memory:")
     ':memory:'
+    >>> normalize_path("file:///a/./b//c?mode=ro&immutable=1", uri=True)
+    'file:/a/b/c?mode=ro&immutable=1'
+    >>> normalize_path("file:name?mode=memory&cache=shared", uri=True)
+    'file:name?mode=memory&cache=shared'
     """
-    if path == ":memory:":
+
+    if is_memory_database(path, uri):
+        # In-memory databases are identified by their names, not paths
         return path
 
+    if uri and path.startswith("file:"):
+        file_path = quote_uri_path(normalize_path(split_uri(path)[0]))
+        query = urllib.parse.urlsplit(path).query
+
+        return "file:%s?%s" % (file_path, query) if query else "file:%s" % (file_path,)
+
     return os.path.normcase(os.path.normpath(os.path.realpath(path)))
 
+def is_memory_database(path, uri=False):
+    """
+    >>> is_memory_database(":memory:")
+    True
+    >>> is_memory_database("file::memory:?cache=shared", uri=True)
+    True
+    >>> is_memory_database("file:name?mode=memory", uri=True)
+    True
+    >>> is_memory_database("file:name?mode=memory")
+    False
+    """
+
+    if path == ":memory:":
+        return True
+
+    if uri and path.startswith("file:"):
+        file_path, params = split_uri(path)
+
+        return file_path == ":memory:" or ("mode", "memory") in params
+
+    return False
+
+def quote_uri_path(path):
+    """
+    >>> quote_uri_path("/a/b c?#.db")
+    '/a/b%20c%3F%23.db'
+    """
+
+    return urllib.parse.quote(path, safe="/:")
+
+def database_key(path, uri=False):
+    """
+        Get the key of the database in `DB_STATES`.
+
+        `None` means that the database doesn't need to be locked:
+        it's either a private in-memory database or the database is opened read-only.
+
+        >>> database_key(":memory:")
+        >>> database_key("/a/b/c")
+        '/a/b/c'
+        >>> database_key("file:/a/b/c?cache=shared", uri=True)
+        '/a/b/c'
+        >>> database_key("file:/a/b/c?mode=ro", uri=True)
+        >>> database_key("file:name?mode=memory", uri=True)
+        >>> database_key("file:name?cache=shared&mode=memory", uri=True)
+        'file:name?mode=memory'
+
+        :param path: Database path, normalized by :any:`normalize_path`
+        :param uri: `True` if `path` should be interpreted as a URI
+
+        :returns: `str` or `None`
+    """
+
+    if path == ":memory:":
+        return None
+
+    if not (uri and path.startswith("file:")):
+        return path
+
+    file_path, params = split_uri(path)
+    params = dict(params)
+
+    if is_memory_database(path, uri):
+        if params.get("cache") != "shared":
+            # Private in-memory database
+            return None
+
+        return "file:%s?mode=memory" % (quote_uri_path(file_path),)
+
+    if params.get("mode") == "ro" or params.get("immutable", "0").lower() in ("1", "true", "yes", "on"):
+        return None
+
+    return file_path
+
+def get_db_state(key):
+    """
+        Get or create the :any:`DBState` of a database.
+
+        :param key: Database key, see :any:`database_key`
+
+        :returns: :any:`DBState`
+    """
+
+    with DICT_LOCK:
+        db_state = DB_STATES.get(key)
+
+        # If the object already exists, use it
+        if db_state is not None:
+            db_state = db_state.peek()
+
+            if db_state is not None:
+                return db_state[0]
+
+        db_state = DBState()
+        db_state.key = key
+
+        def func(key, finalizer):
+            with DICT_LOCK:
+                # The entry might have already been replaced
+                if DB_STATES.get(key) is finalizer[0]:
+                    DB_STATES.pop(key)
+
+        # Automatically cleanup DB_STATES
+        finalizer = []
+        finalizer.append(weakref.finalize(db_state, func, key, finalizer))
+        DB_STATES[key] = finalizer[0]
+
+        return db_state
+
 class FakeLock(object):
     """Only pretends to be a lock, doesn't do anything"""
 
+    __slots__ = ()
+
     def acquire(self, *args, **kwargs):
         return True
 
     def release(self, *args, **kwargs):
         return True
 
+    def __enter__(self):
+        return True
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
 class DBState(object):
     """Stores database locks and the currently active connection"""
 
+    __slots__ = ("lock", "transaction_lock", "active_connection", "key", "last_activity",
+                 "waiting", "stats_lock", "checkpoint_scheduler", "maintenance_scheduler",
+                 "admission", "transaction_acquired_at", "__weakref__")
+
     def __init__(self, connection=None):
         # Blocks parallel database operations
         self.lock = threading.RLock()
@@ -94,546 +305,5011 @@ class DBState(object):
         self.transaction_lock = threading.Lock()
         self.active_connection = connection
 
+        # Key in DB_STATES
+        self.key = None
+
+        # time.monotonic() of the last lock release
+        self.last_activity = time.monotonic()
+
+        # Number of threads waiting for the locks
+        self.waiting = 0
+
+        # Locks access to the counters above
+        self.stats_lock = threading.Lock()
+
+        self.checkpoint_scheduler = None
+        self.maintenance_scheduler = None
+
+        # AdmissionController, see Connection.set_admission_control()
+        self.admission = None
+
+        # time.monotonic() of the transaction lock acquisition, tracked for the AdmissionController
+        self.transaction_acquired_at = 0.0
+
 class FakeDBState(object):
     """Like DBState but uses FakeLock"""
 
+    __slots__ = DBState.__slots__
+
     def __init__(self, connection=None):
         self.lock = FakeLock()
         self.transaction_lock = FakeLock()
         self.active_connection = None
+        self.key = None
+        self.last_activity = time.monotonic()
+        self.waiting = 0
+        self.stats_lock = FakeLock()
+        self.checkpoint_scheduler = None
+        self.maintenance_scheduler = None
+        self.admission = None
+        self.transaction_acquired_at = 0.0
+
+class AdmissionController(object):
+    """
+        Decides whether a thread may queue for the locks of a database.
+
+        The controller is consulted only when a lock can't be acquired right away.
+        A thread is refused with :any:`OverloadedError` if the number of threads already waiting
+        has reached `max_queue_depth` or if its estimated wait exceeds `max_wait`.
+        The wait is estimated as ``(waiting + 1) * hold_time``, where `hold_time` is
+        an exponentially weighted moving average of the time the database lock is held.
+        Threads queuing for the transaction lock use `transaction_hold_time` instead,
+        the moving average of the time the transaction lock is held.
+
+        The limits may depend on the priority of the connection (see :any:`Connection`),
+        so that low priority work is shed first:
+
+        >>> controller = AdmissionController(max_queue_depth=50, priority_limits={0: (10, 0.5)})
+        >>> controller.limits(0), controller.limits(1)
+        ((10, 0.5), (50, None))
+
+        :param max_queue_depth: Maximum number of waiting threads, `None` means no limit
+        :param max_wait: Maximum estimated wait (in seconds), `None` means no limit
+        :param priority_limits: `dict` mapping priorities to ``(max_queue_depth, max_wait)`` tuples,
+                                the other priorities use `max_queue_depth` and `max_wait`
+        :param smoothing: Weight of the latest hold time in the moving average
+    """
 
-def chain(f):
-    def wrapper(self, *args, **kwargs):
-        f(self, *args, **kwargs)
-        return self
+    __slots__ = ("max_queue_depth", "max_wait", "priority_limits", "smoothing", "hold_time",
+                 "transaction_hold_time", "admitted", "rejected")
 
-    wrapper.__doc__ = f.__doc__
+    def __init__(self, max_queue_depth=None, max_wait=None, priority_limits=None, smoothing=0.1):
+        self.max_queue_depth = max_queue_depth
+        self.max_wait = max_wait
+        self.priority_limits = dict(priority_limits or {})
+        self.smoothing = smoothing
 
-    return wrapper
+        # Moving averages of the lock hold times in seconds
+        self.hold_time = 0.0
+        self.transaction_hold_time = 0.0
 
-class Cursor(object):
-    """The cursor class, analogous to :any:`sqlite3.Cursor`."""
+        # Number of threads allowed and refused to wait
+        self.admitted = 0
+        self.rejected = 0
 
-    def __init__(self, connection):
-        self.closed = False
-        self._cursor = None
-        self._connection = weakref.ref(connection)
+    def limits(self, priority):
+        """
+            Get the limits for the priority.
 
-        self._cursor = connection.connection.cursor()
+            :param priority: Connection priority
 
-    def __enter__(self):
-        self.connection.acquire()
+            :returns: ``(max_queue_depth, max_wait)``
+        """
 
-    def __exit__(self, *args, **kwargs):
-        self.connection.release()
+        return self.priority_limits.get(priority, (self.max_queue_depth, self.max_wait))
 
-    def __del__(self):
-        self.close()
+    def admit(self, connection, waiting, transaction=False):
+        """
+            Check if the connection may wait for a lock. Called with `DBState.stats_lock` held.
 
-    def close(self):
-        """Close the cursor"""
+            :param connection: :any:`Connection` that wants to wait
+            :param waiting: Number of threads already waiting
+            :param transaction: `True` if the thread waits for the transaction lock
 
-        if self.closed or self.connection.closed:
-            return
+            :raises OverloadedError: if the thread must not wait
+        """
 
-        self._cursor.close()
-        self.closed = True
+        max_queue_depth, max_wait = self.limits(connection.priority)
+        hold_time = self.transaction_hold_time if transaction else self.hold_time
+        estimated_wait = (waiting + 1) * hold_time
 
-    @chain
-    def execute(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Cursor.execute`
+        if ((max_queue_depth is not None and waiting >= max_queue_depth) or
+            (max_wait is not None and estimated_wait > max_wait)):
+            self.rejected += 1
+            raise OverloadedError(connection, waiting, estimated_wait)
 
-           :returns: self
+        self.admitted += 1
+
+    def record(self, hold_time, transaction=False):
         """
+            Update the moving average of the hold time. Called by the lock owner.
 
-        with self:
-            self._cursor.execute(*args, **kwargs)
+            :param hold_time: Time the lock was held (in seconds)
+            :param transaction: `True` if `hold_time` is for the transaction lock
+        """
 
-    @chain
-    def executemany(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Cursor.executemany`
+        if transaction:
+            self.transaction_hold_time += self.smoothing * (hold_time - self.transaction_hold_time)
+        else:
+            self.hold_time += self.smoothing * (hold_time - self.hold_time)
 
-           :returns: self
-        """
+class BackgroundScheduler(object):
+    """
+        Base class for background threads that work on a database while it's idle.
 
-        with self:
-            self._cursor.executemany(*args, **kwargs)
+        The thread only holds a weak reference to the :any:`DBState`
+        and stops on its own once the state is gone.
 
-    @chain
-    def executescript(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Cursor.executescript`
+        :param db_state: :any:`DBState` of the database
+        :param path: Path to the database
+        :param interval: How often (in seconds) :any:`BackgroundScheduler.tick` should be called
+        :param idle_time: How long (in seconds) the database should be idle before doing anything
+        :param busy_timeout: `timeout` argument for :any:`sqlite3.connect`
+    """
 
-           :returns: self
-        """
+    thread_name = "s3m-scheduler"
 
-        with self:
-            self._cursor.executescript(*args, **kwargs)
+    def __init__(self, db_state, path, interval=1.0, idle_time=0.5, busy_timeout=5.0):
+        self.db_state_ref = weakref.ref(db_state)
+        self.path = path
+        self.interval = interval
+        self.idle_time = idle_time
+        self.busy_timeout = busy_timeout
 
-    def fetchone(self):
-        """Analogous to :any:`sqlite3.Cursor.fetchone`"""
+        self.skipped_count = 0
+        self.error_count = 0
+        self.last_error = None
 
-        with self:
-            return self._cursor.fetchone()
+        self.stop_event = threading.Event()
+        self.thread = None
 
-    def fetchmany(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Cursor.fetchmany`"""
+    def start(self):
+        """Start the background thread"""
 
-        with self:
-            return self._cursor.fetchmany(*args, **kwargs)
+        if self.thread is not None:
+            return
 
-    def fetchall(self):
-        """Analogous to :any:`sqlite3.Cursor.fetchall`"""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name=self.thread_name, daemon=True)
+        self.thread.start()
 
-        with self:
-            return self._cursor.fetchall()
+    def stop(self, timeout=None):
+        """
+            Stop the background thread.
 
-    @property
-    def rowcount(self):
-        """Analogous to :any:`sqlite3.Cursor.rowcount`"""
+            :param timeout: Maximum amount of time to wait for the thread to finish
+        """
 
-        return self._cursor.rowcount
+        self.stop_event.set()
 
-    @property
-    def lastrowid(self):
-        """Analogous to :any:`sqlite3.Cursor.lastrowid`"""
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
 
-        return self._cursor.lastrowid
+        self.thread = None
 
     @property
-    def arraysize(self):
-        """Analogous to :any:`sqlite3.Cursor.arraysize`"""
+    def running(self):
+        """`True` if the background thread is running"""
 
-        return self._cursor.arraysize
+        return self.thread is not None and self.thread.is_alive()
 
-    @arraysize.setter
-    def arraysize(self, value):
-        self._cursor.arraysize = value
+    def is_idle(self, db_state):
+        """Check if the database has been idle for long enough"""
 
-    @property
-    def description(self):
-        """Analogous to :any:`sqlite3.Cursor.description`"""
+        if db_state.waiting:
+            return False
 
-        return self._cursor.description
+        return time.monotonic() - db_state.last_activity >= self.idle_time
 
-    @property
-    def connection(self):
-        """Connection used by the cursor"""
+    def acquire_locks(self, db_state, blocking, timeout=-1):
+        """Acquire the database locks, returns `True` on success"""
 
-        return self._connection()
+        if not blocking:
+            timeout = -1
 
-class Connection(object):
-    """The connection class. It won't let multiple database operations execute in parallel.
-       It can also block parallel transactions (with lock_transactions=True).
+        if not db_state.transaction_lock.acquire(blocking, timeout):
+            return False
 
-       `with` statement is also supported, it acquires the locks, thus blocking all the competing threads.
-       This can be useful to ensure that database queries will complete in the specified order.
+        if not db_state.lock.acquire(blocking, timeout):
+            db_state.transaction_lock.release()
+            return False
 
-       :param path: Path to the database
-       :param lock_transactions: If True, parallel transactions will be blocked
-       :param lock_timeout: Maximum amount of time the connection is allowed to wait for a lock.
-                            If the timeout is exceeded, LockTimeoutError will be thrown.
-                            -1 disables the timeout.
-       :param single_cursor_mode: Use only one cursor (default: `False`)
-    """
+        return True
 
-    def __init__(self, path, lock_transactions=True, lock_timeout=-1, single_cursor_mode=False, *args, **kwargs):
-        self.path = normalize_path(path)
-        self.connection = None
-        self._cursor = None
-        self.closed = False
-        self.db_state = None
-        self.single_cursor_mode = single_cursor_mode
+    def release_locks(self, db_state):
+        """Release the database locks"""
 
-        # Maximum amount of time the connection is allowed to wait when acquiring the lock.
-        self.lock_timeout = lock_timeout
+        db_state.lock.release()
+        db_state.transaction_lock.release()
 
-        # Used in with block
-        self.was_in_transaction = False
+    def tick(self, connection):
+        """
+            Run one iteration of the scheduler.
 
-        # Should parallel transactions be allowed?
-        self.lock_transactions = lock_transactions
+            :param connection: `sqlite3.Connection`
 
-        # This lock is used to control sharing of the connection between threads
-        self.personal_lock = threading.RLock()
+            :returns: `False` if the scheduler should stop
+        """
 
-        # Number of active with blocks
-        self.with_count = 0
+        raise NotImplementedError
 
-        if self.path == ":memory:":
-            # No two :memory: connections point to the same database => locks are not needed
-            self.db_state = FakeDBState()
-        else:
-            with DICT_LOCK:
-                self.db_state = DB_STATES.get(self.path)
+    def run(self):
+        """The body of the background thread"""
 
-                # If the object doesn't already exist, make a new one
-                if self.db_state is None:
-                    self.db_state = DBState()
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
 
-                    def func(path):
-                        with DICT_LOCK:
-                            DB_STATES.pop(path)
+        try:
+            while not self.stop_event.wait(self.interval):
+                if not self.tick(connection):
+                    break
+        finally:
+            connection.close()
 
-                    # Automatically cleanup DB_STATES
-                    DB_STATES[self.path] = weakref.finalize(self.db_state, func, self.path)
-                else:
-                    self.db_state = self.db_state.peek()[0]
+class CheckpointScheduler(BackgroundScheduler):
+    """
+        Runs WAL checkpoints in a background thread.
+
+        Normally, checkpoints are run automatically by whichever commit makes the WAL
+        too large, which results in random latency spikes.
+        The scheduler runs ``PRAGMA wal_checkpoint(PASSIVE)`` when the database
+        hasn't been used by s3m for at least `idle_time` seconds instead.
+        If the WAL grows beyond `restart_size` or `truncate_size`,
+        the checkpoint is run regardless of the activity in ``RESTART`` or ``TRUNCATE`` mode.
+
+        To avoid the automatic checkpoints altogether, set ``PRAGMA wal_autocheckpoint=0``
+        on the connections.
+
+        :param db_state: :any:`DBState` of the database
+        :param path: Path to the database
+        :param interval: How often (in seconds) the WAL size should be checked
+        :param idle_time: How long (in seconds) the database should be idle for a passive checkpoint
+        :param restart_size: WAL size (in bytes) that triggers a ``RESTART`` checkpoint,
+                             `None` disables it
+        :param truncate_size: WAL size (in bytes) that triggers a ``TRUNCATE`` checkpoint,
+                              `None` disables it
+        :param lock_timeout: Maximum amount of time to wait for the locks
+                             before an escalated checkpoint, -1 disables the timeout
+        :param busy_timeout: `timeout` argument for :any:`sqlite3.connect`
+    """
 
-        self.connection = sqlite3.connect(self.path, *args, **kwargs)
+    thread_name = "s3m-checkpoint"
 
-        if self.single_cursor_mode:
-            self._cursor = Cursor(self)
+    def __init__(self, db_state, path, interval=1.0, idle_time=0.5, restart_size=16 * 1024 ** 2,
+                 truncate_size=64 * 1024 ** 2, lock_timeout=5.0, busy_timeout=5.0):
+        BackgroundScheduler.__init__(self, db_state, path, interval, idle_time, busy_timeout)
 
-    def cursor(self):
-        """Analogous to :any:`sqlite3.Connection.cursor`"""
+        self.wal_path = path + "-wal"
+        self.restart_size = restart_size
+        self.truncate_size = truncate_size
+        self.lock_timeout = lock_timeout
 
-        if self.single_cursor_mode:
-            if self._cursor is None:
-                raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        self.wal_size = 0
+        self.checkpoint_count = 0
+        self.mode_counts = {"PASSIVE": 0, "RESTART": 0, "TRUNCATE": 0}
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_result = None
 
-            return self._cursor
+        # get_wal_stat() right after the last complete checkpoint
+        self.checkpointed_stat = None
 
-        return Cursor(self)
+    def get_wal_size(self):
+        """Returns current size of the WAL file in bytes"""
 
-    @property
-    def in_transaction(self):
-        """Analogous to :any:`sqlite3.Connection.in_transaction`"""
+        try:
+            return os.path.getsize(self.wal_path)
+        except OSError:
+            return 0
 
-        if self.connection is not None:
-            return self.connection.in_transaction
+    def get_wal_stat(self):
+        """
+            Returns (size, modification time) of the WAL file.
+            The size alone isn't enough, the WAL is rewritten from the start after a complete checkpoint.
+        """
 
-        raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        try:
+            stat = os.stat(self.wal_path)
+        except OSError:
+            return (0, 0)
 
-    @property
-    def isolation_level(self):
-        """Analogous to :any:`sqlite3.Connection.isolation_level`"""
+        return (stat.st_size, stat.st_mtime_ns)
 
-        return self.connection.isolation_level
+    def choose_mode(self, wal_size):
+        """Returns checkpoint mode for the given WAL size"""
 
-    @isolation_level.setter
-    def isolation_level(self, value):
-        self.connection.isolation_level = value
+        if self.truncate_size is not None and wal_size >= self.truncate_size:
+            return "TRUNCATE"
 
-    @property
-    def row_factory(self):
-        """Analogous to :any:`sqlite3.Connection.row_factory`"""
+        if self.restart_size is not None and wal_size >= self.restart_size:
+            return "RESTART"
 
-        return self.connection.row_factory
+        return "PASSIVE"
 
-    @row_factory.setter
-    def row_factory(self, value):
-        self.connection.row_factory = value
+    def metrics(self):
+        """
+            Returns a snapshot of the scheduler's metrics.
 
-    @property
-    def text_factory(self):
-        """Analogous to :any:`sqlite3.Connection.text_factory`"""
+            :returns: `dict`
+        """
 
-        return self.connection.text_factory
+        return {"wal_size": self.wal_size,
+                "checkpoint_count": self.checkpoint_count,
+                "mode_counts": dict(self.mode_counts),
+                "last_duration": self.last_duration,
+                "max_duration": self.max_duration,
+                "total_duration": self.total_duration,
+                "last_result": self.last_result,
+                "skipped_count": self.skipped_count,
+                "error_count": self.error_count}
+
+    def checkpoint(self, connection, mode):
+        """
+            Run the checkpoint and update the metrics.
 
-    @property
-    def total_changes(self):
-        """Analogous to :any:`sqlite3.Connection.total_changes`"""
+            :param connection: `sqlite3.Connection`
+            :param mode: Checkpoint mode
 
-        return self.connection.total_changes
+            :returns: (busy, log, checkpointed)
+        """
 
-    def __enter__(self):
-        self.acquire()
+        start = time.monotonic()
+        result = connection.execute("PRAGMA wal_checkpoint(%s)" % (mode,)).fetchone()
+        duration = time.monotonic() - start
 
-    def __exit__(self, *args, **kwargs):
-        self.release()
+        self.checkpoint_count += 1
+        self.mode_counts[mode] += 1
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+        self.last_result = result
 
-    def acquire(self, lock_transactions=None):
-        """
-            Acquire the connection locks.
+        return result
 
-            :param lock_transactions: `bool`, acquire the transaction lock
-                                      (`self.lock_transactions` is the default value)
-        """
+    def tick(self, connection):
+        db_state = self.db_state_ref()
 
-        if not self.personal_lock.acquire(timeout=self.lock_timeout):
-            raise LockTimeoutError(self)
+        if db_state is None:
+            return False
 
-        self.with_count += 1
+        wal_stat = self.get_wal_stat()
+        self.wal_size = wal_stat[0]
 
-        if lock_transactions is None:
-            lock_transactions = self.lock_transactions
+        if self.wal_size == 0:
+            return True
 
-        if lock_transactions and self.db_state.active_connection is not self:
-            if not self.db_state.transaction_lock.acquire(timeout=self.lock_timeout):
-                self.personal_lock.release()
-                raise LockTimeoutError(self)
+        # Nothing has been written since the last complete checkpoint
+        if wal_stat == self.checkpointed_stat:
+            return True
 
-            self.db_state.active_connection = self
+        mode = self.choose_mode(self.wal_size)
+        escalated = mode != "PASSIVE"
 
-        if not self.db_state.lock.acquire(timeout=self.lock_timeout):
-            self.personal_lock.release()
+        if not escalated and not self.is_idle(db_state):
+            self.skipped_count += 1
+            return True
 
-            if lock_transactions:
-                self.db_state.active_connection = None
-                self.db_state.transaction_lock.release()
+        if not self.acquire_locks(db_state, escalated, self.lock_timeout):
+            self.skipped_count += 1
+            return True
 
-            raise LockTimeoutError(self)
+        complete = False
 
         try:
-            # If the connection is closed, an exception is thrown
-            in_transaction = self.in_transaction
-        except sqlite3.ProgrammingError:
-            in_transaction = False
+            busy, log, checkpointed = self.checkpoint(connection, mode)
+            complete = log == checkpointed
+        except sqlite3.Error as e:
+            self.error_count += 1
+            self.last_error = e
+        finally:
+            self.release_locks(db_state)
 
-        self.was_in_transaction = in_transaction
+        wal_stat = self.get_wal_stat()
+        self.wal_size = wal_stat[0]
+        self.checkpointed_stat = wal_stat if complete else None
 
-    def release(self, lock_transactions=None):
-        """
-            Release the connection locks.
+        return True
 
-            :param lock_transactions: `bool`, release the transaction lock
-                                      (`self.lock_transactions` is the default value)
-        """
+class MaintenanceScheduler(BackgroundScheduler):
+    """
+        Runs database maintenance in small slices while the database is idle.
+
+        A maintenance cycle consists of ``PRAGMA optimize``, ``ANALYZE`` of every table
+        (limited by ``PRAGMA analysis_limit``) and ``PRAGMA incremental_vacuum(N)``
+        (only if ``auto_vacuum`` is ``INCREMENTAL``).
+        Each slice runs only after the database has been idle for `idle_time` seconds.
+        As soon as another thread starts waiting for the database locks,
+        the running slice is interrupted and the rest of the cycle is postponed.
+
+        :param db_state: :any:`DBState` of the database
+        :param path: Path to the database
+        :param interval: How often (in seconds) the scheduler should check if the database is idle
+        :param idle_time: How long (in seconds) the database should be idle before running maintenance
+        :param period: Minimum amount of time (in seconds) between maintenance cycles
+        :param optimize: Run ``PRAGMA optimize=0x10002``. The scheduler uses its own connection,
+                         so the 0x10000 flag is needed to check all the tables, not just the ones
+                         queried by that connection (SQLite 3.46+)
+        :param analyze: Run ``ANALYZE`` for each table
+        :param analysis_limit: Value of ``PRAGMA analysis_limit``, `None` means no limit
+        :param vacuum_pages: Number of pages to free per incremental vacuum slice,
+                             `None` disables the incremental vacuum
+        :param busy_timeout: `timeout` argument for :any:`sqlite3.connect`
+    """
 
-        self.personal_lock.release()
+    thread_name = "s3m-maintenance"
 
-        self.with_count -= 1
+    def __init__(self, db_state, path, interval=1.0, idle_time=60.0, period=3600.0,
+                 optimize=True, analyze=True, analysis_limit=400, vacuum_pages=100, busy_timeout=5.0):
+        BackgroundScheduler.__init__(self, db_state, path, interval, idle_time, busy_timeout)
 
-        if lock_transactions is None:
-            lock_transactions = self.lock_transactions
+        self.period = period
+        self.optimize = optimize
+        self.analyze = analyze
+        self.analysis_limit = analysis_limit
+        self.vacuum_pages = vacuum_pages
 
-        if not lock_transactions:
-            self.db_state.lock.release()
-            return
+        # Remaining slices of the current cycle
+        self.pending = []
+        self.last_cycle_start = None
 
-        try:
-            # If the connection is closed, an exception is thrown
-            in_transaction = self.in_transaction
-        except sqlite3.ProgrammingError:
-            in_transaction = False
+        self.cycle_count = 0
+        self.slice_count = 0
+        self.backoff_count = 0
+        self.total_duration = 0.0
+        self.last_duration = None
 
-        # The transaction lock should be released only if:
-        # 1) the connection was previously in a transaction and now it isn't
-        # 2) the connection wasn't previously in a transaction and still isn't
-        if (self.was_in_transaction and not in_transaction) or not in_transaction:
-            if self.with_count == 0: # This is for nested with statements
-                self.db_state.active_connection = None
-                self.db_state.transaction_lock.release()
+    def metrics(self):
+        """
+            Returns a snapshot of the scheduler's metrics.
 
-        self.db_state.lock.release()
+            :returns: `dict`
+        """
 
-    def __del__(self):
-        self.close()
+        return {"cycle_count": self.cycle_count,
+                "slice_count": self.slice_count,
+                "backoff_count": self.backoff_count,
+                "pending_slices": len(self.pending),
+                "last_duration": self.last_duration,
+                "total_duration": self.total_duration,
+                "skipped_count": self.skipped_count,
+                "error_count": self.error_count}
 
-    def close(self):
-        """Close the connection"""
+    def plan_cycle(self, connection):
+        """
+            Make a list of maintenance slices.
 
-        if self.closed:
-            return
+            :param connection: `sqlite3.Connection`
 
-        # Make sure no one minds the connection to be closed
-        # This will help avoid MemoryError in other threads,
-        # they will get sqlite3.ProgrammingError instead
-        if not self.personal_lock.acquire(timeout=self.lock_timeout):
-            raise LockTimeoutError(self)
+            :returns: `list` of SQL statements
+        """
+
+        slices = []
+
+        if self.optimize:
+            slices.append("PRAGMA optimize=0x10002")
+
+        if self.analyze:
+            tables = connection.execute("SELECT name FROM sqlite_master "
+                                        "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall()
+
+            slices.extend("ANALYZE %s" % (quote_identifier(name),) for name, in tables)
+
+        if self.vacuum_pages is not None and self.needs_vacuum(connection):
+            slices.append(self.vacuum_slice())
+
+        return slices
+
+    def needs_vacuum(self, connection):
+        """Check if incremental vacuum is enabled and there are free pages"""
+
+        auto_vacuum = connection.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+        if auto_vacuum != 2:
+            return False
+
+        return connection.execute("PRAGMA freelist_count").fetchone()[0] > 0
+
+    def vacuum_slice(self):
+        return "PRAGMA incremental_vacuum(%d)" % (self.vacuum_pages,)
+
+    def run_slice(self, connection, db_state, statement):
+        """
+            Run a single maintenance slice.
+            The statement is interrupted if someone starts waiting for the database.
+
+            :returns: `True` if the slice was completed
+        """
+
+        connection.set_progress_handler(lambda: db_state.waiting, 1000)
+
+        start = time.monotonic()
 
         try:
+            connection.execute(statement).fetchall()
+        except sqlite3.OperationalError as e:
+            if db_state.waiting:
+                # Interrupted by the progress handler
+                self.backoff_count += 1
+                return False
+
+            self.error_count += 1
+            self.last_error = e
+        finally:
+            connection.set_progress_handler(None, 1000)
+
+            duration = time.monotonic() - start
+            self.last_duration = duration
+            self.total_duration += duration
+
+        self.slice_count += 1
+
+        if statement == self.vacuum_slice() and self.needs_vacuum(connection):
+            self.pending.append(statement)
+
+        return True
+
+    def tick(self, connection):
+        db_state = self.db_state_ref()
+
+        if db_state is None:
+            return False
+
+        if not self.pending:
+            now = time.monotonic()
+
+            if self.last_cycle_start is not None and now - self.last_cycle_start < self.period:
+                return True
+
+        while not self.stop_event.is_set():
+            if not self.is_idle(db_state):
+                self.skipped_count += 1
+                return True
+
+            if not self.acquire_locks(db_state, False):
+                self.skipped_count += 1
+                return True
+
             try:
-                if self.in_transaction:
-                    self.db_state.active_connection = None
-                    self.db_state.transaction_lock.release()
-            except sqlite3.ProgrammingError:
-                pass
+                if not self.pending:
+                    if self.analysis_limit is not None:
+                        connection.execute("PRAGMA analysis_limit=%d" % (self.analysis_limit,))
 
-            if self._cursor is not None and not self._cursor.closed:
-                self._cursor._cursor.close()
-                self._cursor.closed = True
+                    self.last_cycle_start = time.monotonic()
+                    self.pending = self.plan_cycle(connection)
 
-            if self.connection is not None:
-                self.connection.close()
+                    if not self.pending:
+                        self.cycle_count += 1
+                        return True
 
-            self.closed = True
-        finally:
-            self.personal_lock.release()
+                if self.run_slice(connection, db_state, self.pending[0]):
+                    self.pending.pop(0)
+                else:
+                    return True
+            except sqlite3.Error as e:
+                self.error_count += 1
+                self.last_error = e
+                return True
+            finally:
+                self.release_locks(db_state)
+
+            if not self.pending:
+                self.cycle_count += 1
+                return True
 
-    def execute(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Cursor.execute`"""
+        return True
+
+def convert_timestamps(values):
+    """
+        Batch converter for ISO 8601 timestamps.
 
-        return self.cursor().execute(*args, **kwargs)
+        >>> convert_timestamps(["2018-01-02 03:04:05", b"2018-01-02T03:04:05.5"])
+        [datetime.datetime(2018, 1, 2, 3, 4, 5), datetime.datetime(2018, 1, 2, 3, 4, 5, 500000)]
+    """
 
-    def executemany(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Cursor.executemany`"""
+    values = [v.decode("utf8") if isinstance(v, bytes) else v for v in values]
 
-        return self.cursor().executemany(*args, **kwargs)
+    return list(map(datetime.datetime.fromisoformat, values))
 
-    def executescript(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Cursor.executescript`"""
+def convert_json(values):
+    """
+        Batch converter for JSON values.
 
-        return self.cursor().executescript(*args, **kwargs)
+        >>> convert_json(['{"a": 1}', b"[1, 2]"])
+        [{'a': 1}, [1, 2]]
+    """
 
-    def commit(self):
-        """Analogous to :any:`sqlite3.Connection.commit`"""
+    return list(map(json.loads, values))
 
-        with self:
-            self.connection.commit()
+def convert_decimals(values):
+    """
+        Batch converter for decimal numbers.
 
-    def rollback(self):
-        """Analogous to :any:`sqlite3.Connection.rollback`"""
+        >>> convert_decimals(["1.10", 2, 0.5])
+        [Decimal('1.10'), Decimal('2'), Decimal('0.5')]
+    """
 
-        with self:
-            self.connection.rollback()
+    values = [v.decode("utf8") if isinstance(v, bytes) else
+              str(v) if isinstance(v, float) else v for v in values]
 
-    def fetchone(self):
-        """
-            Analogous to :any:`sqlite3.Cursor.fetchone`.
-            
-            Works only in single cursor mode.
+    return list(map(decimal.Decimal, values))
+
+def cached_converter(func):
+    """
+        Make a batch converter convert each distinct value only once.
+        Useful for columns with many repeated values, like enum strings.
+
+        >>> convert = cached_converter(lambda values: [len(values)] * len(values))
+        >>> convert(["a", "b", "a", "a"])
+        [2, 2, 2, 2]
+
+        :param func: Batch converter
+
+        :returns: Batch converter
+    """
+
+    def converter(values):
+        unique = list(dict.fromkeys(values))
+        results = dict(zip(unique, func(unique)))
+
+        return [results[v] for v in values]
+
+    converter.__doc__ = func.__doc__
+
+    return converter
+
+# Prefix of compressed column values, see Compressor
+COMPRESSION_MAGIC = b"\x00s3mz"
+
+class Compressor(object):
+    """
+        Base class of the column compressors, see :any:`Connection.enable_compression`.
+
+        Compressed values are stored as BLOBs that start with a header:
+        a magic prefix, the ID of the codec and the type of the original value (TEXT or BLOB).
+    """
+
+    # Stored in the header of the compressed values, 0 means an uncompressed value
+    codec_id = None
+
+    def compress(self, data):
         """
+            :param data: `bytes`
 
-        if not self.single_cursor_mode:
-            raise S3MError("Calling Connection.fetchone() while not in single cursor mode")
+            :returns: `bytes`
+        """
 
-        return self._cursor.fetchone()
+        raise NotImplementedError
 
-    def fetchmany(self, *args, **kwargs):
+    def decompress(self, data):
         """
-            Analogous to :any:`sqlite3.Cursor.fetchmany`.
+            :param data: `bytes` returned by :any:`Compressor.compress`
 
-            Works only in single cursor mode.
+            :returns: `bytes`
         """
 
-        if not self.single_cursor_mode:
-            raise S3MError("Calling Connection.fetchmany() while not in single cursor mode")
+        raise NotImplementedError
 
-        return self._cursor.fetchmany(*args, **kwargs)
+class ZlibCompressor(Compressor):
+    """
+        Compresses values with :any:`zlib`.
 
-    def fetchall(self):
+        :param level: Compression level
+    """
+
+    codec_id = 1
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+class LzmaCompressor(Compressor):
+    """
+        Compresses values with :any:`lzma`. Slower than zlib, but usually compresses better.
+
+        :param preset: Compression preset
+    """
+
+    codec_id = 2
+
+    def __init__(self, preset=6):
+        if lzma is None:
+            raise S3MError("lzma module is not available")
+
+        self.preset = preset
+
+    def compress(self, data):
+        return lzma.compress(data, lzma.FORMAT_XZ, lzma.CHECK_NONE, self.preset)
+
+    def decompress(self, data):
+        return lzma.decompress(data, lzma.FORMAT_XZ)
+
+class DictCompressor(Compressor):
+    """
+        Compresses values with :any:`zlib` using a preset dictionary.
+        Much better than plain zlib for small values that share a lot of content, like JSON documents.
+        The dictionary is identified by its CRC32, which is stored along with each value.
+        The same dictionary is needed to read the values back.
+
+        >>> compressor = DictCompressor.train(['{"name": "%d", "enabled": true}' % i for i in range(100)])
+        >>> value = b'{"name": "x", "enabled": true}'
+        >>> data = compressor.compress(value)
+        >>> len(data) < len(zlib.compress(value)), compressor.decompress(data) == value
+        (True, True)
+
+        :param zdict: Dictionary (`bytes`), see :any:`DictCompressor.train`
+        :param level: Compression level
+    """
+
+    codec_id = 3
+
+    def __init__(self, zdict, level=6):
+        self.zdict = bytes(zdict)
+        self.level = level
+        self.dict_id = struct.pack("<I", zlib.crc32(self.zdict))
+
+    @classmethod
+    def train(cls, samples, size=32 * 1024, level=6, segment_size=16):
         """
-            Analogous to :any:`sqlite3.Cursor.fetchall`.
-        
-            Works only in single cursor mode.
+            Build a dictionary from sample values.
+
+            The dictionary is made of the segments that occur in most of the samples,
+            the most common ones are placed at the end, where zlib can reference them cheaply.
+
+            :param samples: Iterable of `str` or `bytes` values
+            :param size: Maximum dictionary size (in bytes)
+            :param level: Compression level
+            :param segment_size: Length of the segments (in bytes)
+
+            :returns: :any:`DictCompressor`
         """
 
-        if not self.single_cursor_mode:
-            raise S3MError("Calling Connection.fetchall() while not in single cursor mode")
+        counts = collections.Counter()
 
-        return self._cursor.fetchall()
+        for sample in samples:
+            if isinstance(sample, str):
+                sample = sample.encode("utf8")
 
-    @property
-    def rowcount(self):
+            counts.update({sample[i:i + segment_size] for i in range(len(sample) - segment_size + 1)})
+
+        segments = []
+        chosen = bytearray()
+
+        for segment, count in counts.most_common():
+            if count < 2 or len(chosen) + segment_size > size:
+                break
+
+            if segment in chosen:
+                continue
+
+            segments.append(segment)
+            chosen += segment
+
+        return cls(b"".join(reversed(segments)), level)
+
+    def compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=self.zdict)
+
+        return self.dict_id + compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        if data[:4] != self.dict_id:
+            raise S3MError("Value was compressed with a different dictionary")
+
+        decompressor = zlib.decompressobj(-15, zdict=self.zdict)
+
+        return decompressor.decompress(data[4:]) + decompressor.flush()
+
+# Stateless compressors by codec ID
+COMPRESSORS = {ZlibCompressor.codec_id: ZlibCompressor(),
+               LzmaCompressor.codec_id: LzmaCompressor() if lzma is not None else None}
+
+def get_compressor(compressor):
+    """
+        Get a compressor by name.
+
+        :param compressor: ``"zlib"``, ``"lzma"`` or a :any:`Compressor`
+
+        :returns: :any:`Compressor`
+    """
+
+    if isinstance(compressor, Compressor):
+        return compressor
+
+    if compressor == "zlib":
+        return ZlibCompressor()
+
+    if compressor == "lzma":
+        return LzmaCompressor()
+
+    raise ValueError("Unknown compressor: %r" % (compressor,))
+
+def compress_value(value, compressor, threshold):
+    """
+        Compress a TEXT or BLOB value if it's at least `threshold` bytes long and compresses well.
+        Other values are returned as is.
+
+        >>> compress_value("abc" * 100, ZlibCompressor(), 256).startswith(COMPRESSION_MAGIC)
+        True
+        >>> compress_value("abc", ZlibCompressor(), 256)
+        'abc'
+
+        :param value: Value to be compressed
+        :param compressor: :any:`Compressor`
+        :param threshold: Minimum size of the values to be compressed (in bytes)
+    """
+
+    if isinstance(value, str):
+        data = value.encode("utf8")
+        kind = b"t"
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        data = bytes(value)
+        kind = b"b"
+    else:
+        return value
+
+    if len(data) >= threshold:
+        compressed = compressor.compress(data)
+
+        if len(compressed) + len(COMPRESSION_MAGIC) + 2 < len(data):
+            return COMPRESSION_MAGIC + bytes([compressor.codec_id]) + kind + compressed
+
+    if kind == b"b" and data.startswith(COMPRESSION_MAGIC):
+        # Raw BLOBs that look like compressed values have to be wrapped
+        return COMPRESSION_MAGIC + b"\x00b" + data
+
+    return value
+
+def decompress_value(value, dictionaries=None):
+    """
+        Reverse :any:`compress_value`. Values that weren't compressed are returned as is.
+
+        >>> decompress_value(compress_value("abc" * 100, ZlibCompressor(), 256)) == "abc" * 100
+        True
+
+        :param value: Value to be decompressed
+        :param dictionaries: `dict` mapping dictionary IDs to :any:`DictCompressor` objects
+    """
+
+    if not isinstance(value, bytes) or not value.startswith(COMPRESSION_MAGIC):
+        return value
+
+    header_size = len(COMPRESSION_MAGIC) + 2
+    codec_id = value[header_size - 2]
+    data = value[header_size:]
+
+    if codec_id == DictCompressor.codec_id:
+        compressor = (dictionaries or {}).get(data[:4])
+
+        if compressor is None:
+            raise S3MError("Unknown compression dictionary")
+    elif codec_id:
+        compressor = COMPRESSORS.get(codec_id)
+
+        if compressor is None:
+            raise S3MError("Unsupported compression codec: %d" % (codec_id,))
+
+    if codec_id:
+        data = compressor.decompress(data)
+
+    if value[header_size - 1:header_size] == b"t":
+        return data.decode("utf8")
+
+    return data
+
+# Matches column names like "name [type]"
+COLUMN_TYPE_REGEX = re.compile(r"^(.*?)\s*\[([^\]]*)\]$")
+
+class ConverterRegistry(object):
+    """
+        Per-connection column converters.
+        Unlike the `detect_types` converters of :any:`sqlite3`, these work on whole batches of
+        fetched rows: the converter is called once per column per batch with a `list` of values.
+        `None` values are never passed to the converters.
+
+        Converters are looked up by column name first, then by column type.
+        The sqlite3 module doesn't expose declared types of the result columns,
+        so the type is taken from the column name like with `PARSE_COLNAMES`:
+        ``SELECT created AS "created [timestamp]" FROM ...``.
+        The type annotation is stripped from :any:`Cursor.description`.
+
+        Columns with compressed values (see :any:`Connection.enable_compression`)
+        are decompressed before any other conversion.
+    """
+
+    def __init__(self):
+        self.by_column = {}
+        self.by_type = {}
+
+        # Names of the compressed columns (lowercase)
+        self.compressed = set()
+
+        # Dictionary ID -> DictCompressor
+        self.dictionaries = {}
+
+    def __len__(self):
+        return len(self.by_column) + len(self.by_type)
+
+    def register(self, func, column=None, type=None, batch=True, cache=False):
         """
-            Analogous to :any:`sqlite3.Cursor.rowcount`.
-            
-            Works only in single cursor mode.
+            Register a converter.
+
+            :param func: Converter function
+            :param column: Column name (case-insensitive)
+            :param type: Column type (case-insensitive)
+            :param batch: If `True`, `func` takes a `list` of values and returns a `list` of
+                          converted values, otherwise it's called for each value separately
+            :param cache: If `True`, each distinct value is converted only once per batch
         """
 
-        if not self.single_cursor_mode:
-            raise S3MError("Calling Connection.rowcount() while not in single cursor mode")
+        if (column is None) == (type is None):
+            raise ValueError("Exactly one of column and type must be specified")
 
-        return self._cursor.rowcount
+        if not batch:
+            item_func = func
+            func = lambda values: list(map(item_func, values))
 
-    @property
-    def lastrowid(self):
+        if cache:
+            func = cached_converter(func)
+
+        if column is not None:
+            self.by_column[column.lower()] = func
+        else:
+            self.by_type[type.lower()] = func
+
+    def unregister(self, column=None, type=None):
+        """Remove a converter"""
+
+        if column is not None:
+            self.by_column.pop(column.lower(), None)
+
+        if type is not None:
+            self.by_type.pop(type.lower(), None)
+
+    @staticmethod
+    def split_column_name(name):
         """
-            Analogous to :any:`sqlite3.Cursor.lastrowid`.
+            Split column name into the name itself and the type.
 
-            Works only in single cursor mode.
+            >>> ConverterRegistry.split_column_name("created [timestamp]")
+            ('created', 'timestamp')
+            >>> ConverterRegistry.split_column_name("created")
+            ('created', None)
         """
 
-        if not self.single_cursor_mode:
-            raise S3MError("Calling Connection.lastrowid() while not in single cursor mode")
+        match = COLUMN_TYPE_REGEX.match(name)
 
-        return self._cursor.lastrowid
+        if match is None:
+            return name, None
 
-    @property
-    def arraysize(self):
+        return match.group(1), match.group(2)
+
+    def plan(self, description):
         """
-            Analogous to :any:`sqlite3.Cursor.arraysize`
+            Find converters for the result columns.
 
-            Works only in single cursor mode.
+            :param description: :any:`Cursor.description`
+
+            :returns: `list` of (index, converter) pairs
         """
 
-        if not self.single_cursor_mode:
-            raise S3MError("Calling Connection.arraysize() while not in single cursor mode")
+        result = []
 
-        return self._cursor.arraysize
+        if description is None:
+            return result
 
-    @arraysize.setter
-    def arraysize(self, value):
-        self._cursor.arraysize = value
+        for i, column in enumerate(description):
+            name, coltype = self.split_column_name(column[0])
+            func = self.by_column.get(name.lower())
 
-    @property
-    def description(self):
+            if func is None and coltype is not None:
+                func = self.by_type.get(coltype.lower())
+
+            if name.lower() in self.compressed:
+                func = self.decompressor(func)
+
+            if func is not None:
+                result.append((i, func))
+
+        return result
+
+    def decompressor(self, func=None):
         """
-            Analogous to :any:`sqlite3.Cursor.description`
+            Make a batch converter that decompresses the values before passing them to `func`.
 
-            Works only in single cursor mode.
+            :param func: Batch converter or `None`
         """
 
-        if not self.single_cursor_mode:
-            raise S3MError("Calling Connection.description() while not in single cursor mode")
+        dictionaries = self.dictionaries
 
-        return self._cursor.description
+        def converter(values):
+            values = [decompress_value(value, dictionaries) for value in values]
 
-    def interrupt(self):
-        """Analogous to :any:`sqlite3.Connection.interrupt`"""
+            return values if func is None else func(values)
 
-        return self.connection.interrupt()
+        return converter
 
-    def create_function(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Connection.create_function`"""
+    @staticmethod
+    def convert(rows, plan, row_factory=None, cursor=None):
+        """
+            Convert a batch of rows.
 
-        self.connection.create_function(*args, **kwargs)
+            :param rows: `list` of rows
+            :param plan: Result of :any:`ConverterRegistry.plan`
+            :param row_factory: Row factory that produced `rows`
+            :param cursor: `sqlite3.Cursor` for `row_factory`
 
-    def create_aggregate(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Connection.create_aggregate`"""
+            :returns: `list` of converted rows
+        """
 
-        self.connection.create_aggregate(*args, **kwargs)
+        if not rows or not plan:
+            return rows
 
-    def create_collation(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Connection.create_collation`"""
+        columns = [list(column) for column in zip(*rows)]
 
-        self.connection.create_collation(*args, **kwargs)
+        for i, func in plan:
+            column = columns[i]
+            indices = [j for j, value in enumerate(column) if value is not None]
 
-    def set_authorizer(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Connection.set_authorizer`"""
+            if not indices:
+                continue
 
-        self.connection.set_authorizer(*args, **kwargs)
+            if len(indices) == len(column):
+                columns[i] = func(column)
+            else:
+                converted = func([column[j] for j in indices])
 
-    def set_progress_handler(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Connection.set_progress_handler`"""
-        self.connection.set_progress_handler(*args, **kwargs)
+                for j, value in zip(indices, converted):
+                    column[j] = value
 
-    def set_trace_callback(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Connection.set_trace_callback`"""
+        rows = list(zip(*columns))
 
-        self.connection.set_trace_callback(*args, **kwargs)
+        if row_factory is not None:
+            rows = [row_factory(cursor, row) for row in rows]
 
-    def enable_load_extension(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Connection.enable_load_extension`"""
+        return rows
 
-        self.connection.enable_load_extension(*args, **kwargs)
+class RowBuffer(object):
+    """
+        Stores a drained result set.
+        The rows are kept in memory until their estimated size exceeds `memory_limit`,
+        after that they are spilled into a temporary file in chunks.
 
-    def load_extension(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Connection.load_extension`"""
+        :param memory_limit: Maximum estimated size (in bytes) of the rows kept in memory
+    """
 
-        self.connection.load_extension(*args, **kwargs)
+    def __init__(self, memory_limit):
+        self.memory_limit = memory_limit
+        self.rows = []
+        self.size = 0
+        self.count = 0
+        self.file = None
+        self.spilled_chunks = 0
 
-    def iterdump(self, *args, **kwargs):
-        """Analogous to :any:`sqlite3.Connection.iterdump`"""
+        # The chunk that is being read
+        self.current = []
+        self.position = 0
 
-        return self.connection.iterdump()
+    @staticmethod
+    def estimate_size(row):
+        """Returns estimated size of a row in bytes"""
 
-def connect(path, lock_transactions=True, lock_timeout=-1, single_cursor_mode=False,
-            factory=Connection, *args, **kwargs):
-    """Analogous to sqlite3.connect()
+        size = 64 + 8 * len(row)
 
-       :param path: Path to the database
+        for value in row:
+            if isinstance(value, (str, bytes)):
+                size += len(value)
+            else:
+                size += 24
+
+        return size
+
+    @property
+    def spilled(self):
+        """`True` if some of the rows have been written to a temporary file"""
+
+        return self.file is not None
+
+    def extend(self, rows):
+        """Add rows to the buffer"""
+
+        self.rows.extend(rows)
+        self.size += sum(self.estimate_size(row) for row in rows)
+        self.count += len(rows)
+
+        if self.size > self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        """Write the rows kept in memory to the temporary file"""
+
+        if self.file is None:
+            self.file = tempfile.TemporaryFile()
+
+        pickle.dump(self.rows, self.file, pickle.HIGHEST_PROTOCOL)
+
+        self.spilled_chunks += 1
+        self.rows = []
+        self.size = 0
+
+    def finish(self):
+        """Prepare the buffer for reading"""
+
+        if self.file is not None:
+            self.file.seek(0)
+
+    def next_chunk(self):
+        if self.spilled_chunks:
+            self.current = pickle.load(self.file)
+            self.spilled_chunks -= 1
+        elif self.rows is not None:
+            self.current = self.rows
+            self.rows = None
+            self.close()
+        else:
+            return False
+
+        self.position = 0
+
+        return True
+
+    def fetch(self, n=None):
+        """
+            Read rows from the buffer.
+
+            :param n: Maximum number of rows to read, `None` means all of them
+
+            :returns: `list` of rows
+        """
+
+        result = []
+
+        while n is None or len(result) < n:
+            if self.position >= len(self.current):
+                if not self.next_chunk():
+                    break
+
+            end = len(self.current) if n is None else self.position + n - len(result)
+            chunk = self.current[self.position:end]
+            self.position += len(chunk)
+            result.extend(chunk)
+
+        return result
+
+    def close(self):
+        """Remove the temporary file"""
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class Cursor(object):
+    """
+        The cursor class, analogous to :any:`sqlite3.Cursor`.
+
+        :param connection: :any:`Connection`
+        :param prefetch: If `True`, the whole result set is read right after the statement is executed,
+                         so that the statement doesn't keep the database read lock (or the WAL snapshot).
+                         `None` means :any:`Connection.prefetch`.
+    """
+
+    __slots__ = ("closed", "prefetch", "_cursor", "_connection", "_buffer", "_converters", "_schemas",
+                 "__weakref__")
+
+    def __init__(self, connection, prefetch=None):
+        self.closed = False
+        self._cursor = None
+        self._connection = connection
+
+        if prefetch is None:
+            prefetch = connection.prefetch
+
+        self.prefetch = prefetch
+
+        # Drained result set, see _drain()
+        self._buffer = None
+
+        # Converters for the current result set, see ConverterRegistry.plan()
+        self._converters = None
+
+        # Attached databases used by the current statement, see Connection.schemas_for()
+        self._schemas = None
+
+        if connection.manager is None:
+            self._cursor = connection.connection.cursor()
+        else:
+            # The handle of a lazy connection may be replaced, see __enter__()
+            self.prefetch = True
+
+    def __enter__(self):
+        connection = self._connection
+        connection.acquire(None, self._schemas)
+
+        if connection.manager is not None:
+            if self._cursor is None or self._cursor.connection is not connection.connection:
+                arraysize = self._cursor.arraysize if self._cursor is not None else 1
+                self._cursor = connection.connection.cursor()
+                self._cursor.arraysize = arraysize
+
+    def __exit__(self, *args, **kwargs):
+        self._connection.release()
+
+    def close(self):
+        """Close the cursor"""
+
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+        if self.closed or self._connection.closed:
+            return
+
+        if self._cursor is not None:
+            self._cursor.close()
+
+        self.closed = True
+
+    def execute(self, sql, parameters=()):
+        """Analogous to :any:`sqlite3.Cursor.execute`
+
+           :returns: self
+        """
+
+        connection = self._connection
+
+        if connection.slow_path or self.prefetch or self._buffer is not None:
+            self._execute("execute", (sql, parameters))
+            return self
+
+        # Fast path: no recorder, no attached databases and no prefetching
+        connection.acquire()
+
+        try:
+            self._cursor.execute(sql, parameters)
+        finally:
+            connection.release()
+
+        converters = connection.converters
+
+        if converters.by_column or converters.by_type or converters.compressed:
+            self._converters = converters.plan(self._cursor.description)
+        elif self._converters is not None:
+            self._converters = None
+
+        if sql[:1] in ATTACH_PREFIXES and is_attach_statement(sql):
+            connection.refresh_attached()
+
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        """Analogous to :any:`sqlite3.Cursor.executemany`
+
+           :returns: self
+        """
+
+        self._execute("executemany", (sql, seq_of_parameters))
+
+        return self
+
+    def executescript(self, sql_script):
+        """Analogous to :any:`sqlite3.Cursor.executescript`
+
+           :returns: self
+        """
+
+        self._execute("executescript", (sql_script,))
+
+        return self
+
+    def _execute(self, kind, args):
+        connection = self._connection
+        recorder = connection.recorder
+        sql = args[0]
+
+        if not connection.attached or kind == "executescript":
+            self._schemas = None
+        else:
+            self._schemas = connection.schemas_for(sql)
+
+            if (self._schemas is not None and connection.lock_transactions and not connection.in_transaction and
+                begins_transaction(sql, connection.isolation_level is not None)):
+                # Lock all the databases in order up front, otherwise the transaction
+                # would have to take the locks of the attached databases out of order later
+                self._schemas = None
+
+        if connection.compression and kind != "executescript":
+            args = (sql, connection.compress_parameters(kind, sql, args[1]))
+
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+        def finish():
+            # Still holding the locks, so the handle of a lazy connection can't be evicted in between.
+            # Only statements that succeeded are repeated when the handle is reopened
+            if connection.manager is None:
+                pass
+            elif kind == "execute":
+                connection.remember_statement(sql, args[1])
+            elif kind == "executescript":
+                for statement in split_statements(sql):
+                    connection.remember_statement(statement, ())
+
+            if self.prefetch:
+                self._drain()
+
+        if recorder is None:
+            with self:
+                getattr(self._cursor, kind)(*args)
+                finish()
+        else:
+            recorder.run(connection, self, kind, args, {}, finish)
+
+        if kind == "executescript" or is_attach_statement(sql):
+            connection.refresh_attached()
+        elif connection.attached and is_schema_statement(sql):
+            # The same SQL may now refer to the tables of another database
+            connection.schema_cache.clear()
+
+        self._plan_conversion()
+
+    def _plan_conversion(self):
+        converters = self._connection.converters
+
+        if converters.by_column or converters.by_type or converters.compressed:
+            self._converters = converters.plan(self._cursor.description)
+        else:
+            self._converters = None
+
+    def _convert(self, rows):
+        # The rows must be raw tuples, see _fetch_raw()
+        return ConverterRegistry.convert(rows, self._converters,
+                                         self._cursor.row_factory, self._cursor)
+
+    def _fetch_raw(self, method, *args):
+        # Converters work on raw tuples, the row factory is applied after the conversion
+        row_factory = self._cursor.row_factory
+        self._cursor.row_factory = None
+
+        try:
+            return method(*args)
+        finally:
+            self._cursor.row_factory = row_factory
+
+    def _drain(self):
+        # Read the whole result set so that SQLite resets the statement
+        if self._cursor.description is None:
+            return
+
+        buffer = RowBuffer(self._connection.prefetch_memory_limit)
+        row_factory = self._cursor.row_factory
+
+        # Raw tuples take less space and can be spilled to disk
+        self._cursor.row_factory = None
+
+        try:
+            while True:
+                rows = self._cursor.fetchmany(1024)
+
+                if not rows:
+                    break
+
+                buffer.extend(rows)
+        except BaseException:
+            buffer.close()
+            raise
+        finally:
+            self._cursor.row_factory = row_factory
+
+        buffer.finish()
+        self._buffer = buffer
+
+    def _fetch_buffered(self, n):
+        rows = self._buffer.fetch(n)
+
+        if self._converters:
+            return ConverterRegistry.convert(rows, self._converters,
+                                             self._cursor.row_factory, self._cursor)
+
+        row_factory = self._cursor.row_factory
+
+        if row_factory is not None:
+            rows = [row_factory(self._cursor, row) for row in rows]
+
+        return rows
+
+    def fetchone(self):
+        """Analogous to :any:`sqlite3.Cursor.fetchone`"""
+
+        if self._buffer is not None:
+            rows = self._fetch_buffered(1)
+            return rows[0] if rows else None
+
+        # Cursor.__enter__() moves the cursor of a lazy connection to the current handle
+        with self:
+            if not self._converters:
+                return self._cursor.fetchone()
+
+            row = self._fetch_raw(self._cursor.fetchone)
+
+        if row is None:
+            return row
+
+        return self._convert([row])[0]
+
+    def fetchmany(self, size=None):
+        """Analogous to :any:`sqlite3.Cursor.fetchmany`"""
+
+        if size is None:
+            size = self.arraysize
+
+        if self._buffer is not None:
+            return self._fetch_buffered(size)
+
+        with self:
+            if not self._converters:
+                return self._cursor.fetchmany(size)
+
+            rows = self._fetch_raw(self._cursor.fetchmany, size)
+
+        return self._convert(rows)
+
+    def fetchall(self):
+        """Analogous to :any:`sqlite3.Cursor.fetchall`"""
+
+        if self._buffer is not None:
+            return self._fetch_buffered(None)
+
+        with self:
+            if not self._converters:
+                return self._cursor.fetchall()
+
+            rows = self._fetch_raw(self._cursor.fetchall)
+
+        return self._convert(rows)
+
+    def __iter__(self):
+        """Iterate over the result rows, fetching them in chunks of :any:`Cursor.arraysize` rows"""
+
+        while True:
+            rows = self.fetchmany(max(self.arraysize, 64))
+
+            if not rows:
+                break
+
+            for row in rows:
+                yield row
+
+    # A cursor of a lazy connection has no sqlite3.Cursor until its first statement
+
+    @property
+    def rowcount(self):
+        """Analogous to :any:`sqlite3.Cursor.rowcount`"""
+
+        if self._cursor is None:
+            return -1
+
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        """Analogous to :any:`sqlite3.Cursor.lastrowid`"""
+
+        if self._cursor is None:
+            return None
+
+        return self._cursor.lastrowid
+
+    @property
+    def arraysize(self):
+        """Analogous to :any:`sqlite3.Cursor.arraysize`"""
+
+        if self._cursor is None:
+            return 1
+
+        return self._cursor.arraysize
+
+    @arraysize.setter
+    def arraysize(self, value):
+        if self._cursor is None:
+            with self:
+                self._cursor.arraysize = value
+        else:
+            self._cursor.arraysize = value
+
+    @property
+    def description(self):
+        """Analogous to :any:`sqlite3.Cursor.description`"""
+
+        if self._cursor is None:
+            return None
+
+        description = self._cursor.description
+        converters = self._connection.converters
+
+        if description is None or not (converters.by_column or converters.by_type):
+            return description
+
+        return tuple((ConverterRegistry.split_column_name(column[0])[0],) + tuple(column[1:])
+                     for column in description)
+
+    @property
+    def connection(self):
+        """Connection used by the cursor"""
+
+        return self._connection
+
+Change = collections.namedtuple("Change", ["seq", "table", "rowid", "op"])
+Change.__doc__ = "Row change read by :any:`Connection.changes_since`"
+
+CHANGELOG_SCHEMA = """CREATE TABLE IF NOT EXISTS s3m_changelog(
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    tbl TEXT NOT NULL,
+    row_id INTEGER NOT NULL,
+    op TEXT NOT NULL)"""
+
+CHANGEFEED_CONSUMERS_SCHEMA = """CREATE TABLE IF NOT EXISTS s3m_changefeed_consumers(
+    name TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL)"""
+
+CHANGEFEED_TRIGGERS = [
+    ("insert", """CREATE TRIGGER IF NOT EXISTS %(trigger)s AFTER INSERT ON %(table)s BEGIN
+        INSERT INTO s3m_changelog(tbl, row_id, op) VALUES(%(name)s, NEW.rowid, 'I');
+    END"""),
+    ("update", """CREATE TRIGGER IF NOT EXISTS %(trigger)s AFTER UPDATE ON %(table)s BEGIN
+        INSERT INTO s3m_changelog(tbl, row_id, op) SELECT %(name)s, OLD.rowid, 'D' WHERE OLD.rowid != NEW.rowid;
+        INSERT INTO s3m_changelog(tbl, row_id, op) VALUES(%(name)s, NEW.rowid, 'U');
+    END"""),
+    ("delete", """CREATE TRIGGER IF NOT EXISTS %(trigger)s AFTER DELETE ON %(table)s BEGIN
+        INSERT INTO s3m_changelog(tbl, row_id, op) VALUES(%(name)s, OLD.rowid, 'D');
+    END""")]
+
+MIGRATIONS_SCHEMA = """CREATE TABLE IF NOT EXISTS s3m_migrations(
+    name TEXT PRIMARY KEY,
+    last_key,
+    batch_size INTEGER NOT NULL,
+    batches INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    done INTEGER NOT NULL)"""
+
+class Migration(object):
+    """
+        Runs a large UPDATE, DELETE or backfill in key-range batches.
+
+        Each batch is a separate short transaction, so other connections can use the database
+        between the batches. The batch size is adjusted so that each batch takes about `target_time`.
+        The progress is saved in the ``s3m_migrations`` table in the same transaction as the batch,
+        so an interrupted migration continues where it stopped when it's run again.
+
+        `operation` is either an SQL statement with ``:start`` and ``:end`` parameters
+        (both inclusive), for example ``UPDATE t SET b = a * 2 WHERE rowid BETWEEN :start AND :end``,
+        or a callable ``operation(connection, start, end)`` returning the number of affected rows.
+
+        :param connection: :any:`Connection`
+        :param name: Unique name of the migration
+        :param table: Table name
+        :param operation: SQL statement or callable
+        :param key: Column the batches are split by, should be indexed (default: ``rowid``)
+        :param batch_size: Initial number of rows in a batch
+        :param target_time: Desired duration of a batch (in seconds)
+        :param min_batch_size: Minimum number of rows in a batch
+        :param max_batch_size: Maximum number of rows in a batch
+        :param pause: Time to sleep between batches (in seconds)
+    """
+
+    def __init__(self, connection, name, table, operation, key="rowid", batch_size=1000,
+                 target_time=0.05, min_batch_size=10, max_batch_size=100000, pause=0.0):
+        self.connection = connection
+        self.name = name
+        self.table = table
+        self.operation = operation
+        self.key = key
+        self.target_time = target_time
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.pause = pause
+
+        # Progress, saved in s3m_migrations
+        self.last_key = None
+        self.batch_size = batch_size
+        self.batches = 0
+        self.rows = 0
+        self.done = False
+
+    def load(self):
+        """Load the saved progress, if there is any"""
+
+        with self.connection.transaction():
+            self.connection.connection.execute(MIGRATIONS_SCHEMA)
+            row = self.connection.connection.execute(
+                "SELECT last_key, batch_size, batches, rows, done FROM s3m_migrations WHERE name = ?",
+                (self.name,)).fetchone()
+
+        if row is not None:
+            self.last_key, self.batch_size, self.batches, self.rows, done = row
+            self.done = bool(done)
+
+    def save(self):
+        """Save the progress, called within the batch transactions"""
+
+        self.connection.connection.execute("INSERT OR REPLACE INTO s3m_migrations VALUES(?, ?, ?, ?, ?, ?)",
+                                           (self.name, self.last_key, self.batch_size,
+                                            self.batches, self.rows, int(self.done)))
+
+    def reset(self):
+        """Forget the saved progress, so that the migration starts from the beginning"""
+
+        with self.connection.transaction():
+            self.connection.connection.execute(MIGRATIONS_SCHEMA)
+            self.connection.connection.execute("DELETE FROM s3m_migrations WHERE name = ?", (self.name,))
+
+        self.last_key = None
+        self.batches = self.rows = 0
+        self.done = False
+
+    def run_batch(self):
+        """
+            Run the next batch in a transaction.
+
+            :returns: `True` if there are more batches to run
+        """
+
+        connection = self.connection.connection
+        key = quote_identifier(self.key)
+        table = quote_identifier(self.table)
+
+        with self.connection.transaction():
+            start_time = time.monotonic()
+
+            if self.last_key is None:
+                start = connection.execute("SELECT MIN(%s) FROM %s" % (key, table)).fetchone()[0]
+            else:
+                start = connection.execute("SELECT %s FROM %s WHERE %s > ? ORDER BY %s LIMIT 1" % (
+                    key, table, key, key), (self.last_key,)).fetchone()
+                start = start[0] if start is not None else None
+
+            if start is None:
+                self.done = True
+                self.save()
+                return False
+
+            end = connection.execute("SELECT %s FROM %s WHERE %s >= ? ORDER BY %s LIMIT 1 OFFSET ?" % (
+                key, table, key, key), (start, self.batch_size - 1)).fetchone()
+
+            if end is None:
+                end = connection.execute("SELECT MAX(%s) FROM %s" % (key, table)).fetchone()[0]
+            else:
+                end = end[0]
+
+            if callable(self.operation):
+                count = self.operation(self.connection, start, end)
+            else:
+                count = connection.execute(self.operation, {"start": start, "end": end}).rowcount
+
+            self.rows += max(count or 0, 0)
+            self.batches += 1
+            self.last_key = end
+            self.save()
+
+        elapsed = time.monotonic() - start_time
+
+        # Aim for target_time, but don't change the batch size too abruptly
+        factor = min(max(self.target_time / max(elapsed, 1e-6), 0.5), 2.0)
+        self.batch_size = min(max(int(self.batch_size * factor), self.min_batch_size), self.max_batch_size)
+
+        return True
+
+    def run(self, max_batches=None):
+        """
+            Run the migration, continuing from the saved progress.
+
+            :param max_batches: Maximum number of batches to run, `None` means no limit
+
+            :returns: `True` if the migration is complete
+        """
+
+        self.load()
+
+        n_batches = 0
+
+        while not self.done and (max_batches is None or n_batches < max_batches):
+            if n_batches and self.pause:
+                time.sleep(self.pause)
+
+            self.run_batch()
+            n_batches += 1
+
+        return self.done
+
+class DeferredResult(object):
+    """
+        Result of a statement queued in a :any:`Pipeline`.
+        It's resolved when the pipeline is run.
+    """
+
+    __slots__ = ("sql", "parameters", "kind", "rows", "rowcount", "lastrowid", "description",
+                 "error", "resolved")
+
+    def __init__(self, kind, sql, parameters):
+        self.kind = kind
+        self.sql = sql
+        self.parameters = parameters
+        self.rows = None
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+        self.error = None
+        self.resolved = False
+
+    def result(self):
+        """
+            Get the fetched rows.
+
+            :returns: `list` of rows
+
+            :raises S3MError: if the pipeline hasn't been run yet
+            :raises: The exception thrown by the statement
+        """
+
+        if self.error is not None:
+            raise self.error
+
+        if not self.resolved:
+            raise S3MError("Pipeline hasn't been run yet")
+
+        return self.rows
+
+    def fetchall(self):
+        """Same as :any:`DeferredResult.result`"""
+
+        return self.result()
+
+    def fetchone(self):
+        """Get the first row of the result, `None` if there are no rows"""
+
+        rows = self.result()
+
+        return rows[0] if rows else None
+
+class Pipeline(object):
+    """
+        Queues statements and executes all of them under a single lock acquisition.
+        See :any:`Connection.pipeline`.
+
+        :param connection: :any:`Connection`
+        :param transaction: If `True`, the statements are executed in a single transaction
+        :param mode: Transaction mode, see :any:`Connection.transaction`
+    """
+
+    def __init__(self, connection, transaction=False, mode="IMMEDIATE"):
+        self.connection = connection
+        self.transaction = transaction
+        self.mode = mode
+        self.queue = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+        else:
+            self.queue = []
+
+    def execute(self, sql, parameters=()):
+        """
+            Queue a statement.
+
+            :returns: :any:`DeferredResult`
+        """
+
+        result = DeferredResult("execute", sql, parameters)
+        self.queue.append(result)
+
+        return result
+
+    def executemany(self, sql, seq_of_parameters):
+        """
+            Queue a statement to be executed with each of the parameters.
+
+            :returns: :any:`DeferredResult`
+        """
+
+        result = DeferredResult("executemany", sql, seq_of_parameters)
+        self.queue.append(result)
+
+        return result
+
+    def run(self):
+        """
+            Execute the queued statements and resolve their results.
+            Execution stops at the first error, the error is thrown after being stored
+            in the results of the failed statement and of all the statements that weren't executed.
+            If the pipeline runs in a transaction, the transaction is rolled back.
+        """
+
+        queue, self.queue = self.queue, []
+
+        if not queue:
+            return
+
+        if self.transaction:
+            context = self.connection.transaction(self.mode)
+        else:
+            context = self.connection
+
+        cursor = Cursor(self.connection)
+
+        try:
+            with context:
+                for result in queue:
+                    try:
+                        getattr(cursor, result.kind)(result.sql, result.parameters)
+                        result.rows = cursor.fetchall()
+                    except BaseException as e:
+                        for item in queue:
+                            if not item.resolved:
+                                item.error = e
+
+                        raise
+
+                    result.rowcount = cursor.rowcount
+                    result.lastrowid = cursor.lastrowid
+                    result.description = cursor.description
+                    result.resolved = True
+        finally:
+            cursor.close()
+
+class HandleManager(object):
+    """
+        Limits the number of open `sqlite3` handles of lazy connections (``lazy=True``, see :any:`Connection`).
+
+        A lazy connection opens its handle on first use. When there are more than `max_handles`
+        open handles, the least recently used idle handles are closed. An idle handle is one that
+        isn't being used by any thread and isn't in a transaction. The handle is reopened
+        transparently the next time the connection is used, with the functions, pragmas and
+        attached databases set up again. If all the handles are busy, the limit is exceeded temporarily.
+
+        :param max_handles: Maximum number of open handles
+    """
+
+    def __init__(self, max_handles=256):
+        self.max_handles = max_handles
+        self.lock = threading.Lock()
+
+        # id(connection) -> weakref to the connection, in the LRU order
+        self.handles = collections.OrderedDict()
+
+        self.opens = 0
+        self.reopens = 0
+        self.evictions = 0
+
+        # Time spent reopening the evicted handles (in seconds)
+        self.reopen_time = 0.0
+        self.max_reopen_time = 0.0
+
+    def __len__(self):
+        return len(self.handles)
+
+    def touch(self, connection):
+        """Mark the connection's handle as the most recently used one"""
+
+        with self.lock:
+            try:
+                self.handles.move_to_end(id(connection))
+            except KeyError:
+                pass
+
+    def add(self, connection, reopened, open_time):
+        """
+            Register a newly opened handle and evict the idle ones if there are too many.
+
+            :param connection: :any:`Connection` that has just opened its handle
+            :param reopened: `True` if the handle was evicted before
+            :param open_time: Time it took to open the handle (in seconds)
+        """
+
+        with self.lock:
+            self.handles[id(connection)] = weakref.ref(connection)
+            self.opens += 1
+
+            if reopened:
+                self.reopens += 1
+                self.reopen_time += open_time
+                self.max_reopen_time = max(self.max_reopen_time, open_time)
+
+            if len(self.handles) <= self.max_handles:
+                return
+
+            for key, ref in list(self.handles.items()):
+                candidate = ref()
+
+                if candidate is None:
+                    del self.handles[key]
+                elif candidate is not connection and candidate.evict():
+                    del self.handles[key]
+                    self.evictions += 1
+
+                if len(self.handles) <= self.max_handles:
+                    break
+
+    def remove(self, connection):
+        """Forget the connection's handle, it has been closed"""
+
+        with self.lock:
+            self.handles.pop(id(connection), None)
+
+    def stats(self):
+        """
+            Get the statistics.
+
+            :returns: `dict`
+        """
+
+        with self.lock:
+            return {"open": len(self.handles),
+                    "opens": self.opens,
+                    "reopens": self.reopens,
+                    "evictions": self.evictions,
+                    "avg_reopen_time": self.reopen_time / self.reopens if self.reopens else 0.0,
+                    "max_reopen_time": self.max_reopen_time}
+
+# Default handle manager of lazy connections
+HANDLE_MANAGER = HandleManager()
+
+# Connection-level settings that lazy connections repeat when the handle is reopened,
+# see Connection.remember_statement(). Pragmas that are stored in the database file
+# (user_version, journal_mode, page_size, ...) must not be repeated, they might have been changed since.
+SETTING_PRAGMAS = {"ANALYSIS_LIMIT", "AUTOMATIC_INDEX", "BUSY_TIMEOUT", "CACHE_SIZE", "CACHE_SPILL",
+                   "CASE_SENSITIVE_LIKE", "CELL_SIZE_CHECK", "FOREIGN_KEYS", "IGNORE_CHECK_CONSTRAINTS",
+                   "JOURNAL_SIZE_LIMIT", "LOCKING_MODE", "MMAP_SIZE", "QUERY_ONLY", "RECURSIVE_TRIGGERS",
+                   "REVERSE_UNORDERED_SELECTS", "SECURE_DELETE", "SYNCHRONOUS", "TEMP_STORE",
+                   "TRUSTED_SCHEMA", "WAL_AUTOCHECKPOINT"}
+
+class Warmup(object):
+    """
+        Loads database pages into the OS page cache, so that the first queries after a restart
+        don't have to wait for the disk. See :any:`Connection.warmup`.
+
+        The pages of the tables and indexes are found with the ``dbstat`` virtual table
+        and read directly from the database file. If no tables or indexes are specified,
+        the memory-mapped part of the file is loaded (``PRAGMA mmap_size``) or, without mmap,
+        the whole file. If ``dbstat`` isn't available, the whole file is loaded.
+        At most `budget` bytes are read. ``dbstat`` reads the pages it lists,
+        so the enumeration stops as soon as the budget is covered.
+
+        :param path: Path to the database file
+        :param page_size: Database page size
+        :param tables: Names of the tables to be loaded
+        :param indexes: Names of the indexes to be loaded
+        :param budget: Maximum number of bytes to be read
+        :param mmap_size: ``PRAGMA mmap_size`` of the connection
+    """
+
+    # Maximum number of bytes read at once
+    chunk_size = 1024 ** 2
+
+    def __init__(self, path, page_size, tables=None, indexes=None, budget=64 * 1024 ** 2, mmap_size=0):
+        self.path = path
+        self.page_size = page_size
+        self.names = list(tables or []) + list(indexes or [])
+        self.budget = budget
+        self.mmap_size = mmap_size
+        self.thread = None
+
+        # Results
+        self.pages = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.done = False
+        self.error = None
+
+    def get_ranges(self, file_size):
+        """
+            Find the parts of the file to be loaded.
+
+            :param file_size: Size of the database file
+
+            :returns: `list` of (offset, size)
+        """
+
+        if not self.names:
+            if self.mmap_size > 0:
+                return [(0, min(self.mmap_size, file_size))]
+
+            return [(0, file_size)]
+
+        connection = sqlite3.connect("file:%s?mode=ro" % (quote_uri_path(self.path),), uri=True,
+                                     check_same_thread=False)
+
+        # Number of pages that cover the budget
+        max_pages = -(-self.budget // self.page_size)
+
+        try:
+            pages = set()
+
+            for name in self.names:
+                if len(pages) >= max_pages:
+                    break
+
+                for pageno, in connection.execute("SELECT pageno FROM dbstat WHERE name = ?", (name,)):
+                    pages.add(pageno)
+
+                    if len(pages) >= max_pages:
+                        break
+        except sqlite3.OperationalError:
+            # No dbstat
+            return [(0, file_size)]
+        finally:
+            connection.close()
+
+        ranges = []
+
+        # Merge adjacent pages
+        for pageno in sorted(pages):
+            offset = (pageno - 1) * self.page_size
+
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + self.page_size)
+            else:
+                ranges.append((offset, self.page_size))
+
+        return ranges
+
+    def run(self):
+        """Load the pages"""
+
+        start_time = time.monotonic()
+
+        try:
+            with open(self.path, "rb", buffering=0) as f:
+                remaining = self.budget
+
+                for offset, size in self.get_ranges(os.fstat(f.fileno()).st_size):
+                    end = offset + min(size, remaining)
+
+                    while offset < end:
+                        if hasattr(os, "pread"):
+                            data = os.pread(f.fileno(), min(self.chunk_size, end - offset), offset)
+                        else:
+                            f.seek(offset)
+                            data = f.read(min(self.chunk_size, end - offset))
+
+                        if not data:
+                            break
+
+                        offset += len(data)
+                        remaining -= len(data)
+                        self.bytes += len(data)
+
+                    if remaining <= 0:
+                        break
+
+            self.pages = self.bytes // self.page_size
+        except Exception as e:
+            self.error = e
+        finally:
+            self.elapsed = time.monotonic() - start_time
+            self.done = True
+
+    def start(self):
+        """Run in a background thread"""
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def join(self, timeout=None):
+        """
+            Wait for the background thread to finish.
+
+            :returns: `True` if the warmup is done
+        """
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+        return self.done
+
+class Connection(object):
+    """The connection class. It won't let multiple database operations execute in parallel.
+       It can also block parallel transactions (with lock_transactions=True).
+
+       `with` statement is also supported, it acquires the locks, thus blocking all the competing threads.
+       This can be useful to ensure that database queries will complete in the specified order.
+
+       URI filenames are supported with ``uri=True``. Named shared in-memory databases
+       (``file:name?mode=memory&cache=shared``) are locked just like database files,
+       read-only databases (``mode=ro`` or ``immutable=1``) are not locked at all.
+
+       :param path: Path to the database
+       :param lock_transactions: If True, parallel transactions will be blocked
+       :param lock_timeout: Maximum amount of time the connection is allowed to wait for a lock.
+                            If the timeout is exceeded, LockTimeoutError will be thrown.
+                            -1 disables the timeout.
+       :param single_cursor_mode: Use only one cursor (default: `False`)
+       :param prefetch: Default value of :any:`Cursor.prefetch` (default: `False`)
+       :param prefetch_memory_limit: Maximum estimated size (in bytes) of a prefetched result set
+                                     kept in memory, the rest is spilled to a temporary file
+       :param priority: Priority of the connection for :any:`AdmissionController` (default: 0)
+       :param lazy: If `True`, the `sqlite3` handle is opened on first use and may be closed
+                    while the connection is idle, see :any:`HandleManager`.
+                    The cursors of lazy connections always prefetch the results.
+       :param handle_manager: :any:`HandleManager` of a lazy connection (default: :any:`HANDLE_MANAGER`)
+    """
+
+    __slots__ = ("path", "db_key", "in_memory", "connection", "_cursor", "closed", "db_state",
+                 "single_cursor_mode", "prefetch", "prefetch_memory_limit", "lock_timeout",
+                 "lock_transactions", "personal_lock", "with_count", "lock_stack", "attached",
+                 "schema_cache", "authorizer", "trace_callback", "converters", "recorder",
+                 "slow_path", "priority", "acquired_at", "compression", "compression_cache",
+                 "manager", "connect_args", "setup", "last_open_time", "last_warmup", "__weakref__")
+
+    def __init__(self, path, lock_transactions=True, lock_timeout=-1, single_cursor_mode=False, *args,
+                 prefetch=False, prefetch_memory_limit=16 * 1024 ** 2, priority=0, lazy=False,
+                 handle_manager=None, **kwargs):
+        uri = kwargs.get("uri", False)
+
+        self.path = normalize_path(path, uri)
+        self.db_key = database_key(self.path, uri)
+        self.in_memory = is_memory_database(self.path, uri)
+        self.connection = None
+        self._cursor = None
+        self.closed = False
+        self.db_state = None
+        self.single_cursor_mode = single_cursor_mode
+        self.prefetch = prefetch
+        self.prefetch_memory_limit = prefetch_memory_limit
+
+        # Maximum amount of time the connection is allowed to wait when acquiring the lock.
+        self.lock_timeout = lock_timeout
+
+        # Should parallel transactions be allowed?
+        self.lock_transactions = lock_transactions
+
+        # This lock is used to control sharing of the connection between threads
+        self.personal_lock = threading.RLock()
+
+        # Number of active with blocks
+        self.with_count = 0
+
+        # DBStates locked by each active with block
+        self.lock_stack = []
+
+        # Attached databases: schema name (lowercase) -> DBState
+        self.attached = {}
+
+        # SQL -> schemas, see schemas_for()
+        self.schema_cache = {}
+
+        # Callbacks set by the user, they have to be restored after schemas_for()
+        self.authorizer = None
+        self.trace_callback = None
+
+        # Batch converters, see register_converter()
+        self.converters = ConverterRegistry()
+
+        # StatementRecorder, see start_recording()
+        self.recorder = None
+
+        # True if Cursor.execute() can't take the fast path
+        self.slow_path = False
+
+        # See AdmissionController
+        self.priority = priority
+
+        # Compressed columns: (table, column) (lowercase) -> (Compressor, threshold),
+        # see enable_compression()
+        self.compression = {}
+
+        # SQL -> parameters to be compressed, see compression_plan()
+        self.compression_cache = {}
+
+        # time.monotonic() of the outermost acquire(), used to measure the lock hold time.
+        # 0 if it's not being measured.
+        self.acquired_at = 0.0
+
+        # HandleManager of a lazy connection
+        self.manager = None
+
+        # Arguments of sqlite3.connect()
+        self.connect_args = (args, kwargs)
+
+        # Handle configuration to be reapplied when a lazy connection is reopened:
+        # key -> (function, args, kwargs), see configure()
+        self.setup = collections.OrderedDict()
+
+        # Time it took to open the handle the last time (in seconds)
+        self.last_open_time = 0.0
+
+        # Warmup started by warmup()
+        self.last_warmup = None
+
+        if self.db_key is None:
+            # Private in-memory and read-only databases don't need locks
+            self.db_state = FakeDBState()
+        else:
+            self.db_state = get_db_state(self.db_key)
+
+        if lazy:
+            if self.in_memory:
+                self.close()
+                raise S3MError("In-memory databases can't be lazy")
+
+            self.manager = HANDLE_MANAGER if handle_manager is None else handle_manager
+            self.prefetch = True
+            self.update_slow_path()
+        else:
+            self.connection = sqlite3.connect(self.path, *args, **kwargs)
+
+        if self.single_cursor_mode:
+            self._cursor = Cursor(self)
+
+    def cursor(self, prefetch=None):
+        """
+            Analogous to :any:`sqlite3.Connection.cursor`
+
+            :param prefetch: See :any:`Cursor`, ignored in single cursor mode
+        """
+
+        if self.single_cursor_mode:
+            if self._cursor is None:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+
+            return self._cursor
+
+        return Cursor(self, prefetch)
+
+    @property
+    def in_transaction(self):
+        """Analogous to :any:`sqlite3.Connection.in_transaction`"""
+
+        if self.connection is not None:
+            return self.connection.in_transaction
+
+        if self.manager is not None and not self.closed:
+            # Handles in a transaction are never evicted
+            return False
+
+        raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+
+    def handle_attribute(self, name):
+        """Get an attribute of the `sqlite3` handle, opening the handle of a lazy connection if needed"""
+
+        if self.manager is None:
+            return getattr(self.connection, name)
+
+        with self.personal_lock:
+            self.open_handle()
+
+            return getattr(self.connection, name)
+
+    @property
+    def isolation_level(self):
+        """Analogous to :any:`sqlite3.Connection.isolation_level`"""
+
+        return self.handle_attribute("isolation_level")
+
+    @isolation_level.setter
+    def isolation_level(self, value):
+        self.configure(("isolation_level",), setattr, "isolation_level", value)
+
+    @property
+    def row_factory(self):
+        """Analogous to :any:`sqlite3.Connection.row_factory`"""
+
+        if self.manager is None:
+            return self.connection.row_factory
+
+        return self.handle_attribute("row_factory")
+
+    @row_factory.setter
+    def row_factory(self, value):
+        self.configure(("row_factory",), setattr, "row_factory", value)
+
+    @property
+    def text_factory(self):
+        """Analogous to :any:`sqlite3.Connection.text_factory`"""
+
+        return self.handle_attribute("text_factory")
+
+    @text_factory.setter
+    def text_factory(self, value):
+        self.configure(("text_factory",), setattr, "text_factory", value)
+
+    @property
+    def total_changes(self):
+        """
+            Analogous to :any:`sqlite3.Connection.total_changes`.
+            The counter of a lazy connection is reset when its handle is reopened.
+        """
+
+        return self.handle_attribute("total_changes")
+
+    def __enter__(self):
+        if self.attached:
+            # Only the attached databases the connection is already writing to
+            self.acquire(None, self.held_schemas())
+        else:
+            self.acquire()
+
+    def __exit__(self, *args, **kwargs):
+        self.release()
+
+    def acquire_db_lock(self, db_state, lock):
+        """
+            Acquire one of the :any:`DBState` locks, keeping track of the waiting threads.
+
+            :param db_state: :any:`DBState` the lock belongs to
+            :param lock: Lock to acquire
+
+            :returns: `True` on success, `False` if the timeout was exceeded
+        """
+
+        if lock.acquire(False):
+            return True
+
+        with db_state.stats_lock:
+            if db_state.admission is not None:
+                db_state.admission.admit(self, db_state.waiting, lock is db_state.transaction_lock)
+
+            db_state.waiting += 1
+
+        try:
+            return lock.acquire(timeout=self.lock_timeout)
+        finally:
+            with db_state.stats_lock:
+                db_state.waiting -= 1
+
+    def held_schemas(self):
+        """
+            Get the attached databases whose transaction locks the connection holds.
+
+            :returns: `set` of schema names (lowercase)
+        """
+
+        return {name for name, db_state in self.attached.items() if db_state.active_connection is self}
+
+    def held_lock_rank(self):
+        """
+            Get the position of the last lock the connection holds in the locking order:
+            all the transaction locks come before all the database locks,
+            the locks of the same kind are ordered by the database keys.
+
+            :returns: ``(kind, key)`` or `None` if no locks are held
+        """
+
+        ranks = [(0, db_state.key or "") for db_state in [self.db_state] + list(self.attached.values())
+                 if db_state.active_connection is self]
+
+        for db_states in self.lock_stack:
+            for db_state in (db_states or [self.db_state]):
+                ranks.append((1, db_state.key or ""))
+
+        return max(ranks, default=None)
+
+    def acquire_ordered(self, db_state, lock, rank, held_rank):
+        """
+            Acquire a lock of a :any:`DBState`. If the lock precedes the locks that are already held
+            in the locking order, waiting for it could deadlock, so it's only tried without blocking.
+
+            :param db_state: :any:`DBState` the lock belongs to
+            :param lock: Lock to acquire
+            :param rank: Position of the lock in the locking order, see :any:`Connection.held_lock_rank`
+            :param held_rank: Result of :any:`Connection.held_lock_rank`
+
+            :raises LockOrderError: if the lock is out of order and is taken
+            :raises LockTimeoutError: if the timeout was exceeded
+        """
+
+        if held_rank is not None and rank < held_rank:
+            if not lock.acquire(False):
+                raise LockOrderError(self)
+        elif not self.acquire_db_lock(db_state, lock):
+            raise LockTimeoutError(self)
+
+    def get_db_states(self, schemas=None):
+        """
+            Get the :any:`DBState` objects to be locked, in the locking order.
+
+            :param schemas: Names of the attached databases (lowercase) to be locked,
+                            `None` means all of them
+
+            :returns: `list` of :any:`DBState`
+        """
+
+        if not self.attached:
+            return [self.db_state]
+
+        db_states = [self.db_state]
+
+        for name, db_state in self.attached.items():
+            if (schemas is None or name in schemas) and db_state not in db_states:
+                db_states.append(db_state)
+
+        # Locks are always acquired in the same order to avoid deadlocks
+        db_states.sort(key=lambda x: x.key or "")
+
+        return db_states
+
+    def acquire(self, lock_transactions=None, schemas=None):
+        """
+            Acquire the connection locks.
+
+            All the transaction locks are acquired before the database locks,
+            the locks of multiple databases are acquired in the order of their keys.
+
+            :param lock_transactions: `bool`, acquire the transaction lock
+                                      (`self.lock_transactions` is the default value)
+            :param schemas: Names of the attached databases (lowercase) that also have to be locked,
+                            `None` means all of them
+        """
+
+        if self.attached:
+            self.acquire_many(lock_transactions, schemas)
+            return
+
+        # Fast path: only the main database is locked
+        personal_lock = self.personal_lock
+
+        # Threads sharing the connection queue for the personal lock, so they go through admission control too
+        if not (personal_lock.acquire(False) or self.acquire_db_lock(self.db_state, personal_lock)):
+            raise LockTimeoutError(self)
+
+        db_state = self.db_state
+
+        if lock_transactions is None:
+            lock_transactions = self.lock_transactions
+
+        transaction_locked = False
+
+        try:
+            if lock_transactions and db_state.active_connection is not self:
+                transaction_lock = db_state.transaction_lock
+
+                if not (transaction_lock.acquire(False) or self.acquire_db_lock(db_state, transaction_lock)):
+                    raise LockTimeoutError(self)
+
+                db_state.active_connection = self
+                transaction_locked = True
+
+                if db_state.admission is not None:
+                    db_state.transaction_acquired_at = time.monotonic()
+
+            lock = db_state.lock
+
+            if not (lock.acquire(False) or self.acquire_db_lock(db_state, lock)):
+                raise LockTimeoutError(self)
+
+            if self.manager is not None:
+                # Reopening repeats the setup statements, so it's done with the database lock held
+                try:
+                    self.use_handle()
+                except BaseException:
+                    lock.release()
+                    raise
+        except BaseException:
+            if transaction_locked:
+                db_state.active_connection = None
+                db_state.transaction_lock.release()
+
+            personal_lock.release()
+            raise
+
+        if db_state.admission is not None and not self.with_count:
+            self.acquired_at = time.monotonic()
+
+        self.with_count += 1
+        self.lock_stack.append(None)
+
+    def acquire_many(self, lock_transactions=None, schemas=None):
+        """Like :any:`Connection.acquire` but for connections with attached databases"""
+
+        if not (self.personal_lock.acquire(False) or self.acquire_db_lock(self.db_state, self.personal_lock)):
+            raise LockTimeoutError(self)
+
+        if lock_transactions is None:
+            lock_transactions = self.lock_transactions
+
+        db_states = self.get_db_states(schemas)
+        held_rank = self.held_lock_rank()
+        transaction_locked = []
+        locked = []
+
+        try:
+            if lock_transactions:
+                for db_state in db_states:
+                    if db_state.active_connection is self:
+                        continue
+
+                    self.acquire_ordered(db_state, db_state.transaction_lock, (0, db_state.key or ""), held_rank)
+
+                    db_state.active_connection = self
+                    transaction_locked.append(db_state)
+
+                    if db_state.admission is not None:
+                        db_state.transaction_acquired_at = time.monotonic()
+
+            for db_state in db_states:
+                self.acquire_ordered(db_state, db_state.lock, (1, db_state.key or ""), held_rank)
+
+                locked.append(db_state)
+
+            if self.manager is not None:
+                # Reopening repeats the setup statements, so it's done with the database locks held
+                self.use_handle()
+        except BaseException:
+            for db_state in reversed(locked):
+                db_state.lock.release()
+
+            for db_state in reversed(transaction_locked):
+                db_state.active_connection = None
+                db_state.transaction_lock.release()
+
+            self.personal_lock.release()
+            raise
+
+        if not self.with_count:
+            self.acquired_at = time.monotonic()
+
+        self.with_count += 1
+        self.lock_stack.append(db_states)
+
+    def release(self, lock_transactions=None):
+        """
+            Release the connection locks.
+
+            :param lock_transactions: `bool`, release the transaction lock
+                                      (`self.lock_transactions` is the default value)
+        """
+
+        self.with_count -= 1
+        db_states = self.lock_stack.pop()
+
+        if lock_transactions is None:
+            lock_transactions = self.lock_transactions
+
+        if lock_transactions and not self.with_count: # This is for nested with statements
+            try:
+                # If the connection is closed, an exception is thrown
+                in_transaction = self.connection.in_transaction
+            except sqlite3.ProgrammingError:
+                in_transaction = False
+
+            # The transaction locks should be released only if the connection is not in a transaction
+            if in_transaction:
+                pass
+            elif self.attached:
+                self.release_transaction_locks()
+            else:
+                db_state = self.db_state
+
+                if db_state.active_connection is self:
+                    self.release_transaction_lock(db_state)
+
+        if db_states is None:
+            db_state = self.db_state
+            now = db_state.last_activity = time.monotonic()
+
+            if db_state.admission is not None and not self.with_count and self.acquired_at:
+                db_state.admission.record(now - self.acquired_at)
+                self.acquired_at = 0.0
+
+            db_state.lock.release()
+        else:
+            now = time.monotonic()
+
+            for db_state in reversed(db_states):
+                db_state.last_activity = now
+
+                if db_state.admission is not None and not self.with_count:
+                    db_state.admission.record(now - self.acquired_at)
+
+                db_state.lock.release()
+
+            if not self.with_count:
+                self.acquired_at = 0.0
+
+        self.personal_lock.release()
+
+    def release_transaction_locks(self):
+        """Release all the transaction locks held by the connection"""
+
+        db_state = self.db_state
+
+        if db_state.active_connection is self:
+            self.release_transaction_lock(db_state)
+
+        for db_state in self.attached.values():
+            if db_state.active_connection is self:
+                self.release_transaction_lock(db_state)
+
+    def release_transaction_lock(self, db_state):
+        """Release the transaction lock of `db_state`, recording the hold time for admission control"""
+
+        if db_state.admission is not None and db_state.transaction_acquired_at:
+            db_state.admission.record(time.monotonic() - db_state.transaction_acquired_at, True)
+
+        db_state.transaction_acquired_at = 0.0
+        db_state.active_connection = None
+        db_state.transaction_lock.release()
+
+    def use_handle(self):
+        """
+            Open the handle of a lazy connection if it's closed and mark it as recently used.
+            Called by :any:`Connection.acquire` with the database locks held.
+        """
+
+        if self.connection is not None:
+            self.manager.touch(self)
+            return
+
+        if self.closed:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+
+        reopened = bool(self.last_open_time)
+        start_time = time.monotonic()
+        args, kwargs = self.connect_args
+        connection = sqlite3.connect(self.path, *args, **kwargs)
+
+        try:
+            for key, (func, func_args, func_kwargs) in list(self.setup.items()):
+                try:
+                    func(connection, *func_args, **func_kwargs)
+                except BaseException:
+                    # Don't fail every reopen, e.g. if an attached database has been removed
+                    del self.setup[key]
+
+                    if key[0] == "attach":
+                        self.attached.pop(key[1], None)
+                        self.schema_cache.clear()
+                        self.update_slow_path()
+
+                    raise
+
+            if self.authorizer is not None:
+                connection.set_authorizer(self.authorizer)
+
+            if self.trace_callback is not None:
+                connection.set_trace_callback(self.trace_callback)
+        except BaseException:
+            connection.close()
+            raise
+
+        self.connection = connection
+        self.last_open_time = time.monotonic() - start_time
+        self.manager.add(self, reopened, self.last_open_time)
+
+        if self.attached:
+            # In case an ATTACH couldn't be repeated
+            self.refresh_attached()
+
+    def open_handle(self):
+        """
+            Open the handle of a lazy connection outside of :any:`Connection.acquire`.
+            Has to be called with the personal lock held, which keeps the handle from being evicted.
+        """
+
+        if self.connection is not None:
+            self.manager.touch(self)
+            return
+
+        # acquire() reopens the handle with the database lock held
+        self.acquire(False, set())
+        self.release(False)
+
+    def evict(self):
+        """
+            Close the handle of a lazy connection if it's idle. Called by :any:`HandleManager`.
+
+            :returns: `True` if the handle was closed
+        """
+
+        if not self.personal_lock.acquire(False):
+            return False
+
+        try:
+            if self.connection is None or self.with_count or self.connection.in_transaction:
+                return False
+
+            # TEMP tables, views and triggers would be lost
+            self.connection.set_trace_callback(None)
+
+            try:
+                if self.connection.execute("SELECT 1 FROM sqlite_temp_master LIMIT 1").fetchone() is not None:
+                    return False
+            except sqlite3.Error:
+                return False
+            finally:
+                self.connection.set_trace_callback(self.trace_callback)
+
+            self.connection.close()
+            self.connection = None
+
+            return True
+        finally:
+            self.personal_lock.release()
+
+    def configure(self, key, func, *args, **kwargs):
+        """
+            Call `func(self.connection, *args, **kwargs)`.
+            For lazy connections the call is remembered and repeated each time the handle is reopened.
+
+            :param key: Identifies the setting, a later call with the same key replaces the earlier one
+            :param func: Function, e.g. :any:`sqlite3.Connection.create_function`
+        """
+
+        with self.personal_lock:
+            if self.manager is not None:
+                self.setup[key] = (func, args, kwargs)
+
+                if self.connection is None:
+                    return
+
+            return func(self.connection, *args, **kwargs)
+
+    def remember_statement(self, sql, parameters):
+        """
+            Remember PRAGMA settings and ATTACH/DETACH statements of a lazy connection,
+            so that they are repeated when the handle is reopened.
+            Only ``PRAGMA name = value`` and ``PRAGMA name(value)`` for ``SETTING_PRAGMAS`` are remembered,
+            other pragmas are queries, one-off commands (e.g. ``PRAGMA wal_checkpoint(TRUNCATE)``)
+            or change the database file (e.g. ``PRAGMA user_version = 5``).
+            Called after the statement has succeeded.
+        """
+
+        word = sql.lstrip()[:6].upper()
+
+        if word not in ("PRAGMA", "ATTACH", "DETACH"):
+            return
+
+        tokens = [text.upper() if kind == "ident" else text for kind, text in tokenize_sql(sql)]
+
+        if tokens and tokens[-1] == ";":
+            tokens.pop()
+
+        if word == "PRAGMA":
+            # PRAGMA [schema.]name = value or PRAGMA [schema.]name(value)
+            for pos in (2, 4):
+                if len(tokens) > pos and tokens[pos] in ("=", "("):
+                    break
+            else:
+                return
+
+            name = "".join(tokens[1:pos])
+
+            if tokens[pos - 1] in SETTING_PRAGMAS:
+                self.setup[("pragma", name)] = (sqlite3.Connection.execute, (sql,), {})
+        elif len(tokens) > 1:
+            name = unquote_identifier(tokens[-1]).lower()
+
+            if word == "ATTACH":
+                self.setup[("attach", name)] = (sqlite3.Connection.execute, (sql, parameters), {})
+            else:
+                self.setup.pop(("attach", name), None)
+
+    def update_slow_path(self):
+        """Check if the statements can take the fast path, see :any:`Cursor.execute`"""
+
+        self.slow_path = (self.recorder is not None or bool(self.attached) or bool(self.compression) or
+                          self.manager is not None)
+
+    def schemas_for(self, sql):
+        """
+            Find out which attached databases are used by the statement.
+            The statement is compiled with ``EXPLAIN`` and the schema names are collected with an authorizer.
+
+            :param sql: SQL statement
+
+            :returns: `set` of schema names (lowercase) or `None` if they couldn't be determined
+        """
+
+        try:
+            return self.schema_cache[sql]
+        except KeyError:
+            pass
+
+        if is_attach_statement(sql):
+            # ATTACH and DETACH don't actually touch the other databases
+            return set()
+
+        schemas = set()
+
+        def authorizer(action, arg1, arg2, dbname, source):
+            if dbname is not None:
+                schemas.add(dbname.lower())
+
+            return sqlite3.SQLITE_OK
+
+        with self.personal_lock:
+            if self.manager is not None:
+                self.open_handle()
+
+            self.connection.set_authorizer(authorizer)
+            self.connection.set_trace_callback(None)
+
+            try:
+                self.connection.execute("EXPLAIN " + sql, dummy_parameters(sql)).close()
+            except (sqlite3.Error, ValueError):
+                schemas = None
+            finally:
+                self.connection.set_authorizer(self.authorizer)
+                self.connection.set_trace_callback(self.trace_callback)
+
+        if schemas is not None:
+            schemas.intersection_update(self.attached)
+
+        if len(self.schema_cache) >= 1024:
+            self.schema_cache.clear()
+
+        self.schema_cache[sql] = schemas
+
+        return schemas
+
+    def refresh_attached(self):
+        """Update the list of attached databases"""
+
+        attached = {}
+
+        with self.personal_lock:
+            if self.manager is not None:
+                self.open_handle()
+
+            for seq, name, path in self.connection.execute("PRAGMA database_list").fetchall():
+                if name in ("main", "temp") or not path:
+                    continue
+
+                key = database_key(normalize_path(path))
+
+                if key is not None and key != self.db_key:
+                    attached[name.lower()] = get_db_state(key)
+
+            self.attached = attached
+            self.schema_cache.clear()
+            self.update_slow_path()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Close the connection"""
+
+        if self.closed:
+            return
+
+        # Make sure no one minds the connection to be closed
+        # This will help avoid MemoryError in other threads,
+        # they will get sqlite3.ProgrammingError instead
+        if not self.personal_lock.acquire(timeout=self.lock_timeout):
+            raise LockTimeoutError(self)
+
+        try:
+            try:
+                if self.in_transaction:
+                    self.release_transaction_locks()
+            except sqlite3.ProgrammingError:
+                pass
+
+            if self._cursor is not None and not self._cursor.closed:
+                if self._cursor._cursor is not None:
+                    self._cursor._cursor.close()
+
+                self._cursor.closed = True
+
+            if self.connection is not None:
+                self.connection.close()
+
+            if self.manager is not None:
+                self.manager.remove(self)
+
+            self.closed = True
+        finally:
+            self.personal_lock.release()
+
+    def start_scheduler(self, attr, cls, kwargs):
+        """Start a :any:`BackgroundScheduler` stored in `self.db_state.<attr>`"""
+
+        if isinstance(self.db_state, FakeDBState) or self.in_memory:
+            raise S3MError("%s requires a writable database file" % (cls.__name__,))
+
+        with DICT_LOCK:
+            scheduler = getattr(self.db_state, attr)
+
+            if scheduler is None or not scheduler.running:
+                scheduler = cls(self.db_state, self.db_key, **kwargs)
+                setattr(self.db_state, attr, scheduler)
+                scheduler.start()
+
+        return scheduler
+
+    def stop_scheduler(self, attr, timeout=None):
+        """Stop a :any:`BackgroundScheduler` stored in `self.db_state.<attr>`"""
+
+        with DICT_LOCK:
+            scheduler = getattr(self.db_state, attr)
+            setattr(self.db_state, attr, None)
+
+        if scheduler is not None:
+            scheduler.stop(timeout)
+
+    def set_admission_control(self, controller):
+        """
+            Set the :any:`AdmissionController` of the database.
+            It's shared by all the connections to the database.
+
+            :param controller: :any:`AdmissionController` or `None` to disable admission control
+
+            :returns: The previous controller or `None`
+        """
+
+        with self.db_state.stats_lock:
+            previous = self.db_state.admission
+            self.db_state.admission = controller
+
+        return previous
+
+    def start_checkpoint_scheduler(self, **kwargs):
+        """
+            Start a :any:`CheckpointScheduler` for the database.
+            There is only one scheduler per database, if it's already running, it's returned as is.
+
+            Takes the same keyword arguments as :any:`CheckpointScheduler`.
+
+            :returns: :any:`CheckpointScheduler`
+        """
+
+        return self.start_scheduler("checkpoint_scheduler", CheckpointScheduler, kwargs)
+
+    def stop_checkpoint_scheduler(self, timeout=None):
+        """
+            Stop the :any:`CheckpointScheduler` of the database, if there is one.
+
+            :param timeout: Maximum amount of time to wait for the thread to finish
+        """
+
+        self.stop_scheduler("checkpoint_scheduler", timeout)
+
+    def start_maintenance_scheduler(self, **kwargs):
+        """
+            Start a :any:`MaintenanceScheduler` for the database.
+            There is only one scheduler per database, if it's already running, it's returned as is.
+
+            Takes the same keyword arguments as :any:`MaintenanceScheduler`.
+
+            :returns: :any:`MaintenanceScheduler`
+        """
+
+        return self.start_scheduler("maintenance_scheduler", MaintenanceScheduler, kwargs)
+
+    def stop_maintenance_scheduler(self, timeout=None):
+        """
+            Stop the :any:`MaintenanceScheduler` of the database, if there is one.
+
+            :param timeout: Maximum amount of time to wait for the thread to finish
+        """
+
+        self.stop_scheduler("maintenance_scheduler", timeout)
+
+    def execute(self, sql, parameters=()):
+        """Analogous to :any:`sqlite3.Cursor.execute`"""
+
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        """Analogous to :any:`sqlite3.Cursor.executemany`"""
+
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        """Analogous to :any:`sqlite3.Cursor.executescript`"""
+
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        """Analogous to :any:`sqlite3.Connection.commit`"""
+
+        if self.recorder is not None:
+            self.recorder.run(self, self, "commit", (), {})
+            return
+
+        with self:
+            self.connection.commit()
+
+    def rollback(self):
+        """Analogous to :any:`sqlite3.Connection.rollback`"""
+
+        if self.recorder is not None:
+            self.recorder.run(self, self, "rollback", (), {})
+            return
+
+        with self:
+            self.connection.rollback()
+
+    @contextlib.contextmanager
+    def transaction(self, mode="IMMEDIATE"):
+        """
+            Run the ``with`` block in a transaction while holding the connection locks.
+            The transaction is committed at the end of the block or rolled back on error.
+            If the connection is already in a transaction, the block simply becomes a part of it.
+
+            :param mode: ``"DEFERRED"``, ``"IMMEDIATE"`` or ``"EXCLUSIVE"``
+        """
+
+        if self.attached and not self.in_transaction and (self.lock_transactions or mode.upper() != "DEFERRED"):
+            # The transaction locks are taken in order up front, see Cursor._execute().
+            # BEGIN IMMEDIATE and EXCLUSIVE start write transactions on all the attached databases anyway
+            self.acquire()
+        else:
+            self.acquire(None, self.held_schemas())
+
+        try:
+            if self.connection.in_transaction:
+                yield self
+                return
+
+            if self.recorder is not None:
+                self.recorder.run(self, self, "execute", ("BEGIN %s" % (mode,),), {})
+            else:
+                self.connection.execute("BEGIN %s" % (mode,))
+
+            try:
+                yield self
+            except BaseException:
+                self.rollback()
+                raise
+
+            self.commit()
+        finally:
+            self.release()
+
+    def enable_changefeed(self, tables):
+        """
+            Start recording row changes of the tables into the changelog table (``s3m_changelog``).
+            Each change is recorded by a trigger as (seq, table, rowid, op),
+            where `op` is ``"I"`` (insert), ``"U"`` (update) or ``"D"`` (delete).
+            The changes can be read with :any:`Connection.changes_since`.
+
+            :param tables: `list` of table names, the tables must have rowids
+        """
+
+        if isinstance(tables, str):
+            tables = [tables]
+
+        with self.transaction():
+            self.connection.execute(CHANGELOG_SCHEMA)
+            self.connection.execute(CHANGEFEED_CONSUMERS_SCHEMA)
+
+            for table in tables:
+                try:
+                    self.connection.execute("SELECT rowid FROM %s LIMIT 0" % (quote_identifier(table),))
+                except sqlite3.OperationalError:
+                    raise S3MError("Table %r doesn't exist or doesn't have rowids" % (table,))
+
+                for op, template in CHANGEFEED_TRIGGERS:
+                    self.connection.execute(template % {
+                        "trigger": quote_identifier("s3m_changefeed_%s_%s" % (table, op)),
+                        "table": quote_identifier(table),
+                        "name": quote_literal(table)})
+
+    def disable_changefeed(self, tables):
+        """
+            Stop recording row changes of the tables.
+            The changelog itself is left as is.
+
+            :param tables: `list` of table names
+        """
+
+        if isinstance(tables, str):
+            tables = [tables]
+
+        with self.transaction():
+            for table in tables:
+                for op, template in CHANGEFEED_TRIGGERS:
+                    self.connection.execute("DROP TRIGGER IF EXISTS %s" %
+                                            (quote_identifier("s3m_changefeed_%s_%s" % (table, op)),))
+
+    def changefeed_seq(self):
+        """
+            Returns the sequence number of the last recorded change, 0 if there is none.
+            It can be used as the starting point for :any:`Connection.changes_since`.
+        """
+
+        with self:
+            row = self.connection.execute("SELECT seq FROM sqlite_sequence "
+                                          "WHERE name = 's3m_changelog'").fetchone()
+
+        return row[0] if row is not None else 0
+
+    def changes_since(self, seq, batch_size=1000, consumer=None):
+        """
+            Stream changes recorded after `seq`, see :any:`Connection.enable_changefeed`.
+
+            The changes are read in batches, the locks are released between the batches.
+            If `consumer` is specified, its position is saved each time a batch has been consumed,
+            and the changes consumed by all the consumers are removed from the changelog.
+
+            :param seq: Sequence number of the last processed change
+            :param batch_size: Number of changes to read at a time
+            :param consumer: Name of the consumer, `None` disables automatic pruning
+
+            :returns: iterator of :any:`Change`
+        """
+
+        while True:
+            with self:
+                rows = self.connection.execute("SELECT seq, tbl, row_id, op FROM s3m_changelog "
+                                               "WHERE seq > ? ORDER BY seq LIMIT ?",
+                                               (seq, batch_size)).fetchall()
+
+            for row in rows:
+                yield Change(*row)
+
+            if not rows:
+                break
+
+            seq = rows[-1][0]
+
+            if consumer is not None:
+                self.ack_changes(consumer, seq)
+
+            if len(rows) < batch_size:
+                break
+
+    def ack_changes(self, consumer, seq):
+        """
+            Save the position of a changefeed consumer and prune the changelog.
+
+            :param consumer: Name of the consumer
+            :param seq: Sequence number of the last processed change
+        """
+
+        with self.transaction():
+            self.connection.execute("INSERT OR REPLACE INTO s3m_changefeed_consumers VALUES(?, ?)",
+                                    (consumer, seq))
+
+        self.prune_changelog()
+
+    def remove_changefeed_consumer(self, consumer):
+        """Forget a changefeed consumer, so that it doesn't hold back pruning"""
+
+        with self.transaction():
+            self.connection.execute("DELETE FROM s3m_changefeed_consumers WHERE name = ?", (consumer,))
+
+        self.prune_changelog()
+
+    def prune_changelog(self, seq=None):
+        """
+            Remove old changes from the changelog.
+
+            :param seq: Remove the changes up to this sequence number,
+                        `None` means up to the position of the slowest consumer
+        """
+
+        with self.transaction():
+            if seq is None:
+                seq = self.connection.execute("SELECT MIN(seq) FROM s3m_changefeed_consumers").fetchone()[0]
+
+                if seq is None:
+                    return
+
+            self.connection.execute("DELETE FROM s3m_changelog WHERE seq <= ?", (seq,))
+
+    def warmup(self, tables=None, indexes=None, budget=64 * 1024 ** 2, background=True):
+        """
+            Load the pages of the database into the OS page cache, see :any:`Warmup`.
+
+            :param tables: Names of the tables to be loaded
+            :param indexes: Names of the indexes to be loaded
+            :param budget: Maximum number of bytes to be read
+            :param background: If `True`, the pages are loaded in a background thread
+
+            :returns: :any:`Warmup`, also stored in `self.last_warmup`
+        """
+
+        with self:
+            path = self.connection.execute("PRAGMA database_list").fetchone()[2]
+            page_size = self.connection.execute("PRAGMA page_size").fetchone()[0]
+            mmap_size = (self.connection.execute("PRAGMA mmap_size").fetchone() or (0,))[0]
+
+        if not path:
+            raise S3MError("Only database files can be warmed up")
+
+        warmup = Warmup(path, page_size, tables, indexes, budget, mmap_size)
+        self.last_warmup = warmup
+
+        if background:
+            warmup.start()
+        else:
+            warmup.run()
+
+        return warmup
+
+    def pipeline(self, transaction=False, mode="IMMEDIATE"):
+        """
+            Queue statements to be executed under a single lock acquisition.
+            The statements are executed when the ``with`` block ends:
+
+            .. code:: python
+
+                with conn.pipeline() as p:
+                    user = p.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+                    p.execute("UPDATE users SET last_seen = ? WHERE id = ?", (now, user_id))
+
+                print(user.fetchone())
+
+            :param transaction: If `True`, the statements are executed in a single transaction
+            :param mode: Transaction mode, see :any:`Connection.transaction`
+
+            :returns: :any:`Pipeline`
+        """
+
+        return Pipeline(self, transaction, mode)
+
+    def migrate(self, name, table, operation, **kwargs):
+        """
+            Run a :any:`Migration` to completion.
+
+            :param name: Unique name of the migration
+            :param table: Table name
+            :param operation: SQL statement with ``:start`` and ``:end`` parameters or a callable
+
+            Other keyword arguments are passed to :any:`Migration`.
+
+            :returns: :any:`Migration`
+        """
+
+        migration = Migration(self, name, table, operation, **kwargs)
+        migration.run()
+
+        return migration
+
+    def start_recording(self, recorder):
+        """
+            Record all the statements executed through this connection.
+
+            :param recorder: :any:`StatementRecorder`
+        """
+
+        recorder.add_connection(self)
+        self.recorder = recorder
+        self.update_slow_path()
+
+    def stop_recording(self):
+        """Stop recording the statements"""
+
+        self.recorder = None
+        self.update_slow_path()
+
+    def fetchone(self):
+        """
+            Analogous to :any:`sqlite3.Cursor.fetchone`.
+            
+            Works only in single cursor mode.
+        """
+
+        if not self.single_cursor_mode:
+            raise S3MError("Calling Connection.fetchone() while not in single cursor mode")
+
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        """
+            Analogous to :any:`sqlite3.Cursor.fetchmany`.
+
+            Works only in single cursor mode.
+        """
+
+        if not self.single_cursor_mode:
+            raise S3MError("Calling Connection.fetchmany() while not in single cursor mode")
+
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        """
+            Analogous to :any:`sqlite3.Cursor.fetchall`.
+        
+            Works only in single cursor mode.
+        """
+
+        if not self.single_cursor_mode:
+            raise S3MError("Calling Connection.fetchall() while not in single cursor mode")
+
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        """
+            Analogous to :any:`sqlite3.Cursor.rowcount`.
+            
+            Works only in single cursor mode.
+        """
+
+        if not self.single_cursor_mode:
+            raise S3MError("Calling Connection.rowcount() while not in single cursor mode")
+
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        """
+            Analogous to :any:`sqlite3.Cursor.lastrowid`.
+
+            Works only in single cursor mode.
+        """
+
+        if not self.single_cursor_mode:
+            raise S3MError("Calling Connection.lastrowid() while not in single cursor mode")
+
+        return self._cursor.lastrowid
+
+    @property
+    def arraysize(self):
+        """
+            Analogous to :any:`sqlite3.Cursor.arraysize`
+
+            Works only in single cursor mode.
+        """
+
+        if not self.single_cursor_mode:
+            raise S3MError("Calling Connection.arraysize() while not in single cursor mode")
+
+        return self._cursor.arraysize
+
+    @arraysize.setter
+    def arraysize(self, value):
+        self._cursor.arraysize = value
+
+    @property
+    def description(self):
+        """
+            Analogous to :any:`sqlite3.Cursor.description`
+
+            Works only in single cursor mode.
+        """
+
+        if not self.single_cursor_mode:
+            raise S3MError("Calling Connection.description() while not in single cursor mode")
+
+        return self._cursor.description
+
+    def enable_compression(self, table, column, compressor="zlib", threshold=256, aliases=()):
+        """
+            Compress the values of a TEXT or BLOB column.
+
+            The values are compressed when they are bound as parameters of INSERT, REPLACE and UPDATE
+            statements that assign them directly to the column:
+            ``INSERT INTO t(c) VALUES(?)`` or ``UPDATE t SET c = :c``.
+            The values are decompressed when the column is fetched (by name, see :any:`ConverterRegistry`).
+            The result columns are matched by name only: ``SELECT c AS x`` returns the compressed values
+            unless ``x`` is one of the `aliases`, and the columns named `column` in the other tables go
+            through the decompressor too (their values are returned as is unless they look compressed).
+            Note that compressed values can't be searched or compared in SQL.
+
+            :param table: Table name
+            :param column: Column name
+            :param compressor: ``"zlib"``, ``"lzma"`` or a :any:`Compressor`, e.g. :any:`DictCompressor`
+            :param threshold: Values smaller than this (in bytes) are stored uncompressed
+            :param aliases: Other result column names to be decompressed, e.g. ``["x"]`` for ``SELECT c AS x``
+        """
+
+        compressor = get_compressor(compressor)
+
+        if isinstance(compressor, DictCompressor):
+            self.converters.dictionaries[compressor.dict_id] = compressor
+
+        self.compression[(table.lower(), column.lower())] = (compressor, threshold)
+        self.converters.compressed.add(column.lower())
+        self.converters.compressed.update(alias.lower() for alias in aliases)
+        self.compression_cache.clear()
+        self.update_slow_path()
+
+    def disable_compression(self, table, column):
+        """
+            Stop compressing the new values of the column.
+            The values that are already compressed are still decompressed on fetch.
+
+            :param table: Table name
+            :param column: Column name
+        """
+
+        self.compression.pop((table.lower(), column.lower()), None)
+        self.compression_cache.clear()
+        self.update_slow_path()
+
+    def compression_plan(self, sql):
+        """
+            Find the statement parameters that have to be compressed.
+
+            :param sql: SQL statement
+
+            :returns: `list` of (parameter index or name, :any:`Compressor`, threshold)
+        """
+
+        try:
+            return self.compression_cache[sql]
+        except KeyError:
+            pass
+
+        table, bound = bound_columns(sql)
+        plan = []
+
+        if bound and any(key[0] == table.lower() for key in self.compression):
+            if isinstance(bound[0][1], int):
+                # INSERT without a column list
+                with self:
+                    columns = [row[1] for row in
+                               self.connection.execute("PRAGMA table_info(%s)" % (quote_identifier(table),))]
+
+                bound = [(key, columns[i]) for key, i in bound if i < len(columns)]
+
+            for key, column in bound:
+                spec = self.compression.get((table.lower(), column.lower()))
+
+                if spec is not None:
+                    plan.append((key,) + spec)
+
+        self.compression_cache[sql] = plan
+
+        return plan
+
+    def compress_parameters(self, kind, sql, parameters):
+        """
+            Compress the statement parameters, see :any:`Connection.enable_compression`.
+
+            :param kind: ``"execute"`` or ``"executemany"``
+            :param sql: SQL statement
+            :param parameters: Parameters or a sequence of parameters (``"executemany"``)
+        """
+
+        plan = self.compression_plan(sql)
+
+        if not plan:
+            return parameters
+
+        if kind == "executemany":
+            return (compress_parameters(p, plan) for p in parameters)
+
+        return compress_parameters(parameters, plan)
+
+    def compress_existing(self, table, column, batch_size=1000):
+        """
+            Compress the values that were stored before compression was enabled for the column.
+            Runs as a :any:`Migration`, each batch of rows is processed in a separate transaction.
+
+            :param table: Table name
+            :param column: Column name
+            :param batch_size: Initial number of rows in a batch
+
+            :returns: Number of compressed values
+        """
+
+        spec = self.compression.get((table.lower(), column.lower()))
+
+        if spec is None:
+            raise S3MError("Compression is not enabled for %s.%s" % (table, column))
+
+        compressor, threshold = spec
+        select = "SELECT rowid, %s FROM %s WHERE rowid BETWEEN ? AND ?" % (
+            quote_identifier(column), quote_identifier(table))
+        update = "UPDATE %s SET %s = ? WHERE rowid = ?" % (quote_identifier(table), quote_identifier(column))
+
+        def compress_batch(connection, start, end):
+            updates = []
+
+            for rowid, value in connection.connection.execute(select, (start, end)):
+                if isinstance(value, bytes) and value.startswith(COMPRESSION_MAGIC):
+                    continue
+
+                compressed = compress_value(value, compressor, threshold)
+
+                if compressed is not value:
+                    updates.append((compressed, rowid))
+
+            connection.connection.executemany(update, updates)
+
+            return len(updates)
+
+        migration = Migration(self, "s3m_compress:%s.%s" % (table.lower(), column.lower()),
+                              table, compress_batch, batch_size=batch_size)
+
+        # An interrupted run is resumed, a complete one leaves no progress behind
+        migration.run()
+        count = migration.rows
+        migration.reset()
+
+        return count
+
+    def train_compression_dictionary(self, table, column, sample_size=1000, **kwargs):
+        """
+            Train a :any:`DictCompressor` on random values of the column.
+
+            :param table: Table name
+            :param column: Column name
+            :param sample_size: Number of values to be sampled
+
+            Other keyword arguments are passed to :any:`DictCompressor.train`.
+
+            :returns: :any:`DictCompressor`
+        """
+
+        with self:
+            rows = self.connection.execute("SELECT %s FROM %s WHERE %s IS NOT NULL ORDER BY random() LIMIT ?" % (
+                quote_identifier(column), quote_identifier(table), quote_identifier(column)),
+                (sample_size,)).fetchall()
+
+        dictionaries = self.converters.dictionaries
+
+        return DictCompressor.train([decompress_value(row[0], dictionaries) for row in rows], **kwargs)
+
+    def register_converter(self, func, column=None, type=None, batch=True, cache=False):
+        """
+            Register a batch column converter, see :any:`ConverterRegistry`.
+
+            :param func: Converter function, for example :any:`convert_timestamps`,
+                         :any:`convert_json` or :any:`convert_decimals`
+            :param column: Column name (case-insensitive)
+            :param type: Column type (case-insensitive)
+            :param batch: If `True`, `func` takes a `list` of values and returns a `list` of
+                          converted values, otherwise it's called for each value separately
+            :param cache: If `True`, each distinct value is converted only once per batch
+        """
+
+        self.converters.register(func, column=column, type=type, batch=batch, cache=cache)
+
+    def unregister_converter(self, column=None, type=None):
+        """Remove a converter registered with :any:`Connection.register_converter`"""
+
+        self.converters.unregister(column=column, type=type)
+
+    def interrupt(self):
+        """Analogous to :any:`sqlite3.Connection.interrupt`"""
+
+        return self.connection.interrupt()
+
+    def create_function(self, name, num_params, *args, **kwargs):
+        """Analogous to :any:`sqlite3.Connection.create_function`"""
+
+        self.configure(("create_function", name.lower(), num_params),
+                       sqlite3.Connection.create_function, name, num_params, *args, **kwargs)
+
+    def create_aggregate(self, name, num_params, *args, **kwargs):
+        """Analogous to :any:`sqlite3.Connection.create_aggregate`"""
+
+        self.configure(("create_aggregate", name.lower(), num_params),
+                       sqlite3.Connection.create_aggregate, name, num_params, *args, **kwargs)
+
+    def create_collation(self, name, *args, **kwargs):
+        """Analogous to :any:`sqlite3.Connection.create_collation`"""
+
+        self.configure(("create_collation", name.lower()),
+                       sqlite3.Connection.create_collation, name, *args, **kwargs)
+
+    def set_authorizer(self, authorizer_callback):
+        """Analogous to :any:`sqlite3.Connection.set_authorizer`"""
+
+        with self.personal_lock:
+            if self.connection is not None:
+                self.connection.set_authorizer(authorizer_callback)
+
+            self.authorizer = authorizer_callback
+
+    def set_progress_handler(self, *args, **kwargs):
+        """Analogous to :any:`sqlite3.Connection.set_progress_handler`"""
+
+        self.configure(("set_progress_handler",), sqlite3.Connection.set_progress_handler, *args, **kwargs)
+
+    def set_trace_callback(self, trace_callback):
+        """Analogous to :any:`sqlite3.Connection.set_trace_callback`"""
+
+        with self.personal_lock:
+            if self.connection is not None:
+                self.connection.set_trace_callback(trace_callback)
+
+            self.trace_callback = trace_callback
+
+    def enable_load_extension(self, *args, **kwargs):
+        """Analogous to :any:`sqlite3.Connection.enable_load_extension`"""
+
+        self.configure(("enable_load_extension",), sqlite3.Connection.enable_load_extension, *args, **kwargs)
+
+    def load_extension(self, path, *args, **kwargs):
+        """Analogous to :any:`sqlite3.Connection.load_extension`"""
+
+        self.configure(("load_extension", path), sqlite3.Connection.load_extension, path, *args, **kwargs)
+
+    def iterdump(self, *args, **kwargs):
+        """Analogous to :any:`sqlite3.Connection.iterdump`"""
+
+        if self.manager is None:
+            return self.connection.iterdump()
+
+        with self:
+            return list(self.connection.iterdump())
+
+# Magic header of the statement log files
+RECORDING_MAGIC = b"S3MLOG1\n"
+
+class StatementRecorder(object):
+    """
+        Records statements executed through :any:`Connection` objects into a compact binary log,
+        which can be replayed with :any:`replay` or ``python -m s3m replay``.
+
+        For each statement the log stores its parameters, the connection, the thread,
+        the start time, the time spent waiting for the locks, the duration and the error, if any.
+        Each distinct SQL text is stored only once.
+        Parameters are serialized with :any:`pickle`, don't replay logs from untrusted sources.
+
+        :param path: Path to the log file or a binary file object
+    """
+
+    def __init__(self, path):
+        if isinstance(path, (str, bytes, os.PathLike)):
+            self.file = open(path, "wb")
+            self.owns_file = True
+        else:
+            self.file = path
+            self.owns_file = False
+
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.statement_ids = {}
+        self.connection_ids = {}
+        self.record_count = 0
+
+        self.file.write(RECORDING_MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def write(self, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.file.write(struct.pack("<I", len(data)))
+        self.file.write(data)
+
+    def add_connection(self, connection):
+        """
+            Assign an ID to the connection.
+
+            :param connection: :any:`Connection`
+
+            :returns: `int`
+        """
+
+        with self.lock:
+            conn_id = self.connection_ids.get(id(connection))
+
+            if conn_id is None:
+                conn_id = len(self.connection_ids)
+                self.connection_ids[id(connection)] = conn_id
+                self.write(("C", conn_id, connection.isolation_level))
+
+            return conn_id
+
+    def record(self, connection, kind, sql, params, start, lock_wait, duration, error=None):
+        """
+            Write a statement into the log.
+
+            :param connection: :any:`Connection`
+            :param kind: ``"execute"``, ``"executemany"``, ``"executescript"``,
+                         ``"commit"`` or ``"rollback"``
+            :param sql: SQL statement or `None`
+            :param params: Statement parameters
+            :param start: `time.monotonic()` of the call
+            :param lock_wait: Time spent waiting for the locks
+            :param duration: Time spent executing the statement
+            :param error: Error message or `None`
+        """
+
+        conn_id = self.add_connection(connection)
+
+        try:
+            pickle.dumps(params, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            params = None
+            error = error or "Parameters could not be serialized"
+
+        with self.lock:
+            stmt_id = None
+
+            if sql is not None:
+                stmt_id = self.statement_ids.get(sql)
+
+                if stmt_id is None:
+                    stmt_id = len(self.statement_ids)
+                    self.statement_ids[sql] = stmt_id
+                    self.write(("S", stmt_id, sql))
+
+            self.write(("E", conn_id, threading.get_ident(), kind, stmt_id, params,
+                        start - self.start_time, lock_wait, duration, error))
+            self.record_count += 1
+
+    def run(self, connection, target, kind, args, kwargs, callback=None):
+        """
+            Call `target.<kind>()` with the connection locks acquired and record the call.
+            If `target` is the connection, the method of its `sqlite3.Connection` is called.
+
+            :param connection: :any:`Connection`
+            :param target: :any:`Cursor` or :any:`Connection`
+            :param kind: Name of the method
+            :param args: Positional arguments
+            :param kwargs: Keyword arguments
+            :param callback: Function to call after a successful call, before the locks are released
+        """
+
+        if kind in ("commit", "rollback"):
+            sql, params = None, None
+        else:
+            args = list(args)
+            sql = args[0] if args else kwargs.get("sql", kwargs.get("sql_script"))
+            params = ()
+
+            if len(args) > 1:
+                params = args[1]
+            elif "parameters" in kwargs:
+                params = kwargs["parameters"]
+            elif "seq_of_parameters" in kwargs:
+                params = kwargs["seq_of_parameters"]
+
+            if kind == "executemany":
+                # The parameters might be an iterator
+                params = list(params)
+
+                if len(args) > 1:
+                    args[1] = params
+                elif "parameters" in kwargs:
+                    kwargs["parameters"] = params
+                elif "seq_of_parameters" in kwargs:
+                    kwargs["seq_of_parameters"] = params
+
+        error = None
+        start = time.monotonic()
+
+        with target:
+            acquired = time.monotonic()
+
+            # The handle of a lazy connection is only guaranteed to be open with the locks acquired
+            if target is connection:
+                method = getattr(connection.connection, kind)
+            else:
+                method = getattr(target._cursor, kind)
+
+            try:
+                method(*args, **kwargs)
+            except Exception as e:
+                error = "%s: %s" % (type(e).__name__, e)
+                raise
+            finally:
+                end = time.monotonic()
+                self.record(connection, kind, sql, params, start, acquired - start, end - acquired, error)
+
+            if callback is not None:
+                callback()
+
+    def flush(self):
+        """Flush the log file"""
+
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        """Close the log file"""
+
+        with self.lock:
+            if self.owns_file:
+                self.file.close()
+            else:
+                self.file.flush()
+
+def read_recording(path):
+    """
+        Read a log written by :any:`StatementRecorder`.
+
+        :param path: Path to the log file
+
+        :returns: (connections, events), where `connections` maps connection IDs to their isolation levels
+                  and `events` is a `list` of :any:`RecordedStatement`
+    """
+
+    statements = {}
+    connections = {}
+    events = []
+
+    with open(path, "rb") as f:
+        if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise S3MError("%s is not an s3m statement log" % (path,))
+
+        while True:
+            header = f.read(4)
+
+            if len(header) < 4:
+                break
+
+            size, = struct.unpack("<I", header)
+            data = f.read(size)
+
+            if len(data) < size:
+                # Truncated record
+                break
+
+            record = pickle.loads(data)
+
+            if record[0] == "S":
+                statements[record[1]] = record[2]
+            elif record[0] == "C":
+                connections[record[1]] = record[2]
+            elif record[0] == "E":
+                _, conn_id, thread_id, kind, stmt_id, params, start, lock_wait, duration, error = record
+                events.append(RecordedStatement(conn_id, thread_id, kind, statements.get(stmt_id),
+                                                params, start, lock_wait, duration, error))
+
+    return connections, events
+
+class RecordedStatement(object):
+    """A statement read from a log by :any:`read_recording`"""
+
+    def __init__(self, conn_id, thread_id, kind, sql, params, start, lock_wait, duration, error):
+        self.conn_id = conn_id
+        self.thread_id = thread_id
+        self.kind = kind
+        self.sql = sql
+        self.params = params
+        self.start = start
+        self.lock_wait = lock_wait
+        self.duration = duration
+        self.error = error
+
+def percentile(values, p):
+    """
+        >>> percentile([1, 2, 3, 4], 50)
+        2
+        >>> percentile([1, 2, 3, 4], 100)
+        4
+        >>> percentile([], 50)
+    """
+
+    if not values:
+        return None
+
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+
+    return values[index]
+
+class ReplayReport(object):
+    """
+        Result of :any:`replay`.
+
+        :ivar count: Number of replayed statements
+        :ivar error_count: Number of failed statements
+        :ivar elapsed: Total replay time
+        :ivar latencies: `list` of statement latencies, including the lock wait
+        :ivar original_latencies: `list` of recorded statement latencies, including the lock wait
+        :ivar original_elapsed: Duration of the recording
+    """
+
+    def __init__(self, count, error_count, elapsed, latencies, original_latencies, original_elapsed):
+        self.count = count
+        self.error_count = error_count
+        self.elapsed = elapsed
+        self.latencies = latencies
+        self.original_latencies = original_latencies
+        self.original_elapsed = original_elapsed
+
+    @property
+    def throughput(self):
+        """Statements per second"""
+
+        return self.count / self.elapsed if self.elapsed else None
+
+    def latency_distribution(self, latencies=None):
+        """
+            :returns: `dict` with mean, p50, p90, p99 and max latency
+        """
+
+        if latencies is None:
+            latencies = self.latencies
+
+        return {"mean": sum(latencies) / len(latencies) if latencies else None,
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies) if latencies else None}
+
+    def format(self):
+        """Returns the report as human-readable text"""
+
+        def ms(x):
+            return "-" if x is None else "%.3fms" % (x * 1000,)
+
+        lines = ["statements: %d (%d errors)" % (self.count, self.error_count),
+                 "elapsed: %.3fs (recorded: %.3fs)" % (self.elapsed, self.original_elapsed),
+                 "throughput: %.1f statements/s" % (self.throughput or 0.0,)]
+
+        for name, latencies in (("replay", self.latencies), ("recorded", self.original_latencies)):
+            dist = self.latency_distribution(latencies)
+            lines.append("%s latency: mean %s, p50 %s, p90 %s, p99 %s, max %s" %
+                         (name, ms(dist["mean"]), ms(dist["p50"]), ms(dist["p90"]),
+                          ms(dist["p99"]), ms(dist["max"])))
+
+        return "\n".join(lines) + "\n"
+
+def replay(log_path, database, timed=False, speed=1.0, copy=True, lock_timeout=-1):
+    """
+        Replay a log written by :any:`StatementRecorder`.
+
+        Statements recorded in the same thread are replayed sequentially in their own thread,
+        so the original concurrency is preserved.
+
+        :param log_path: Path to the log
+        :param database: Path to the database
+        :param timed: If `True`, the statements are started with the original timing,
+                      otherwise they are replayed as fast as possible
+        :param speed: Timing multiplier for the timed mode
+        :param copy: If `True`, the log is replayed against a temporary copy of the database
+        :param lock_timeout: `lock_timeout` for the connections
+
+        :returns: :any:`ReplayReport`
+    """
+
+    connections, events = read_recording(log_path)
+
+    if copy:
+        fd, target = tempfile.mkstemp(prefix="s3m-replay-", suffix=".db",
+                                      dir=os.path.dirname(os.path.abspath(database)))
+        os.close(fd)
+
+        source = sqlite3.connect(database)
+        dest = sqlite3.connect(target)
+
+        try:
+            source.backup(dest)
+        finally:
+            dest.close()
+            source.close()
+    else:
+        target = database
+
+    try:
+        conns = {conn_id: connect(target, isolation_level=isolation_level,
+                                  check_same_thread=False, lock_timeout=lock_timeout)
+                 for conn_id, isolation_level in connections.items()}
+
+        by_thread = {}
+
+        for event in events:
+            by_thread.setdefault(event.thread_id, []).append(event)
+
+        latencies = []
+        errors = [0]
+        stats_lock = threading.Lock()
+        start_event = threading.Event()
+        replay_start = [None]
+
+        def worker(thread_events):
+            cursors = {}
+            thread_latencies = []
+            thread_errors = 0
+
+            start_event.wait()
+
+            for event in thread_events:
+                if timed:
+                    delay = replay_start[0] + event.start / speed - time.monotonic()
+
+                    if delay > 0:
+                        time.sleep(delay)
+
+                conn = conns[event.conn_id]
+                start = time.monotonic()
+
+                try:
+                    if event.kind == "commit":
+                        conn.commit()
+                    elif event.kind == "rollback":
+                        conn.rollback()
+                    else:
+                        cursor = cursors.get(event.conn_id)
+
+                        if cursor is None:
+                            cursor = conn.cursor()
+                            cursors[event.conn_id] = cursor
+
+                        if event.kind == "executescript":
+                            cursor.executescript(event.sql)
+                        else:
+                            getattr(cursor, event.kind)(event.sql, event.params or ())
+
+                            if event.kind == "execute" and cursor.description is not None:
+                                cursor.fetchall()
+                except Exception:
+                    thread_errors += 1
+
+                thread_latencies.append(time.monotonic() - start)
+
+            with stats_lock:
+                latencies.extend(thread_latencies)
+                errors[0] += thread_errors
+
+        threads = [threading.Thread(target=worker, args=(thread_events,))
+                   for thread_events in by_thread.values()]
+
+        for thread in threads:
+            thread.start()
+
+        replay_start[0] = time.monotonic()
+        start_event.set()
+
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.monotonic() - replay_start[0]
+
+        for conn in conns.values():
+            conn.close()
+    finally:
+        if copy:
+            for suffix in ("", "-wal", "-shm", "-journal"):
+                try:
+                    os.remove(target + suffix)
+                except OSError:
+                    pass
+
+    original_latencies = [e.lock_wait + e.duration for e in events]
+    original_elapsed = max(e.start + e.lock_wait + e.duration for e in events) if events else 0.0
+
+    return ReplayReport(len(events), errors[0], elapsed, latencies,
+                        original_latencies, original_elapsed)
+
+def connect(path, lock_transactions=True, lock_timeout=-1, single_cursor_mode=False,
+            factory=Connection, *args, warmup=None, **kwargs):
+    """Analogous to sqlite3.connect()
+
+       :param path: Path to the database
        :param lock_transactions: If `True`, parallel transactions will be blocked
        :param lock_timeout: Maximum amount of time the connection is allowed to wait for a lock.
                             If the timeout i exceeded, :any:`LockTimeoutError` will be thrown.
                             -1 disables the timeout.
        :param single_cursor_mode: Use only one cursor (default: `False`)
        :param factory: Connection class (default: :any:`Connection`)
+       :param warmup: `True` or a `dict` of keyword arguments for :any:`Connection.warmup`
+                      to warm up the database in the background
+    """
+
+    conn = factory(path,
+                   lock_transactions=lock_transactions,
+                   lock_timeout=lock_timeout,
+                   single_cursor_mode=single_cursor_mode,
+                   *args, **kwargs)
+
+    if warmup:
+        conn.warmup(**(warmup if isinstance(warmup, dict) else {}))
+
+    return conn
+
+# Tokenizer used by the workload tools below
+TOKEN_REGEX = re.compile(r"""
+    (?P<space>\s+|--[^\n]*|/\*.*?\*/)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<blob>[xX]'[0-9a-fA-F]*')
+  | (?P<ident>"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\]|[A-Za-z_][A-Za-z_0-9$]*)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|0[xX][0-9a-fA-F]+)
+  | (?P<param>\?\d*|[:@$][A-Za-z_0-9]+)
+  | (?P<op><=|>=|==|!=|<>|\|\||<<|>>|[-+*/%<>=~&|(),.;])
+""", re.VERBOSE | re.DOTALL)
+
+EQUALITY_OPERATORS = {"=", "==", "IS", "IN"}
+RANGE_OPERATORS = {"<", ">", "<=", ">=", "BETWEEN"}
+
+# Keywords that can't be table aliases
+SQL_KEYWORDS = {"WHERE", "JOIN", "INNER", "LEFT", "RIGHT", "FULL", "OUTER", "CROSS",
+                "NATURAL", "ON", "USING", "GROUP", "ORDER", "LIMIT", "HAVING",
+                "UNION", "EXCEPT", "INTERSECT", "SET", "VALUES", "SELECT",
+                "DEFAULT", "RETURNING", "WINDOW", "INDEXED", "NOT", "AS", "DO"}
+
+def tokenize_sql(sql):
+    """
+        Split an SQL statement into tokens.
+
+        :param sql: `str`, SQL statement
+
+        :returns: `list` of (kind, text) pairs, whitespace and comments are omitted
+    """
+
+    tokens = []
+    pos = 0
+
+    while pos < len(sql):
+        match = TOKEN_REGEX.match(sql, pos)
+
+        if match is None:
+            tokens.append(("other", sql[pos]))
+            pos += 1
+            continue
+
+        pos = match.end()
+
+        if match.lastgroup != "space":
+            tokens.append((match.lastgroup, match.group()))
+
+    return tokens
+
+def unquote_identifier(ident):
+    """
+    >>> unquote_identifier('"a""b"')
+    'a"b'
+    >>> unquote_identifier("[a b]")
+    'a b'
+    >>> unquote_identifier("abc")
+    'abc'
+    """
+
+    if ident[:1] in ('"', "`"):
+        return ident[1:-1].replace(ident[0] * 2, ident[0])
+
+    if ident[:1] == "[":
+        return ident[1:-1]
+
+    return ident
+
+def quote_identifier(ident):
+    """
+    >>> quote_identifier('a"b')
+    '"a""b"'
+    """
+
+    return '"%s"' % (ident.replace('"', '""'),)
+
+# First characters of statements that might be ATTACH or DETACH
+ATTACH_PREFIXES = "aAdD \t\r\n"
+
+def is_attach_statement(sql):
+    """
+    >>> is_attach_statement("  attach database 'a.db' AS a")
+    True
+    >>> is_attach_statement("DETACH a")
+    True
+    >>> is_attach_statement("SELECT 1")
+    False
+    """
+
+    return sql.lstrip()[:6].upper() in ("ATTACH", "DETACH")
+
+def begins_transaction(sql, implicit):
+    """
+        Check if the statement starts a transaction when the connection isn't in one.
+
+        :param sql: SQL statement
+        :param implicit: `True` if `sqlite3` implicitly begins transactions before
+                         INSERT, UPDATE, DELETE and REPLACE (``isolation_level`` is not `None`)
+
+        >>> begins_transaction("begin immediate", False)
+        True
+        >>> begins_transaction("INSERT INTO a VALUES(1)", True)
+        True
+        >>> begins_transaction("INSERT INTO a VALUES(1)", False)
+        False
+    """
+
+    word = sql.lstrip()[:9].upper()
+
+    if word[:5] == "BEGIN" or word == "SAVEPOINT":
+        return True
+
+    return implicit and word[:6] in ("INSERT", "UPDATE", "DELETE", "REPLAC")
+
+def split_statements(script):
+    """
+        Split an SQL script into statements.
+
+        >>> split_statements("PRAGMA foreign_keys = 1; ATTACH 'a;b.db' AS a; SELECT 1")
+        ['PRAGMA foreign_keys = 1;', "ATTACH 'a;b.db' AS a;", 'SELECT 1']
     """
 
-    return factory(path,
-                   lock_transactions=lock_transactions,
-                   lock_timeout=lock_timeout,
-                   single_cursor_mode=single_cursor_mode,
-                   *args, **kwargs)
+    statements = []
+    start = 0
+    pos = script.find(";")
+
+    while pos != -1:
+        statement = script[start:pos + 1]
+
+        # The semicolon might be inside a string literal or a trigger body
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            start = pos + 1
+
+        pos = script.find(";", pos + 1)
+
+    if script[start:].strip():
+        statements.append(script[start:].strip())
+
+    return statements
+
+def is_schema_statement(sql):
+    """
+    >>> is_schema_statement("CREATE TEMP TABLE b(id INTEGER)")
+    True
+    >>> is_schema_statement(" drop table b")
+    True
+    >>> is_schema_statement("SELECT * FROM b")
+    False
+    """
+
+    word = sql.lstrip()[:6].upper()
+
+    return word == "CREATE" or word[:5] == "ALTER" or word[:4] == "DROP"
+
+def bound_columns(sql):
+    """
+        Find the parameters that INSERT, REPLACE and UPDATE statements assign directly to columns.
+        Positional parameters are identified by 0-based indices, named ones by their names.
+        If an INSERT statement has no column list, the columns are identified by their positions.
+
+        >>> bound_columns("INSERT INTO t(a, b) VALUES(?, :x)")
+        ('t', [(0, 'a'), ('x', 'b')])
+        >>> bound_columns("UPDATE main.t SET b = ?2, a = a + ? WHERE id = ?")
+        ('t', [(1, 'b')])
+        >>> bound_columns("INSERT INTO t VALUES(?, ?), (?, 1)")
+        ('t', [(0, 0), (1, 1), (2, 0)])
+        >>> bound_columns("SELECT ?")
+        (None, [])
+
+        :param sql: SQL statement
+
+        :returns: (table, `list` of (parameter, column name or position))
+    """
+
+    tokens = tokenize_sql(sql)
+    words = [text.upper() if kind == "ident" else text for kind, text in tokens]
+    keys = {}
+    count = 0
+
+    for i, (kind, text) in enumerate(tokens):
+        if kind != "param":
+            continue
+
+        if text[0] != "?":
+            keys[i] = text[1:]
+        else:
+            count = max(count + 1, int(text[1:] or 0))
+            keys[i] = count - 1
+
+    if not words or words[0] not in ("INSERT", "REPLACE", "UPDATE"):
+        return None, []
+
+    pos = words.index("INTO") + 1 if words[0] != "UPDATE" and "INTO" in words else 1
+
+    if words[0] == "UPDATE" and words[pos:pos + 1] == ["OR"]:
+        pos += 2
+
+    if words[pos + 1:pos + 2] == ["."]:
+        pos += 2
+
+    if pos >= len(tokens):
+        return None, []
+
+    table = unquote_identifier(tokens[pos][1])
+    pos += 1
+    result = []
+
+    def split_items(start, stop_words):
+        # Split tokens into comma separated items at the top level
+        items = [[]]
+        depth = 0
+        i = start
+
+        while i < len(tokens):
+            word = words[i]
+
+            if depth == 0 and (word in stop_words or word == ")"):
+                break
+
+            if word == "(":
+                depth += 1
+            elif word == ")":
+                depth -= 1
+
+            if depth == 0 and word == ",":
+                items.append([])
+            else:
+                items[-1].append(i)
+
+            i += 1
+
+        return items, i
+
+    if words[0] == "UPDATE":
+        if "SET" not in words[pos:]:
+            return table, []
+
+        assignments, _ = split_items(words.index("SET", pos) + 1, ("WHERE", "FROM", "RETURNING", "ORDER", "LIMIT"))
+
+        for item in assignments:
+            if len(item) == 3 and words[item[1]] == "=" and item[2] in keys:
+                result.append((keys[item[2]], unquote_identifier(tokens[item[0]][1])))
+
+        return table, result
+
+    if words[pos:pos + 1] == ["AS"]:
+        pos += 2
+
+    columns = None
+
+    if words[pos:pos + 1] == ["("]:
+        items, pos = split_items(pos + 1, ())
+        columns = [unquote_identifier(tokens[item[0]][1]) for item in items if item]
+        pos += 1
+
+    if words[pos:pos + 1] != ["VALUES"]:
+        return table, []
+
+    pos += 1
+
+    while words[pos:pos + 1] == ["("]:
+        items, pos = split_items(pos + 1, ())
+
+        for i, item in enumerate(items):
+            if len(item) == 1 and item[0] in keys and (columns is None or i < len(columns)):
+                result.append((keys[item[0]], i if columns is None else columns[i]))
+
+        pos += 1
+
+        if words[pos:pos + 1] != [","]:
+            break
+
+        pos += 1
+
+    return table, result
+
+def compress_parameters(parameters, plan):
+    """
+        Compress statement parameters according to :any:`Connection.compression_plan`.
+
+        :param parameters: `dict` or sequence of parameters
+        :param plan: `list` of (parameter index or name, :any:`Compressor`, threshold)
+    """
+
+    if isinstance(parameters, dict):
+        parameters = dict(parameters)
+
+        for key, compressor, threshold in plan:
+            if key in parameters:
+                parameters[key] = compress_value(parameters[key], compressor, threshold)
+    else:
+        parameters = list(parameters)
+
+        for key, compressor, threshold in plan:
+            if isinstance(key, int) and key < len(parameters):
+                parameters[key] = compress_value(parameters[key], compressor, threshold)
+
+    return parameters
+
+def dummy_parameters(sql):
+    """
+        Make `NULL` parameters for all the placeholders in the statement.
+
+        >>> dummy_parameters("SELECT ?, ?3")
+        (None, None, None)
+        >>> dummy_parameters("SELECT :a, @b")
+        {'a': None, 'b': None}
+    """
+
+    count = 0
+    names = {}
+
+    for kind, text in tokenize_sql(sql):
+        if kind != "param":
+            continue
+
+        if text[0] == "?":
+            count = max(count + 1, int(text[1:] or 0))
+        else:
+            names[text[1:]] = None
+
+    if names:
+        return names
+
+    return (None,) * count
+
+def quote_literal(value):
+    """
+    >>> quote_literal("it's")
+    "'it''s'"
+    """
+
+    return "'%s'" % (value.replace("'", "''"),)
+
+def normalize_statement(sql):
+    """
+        Replace literals with placeholders so that similar statements look the same.
+
+        >>> normalize_statement("SELECT *  FROM a WHERE b = 'x' AND c IN (1, 2, 3)")
+        'SELECT * FROM a WHERE b = ? AND c IN (?)'
+        >>> normalize_statement("SELECT 1.5e3")
+        'SELECT ?'
+
+        :param sql: `str`, SQL statement
+
+        :returns: `str`
+    """
+
+    out = []
+
+    for kind, text in tokenize_sql(sql):
+        if kind in ("string", "blob", "number", "param"):
+            text = "?"
+
+            # Collapse lists of placeholders: (?, ?, ?) -> (?)
+            if len(out) >= 2 and out[-1] == "," and out[-2] == "?":
+                out.pop()
+                continue
+
+        out.append(text)
+
+    result = " ".join(out)
+
+    for a, b in (("( ", "("), (" )", ")"), (" ,", ","), (" .", "."), (". ", "."), (" ;", ";")):
+        result = result.replace(a, b)
+
+    return result.rstrip("; ")
+
+class StatementCollector(object):
+    """
+        Collects executed statements, meant to be passed to
+        :any:`Connection.set_trace_callback`.
+
+        Elements of :any:`StatementCollector.statements` can be passed directly to :any:`IndexAdvisor`.
+
+        :param limit: Maximum number of statements to keep, `None` means no limit
+    """
+
+    def __init__(self, limit=None):
+        self.statements = []
+        self.limit = limit
+        self.lock = threading.Lock()
+
+    def __call__(self, statement):
+        with self.lock:
+            if self.limit is not None and len(self.statements) >= self.limit:
+                return
+
+            self.statements.append(statement)
+
+    def clear(self):
+        """Forget all the collected statements"""
+
+        with self.lock:
+            self.statements = []
+
+class IndexRecommendation(object):
+    """
+        Index proposed by :any:`IndexAdvisor`.
+
+        :ivar table: Name of the table
+        :ivar columns: `tuple` of column names
+        :ivar sql: `CREATE INDEX` statement
+        :ivar cost_before: Cost of the workload without the index
+        :ivar cost_after: Cost of the workload with the index
+        :ivar reasons: `list` of query plan lines that led to the recommendation
+        :ivar statements: `list` of normalized statements that benefit from the index
+    """
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = tuple(columns)
+        self.reasons = []
+        self.statements = []
+        self.cost_before = None
+        self.cost_after = None
+
+        name = "s3m_idx_%s_%s" % (table, "_".join(columns))
+        name = re.sub(r"[^A-Za-z0-9_]", "_", name)
+
+        self.name = name
+        self.sql = "CREATE INDEX %s ON %s(%s)" % (quote_identifier(name), quote_identifier(table),
+                                                   ", ".join(quote_identifier(c) for c in columns))
+
+    @property
+    def benefit(self):
+        """Cost reduction of the workload"""
+
+        if self.cost_before is None or self.cost_after is None:
+            return None
+
+        return self.cost_before - self.cost_after
+
+    @property
+    def speedup(self):
+        """Ratio of the workload cost before and after creating the index"""
+
+        if not self.cost_after:
+            return None
+
+        return float(self.cost_before) / self.cost_after
+
+    def __repr__(self):
+        return "<IndexRecommendation %s benefit=%s>" % (self.sql, self.benefit)
+
+class WorkloadStatement(object):
+    """A group of workload statements that only differ in literals"""
+
+    def __init__(self, normalized, sql, params):
+        self.normalized = normalized
+        self.sql = sql
+        self.params = params
+        self.count = 0
+
+class IndexAdvisor(object):
+    """
+        Proposes indexes based on a recorded workload.
+
+        Every distinct statement is run through ``EXPLAIN QUERY PLAN``,
+        full table scans and temporary B-trees are turned into index candidates.
+        Each candidate is then verified on a scratch copy of the database by
+        measuring the cost of the whole workload with and without the index.
+        The cost is the number of SQLite virtual machine instructions, which,
+        unlike wall time, doesn't depend on the machine load.
+
+        :param connection: :any:`Connection` to the database
+        :param statements: iterable of SQL statements (`str`) or (sql, params) pairs,
+                           for example :any:`StatementCollector.statements`
+        :param cost_granularity: Number of VM instructions per cost unit
+    """
+
+    def __init__(self, connection, statements=(), cost_granularity=10):
+        self.connection = connection
+        self.cost_granularity = cost_granularity
+        self.workload = {}
+        self._columns_cache = {}
+
+        self.add_statements(statements)
+
+    def add_statements(self, statements):
+        """
+            Add more statements to the workload.
+
+            :param statements: iterable of SQL statements (`str`) or (sql, params) pairs
+        """
+
+        for statement in statements:
+            if isinstance(statement, str):
+                sql, params = statement, ()
+            else:
+                sql, params = statement
+
+            if not self.is_analyzable(sql):
+                continue
+
+            normalized = normalize_statement(sql)
+            entry = self.workload.get(normalized)
+
+            if entry is None:
+                entry = WorkloadStatement(normalized, sql, params)
+                self.workload[normalized] = entry
+
+            entry.count += 1
+
+    @staticmethod
+    def is_analyzable(sql):
+        """Check if the statement is a query or a DML statement"""
+
+        tokens = tokenize_sql(sql)
+
+        if not tokens:
+            return False
+
+        return tokens[0][1].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+    def table_columns(self, table):
+        """Returns column names of a table (lowercase)"""
+
+        key = table.lower()
+
+        try:
+            return self._columns_cache[key]
+        except KeyError:
+            pass
+
+        rows = self.connection.execute("PRAGMA table_info(%s)" % (quote_identifier(table),)).fetchall()
+        columns = [row[1].lower() for row in rows]
+
+        self._columns_cache[key] = columns
+
+        return columns
+
+    def existing_indexes(self, table):
+        """Returns `list` of column tuples of the table's indexes (lowercase)"""
+
+        result = []
+
+        for row in self.connection.execute("PRAGMA index_list(%s)" % (quote_identifier(table),)).fetchall():
+            info = self.connection.execute("PRAGMA index_info(%s)" % (quote_identifier(row[1]),)).fetchall()
+            result.append(tuple((r[2] or "").lower() for r in sorted(info)))
+
+        return result
+
+    @staticmethod
+    def parse_statement(sql):
+        """
+            Extract table references and column usage from a statement.
+
+            :returns: (aliases, predicates, ordering), where
+                      `aliases` maps aliases (lowercase) to table names,
+                      `predicates` is a `list` of (qualifier, column, kind) with kind being
+                      ``"eq"``, ``"join"`` or ``"range"`` and `ordering` is a `list` of (qualifier, column)
+        """
+
+        tokens = [(kind, unquote_identifier(text) if kind == "ident" else text)
+                  for kind, text in tokenize_sql(sql)]
+        upper = [text.upper() if kind == "ident" else text for kind, text in tokens]
+
+        aliases = {}
+        predicates = []
+        ordering = []
+        clause = None
+        i = 0
+
+        def column_ref_before(i):
+            # ... [qualifier .] column <i>
+            if i < 1 or tokens[i - 1][0] != "ident" or upper[i - 1] in SQL_KEYWORDS:
+                return None
+
+            if i >= 3 and upper[i - 2] == "." and tokens[i - 3][0] == "ident":
+                return (tokens[i - 3][1].lower(), tokens[i - 1][1].lower())
+
+            return (None, tokens[i - 1][1].lower())
+
+        def column_ref_after(i):
+            # <i> [qualifier .] column ...
+            if i + 1 >= len(tokens) or tokens[i + 1][0] != "ident" or upper[i + 1] in SQL_KEYWORDS:
+                return None
+
+            if i + 3 < len(tokens) and upper[i + 2] == "." and tokens[i + 3][0] == "ident":
+                if i + 4 < len(tokens) and upper[i + 4] == "(":
+                    return None
+
+                return (tokens[i + 1][1].lower(), tokens[i + 3][1].lower())
+
+            if i + 2 < len(tokens) and upper[i + 2] == "(":
+                # Function call
+                return None
+
+            return (None, tokens[i + 1][1].lower())
+
+        while i < len(tokens):
+            kind, text = tokens[i]
+            word = upper[i]
+
+            if kind == "ident" and word in ("FROM", "JOIN", "UPDATE", "INTO"):
+                clause = "table"
+                i += 1
+
+                while i < len(tokens) and tokens[i][0] == "ident" and upper[i] not in SQL_KEYWORDS:
+                    table = tokens[i][1]
+                    i += 1
+
+                    if i + 1 < len(tokens) and upper[i] == "." and tokens[i + 1][0] == "ident":
+                        # schema.table
+                        table = tokens[i + 1][1]
+                        i += 2
+
+                    alias = table
+
+                    if i < len(tokens) and upper[i] == "AS":
+                        i += 1
+
+                    if (i < len(tokens) and tokens[i][0] == "ident" and
+                        upper[i] not in SQL_KEYWORDS and upper[i] != "("):
+                        alias = tokens[i][1]
+                        i += 1
+
+                    aliases[alias.lower()] = table
+                    aliases.setdefault(table.lower(), table)
+
+                    if i < len(tokens) and upper[i] == ",":
+                        i += 1
+                    else:
+                        break
+
+                continue
+            elif kind == "ident" and word in ("WHERE", "ON", "HAVING"):
+                clause = "predicate"
+            elif kind == "ident" and word in ("ORDER", "GROUP") and i + 1 < len(tokens) and upper[i + 1] == "BY":
+                clause = "ordering"
+                i += 2
+                continue
+            elif kind == "ident" and word in ("SELECT", "SET", "VALUES", "LIMIT", "RETURNING"):
+                clause = None
+            elif clause == "predicate" and (word in EQUALITY_OPERATORS or word in RANGE_OPERATORS):
+                op_kind = "eq" if word in EQUALITY_OPERATORS else "range"
+
+                left = column_ref_before(i)
+                right = None
+
+                if word not in ("IN", "BETWEEN", "IS"):
+                    right = column_ref_after(i)
+
+                # Comparing two columns is a join condition
+                if left is not None and right is not None and op_kind == "eq":
+                    op_kind = "join"
+
+                for ref in (left, right):
+                    if ref is not None:
+                        predicates.append(ref + (op_kind,))
+            elif clause == "ordering" and kind == "ident" and word not in ("ASC", "DESC", "COLLATE", "NULLS",
+                                                                          "FIRST", "LAST"):
+                if i + 1 < len(tokens) and upper[i + 1] == ".":
+                    pass
+                elif i >= 2 and upper[i - 1] == ".":
+                    ordering.append((tokens[i - 2][1].lower(), text.lower()))
+                elif i + 1 >= len(tokens) or upper[i + 1] != "(":
+                    ordering.append((None, text.lower()))
+
+            i += 1
+
+        return aliases, predicates, ordering
+
+    def resolve_columns(self, refs, aliases, table):
+        """Filter column references that belong to `table`"""
+
+        table_columns = self.table_columns(table)
+        tables = set(t.lower() for t in aliases.values())
+        result = []
+
+        for ref in refs:
+            qualifier, column = ref[0], ref[1]
+
+            if column not in table_columns or column in result:
+                continue
+
+            if qualifier is None:
+                # Ambiguous references are skipped
+                owners = [t for t in tables if column in self.table_columns(t)]
+
+                if owners != [table.lower()]:
+                    continue
+            elif aliases.get(qualifier, "").lower() != table.lower():
+                continue
+
+            result.append(column)
+
+        return result
+
+    def query_plan(self, sql, params=()):
+        """Returns `list` of ``EXPLAIN QUERY PLAN`` lines"""
+
+        rows = self.connection.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+
+        return [row[-1] for row in rows]
+
+    def find_candidates(self):
+        """
+            Find index candidates without verifying them.
+
+            :returns: `list` of :any:`IndexRecommendation`
+        """
+
+        candidates = {}
+
+        for entry in self.workload.values():
+            try:
+                plan = self.query_plan(entry.sql, entry.params)
+            except (sqlite3.Error, ValueError):
+                continue
+
+            aliases, predicates, ordering = self.parse_statement(entry.sql)
+            eq_refs = [p for p in predicates if p[2] == "eq"]
+            eq_refs += [p for p in predicates if p[2] == "join"]
+            range_refs = [p for p in predicates if p[2] == "range"]
+            temp_btree = [line for line in plan if line.startswith("USE TEMP B-TREE FOR")]
+            single_table = len(set(t.lower() for t in aliases.values())) == 1
+
+            scanned = []
+
+            for line in plan:
+                match = re.match(r"SCAN (?:TABLE )?(\S+)", line)
+
+                if match is None:
+                    continue
+
+                alias = unquote_identifier(match.group(1)).lower()
+
+                if alias in aliases:
+                    scanned.append((aliases[alias], line))
+
+            if temp_btree and not scanned and single_table:
+                scanned.append((list(aliases.values())[0], temp_btree[0]))
+
+            for table, reason in scanned:
+                try:
+                    columns = self.resolve_columns(eq_refs, aliases, table)
+
+                    # An index can either avoid sorting or narrow down a range, not both
+                    if temp_btree and single_table and ordering:
+                        for column in self.resolve_columns(ordering, aliases, table):
+                            if column not in columns:
+                                columns.append(column)
+                    else:
+                        for column in self.resolve_columns(range_refs, aliases, table)[:1]:
+                            if column not in columns:
+                                columns.append(column)
+                except sqlite3.Error:
+                    continue
+
+                if not columns:
+                    continue
+
+                existing = self.existing_indexes(table)
+
+                if any(index[:len(columns)] == tuple(columns) for index in existing):
+                    continue
+
+                key = (table.lower(), tuple(columns))
+                candidate = candidates.get(key)
+
+                if candidate is None:
+                    candidate = IndexRecommendation(table, columns)
+                    candidates[key] = candidate
+
+                for line in [reason] + temp_btree:
+                    if line not in candidate.reasons:
+                        candidate.reasons.append(line)
+
+                if entry.normalized not in candidate.statements:
+                    candidate.statements.append(entry.normalized)
+
+        return list(candidates.values())
+
+    def make_scratch_copy(self):
+        """Copy the database into memory"""
+
+        scratch = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+
+        with self.connection:
+            self.connection.connection.backup(scratch)
+
+        return scratch
+
+    def measure(self, scratch):
+        """
+            Measure the cost of the workload.
+
+            Modifications are rolled back after each statement.
+
+            :param scratch: `sqlite3.Connection`
+
+            :returns: `int`
+        """
+
+        steps = [0]
+
+        def progress_handler():
+            steps[0] += 1
+            return 0
+
+        scratch.set_progress_handler(progress_handler, self.cost_granularity)
+
+        try:
+            total = 0
+
+            for entry in self.workload.values():
+                steps[0] = 0
+                scratch.execute("BEGIN")
+
+                try:
+                    scratch.execute(entry.sql, entry.params).fetchall()
+                except (sqlite3.Error, ValueError):
+                    steps[0] = 0
+                finally:
+                    scratch.execute("ROLLBACK")
+
+                total += steps[0] * entry.count
+        finally:
+            scratch.set_progress_handler(None, self.cost_granularity)
+
+        return total * self.cost_granularity
+
+    def analyze(self):
+        """
+            Find and verify index candidates.
+
+            :returns: `list` of :any:`IndexRecommendation` that reduce the workload cost,
+                      the most beneficial ones come first
+        """
+
+        candidates = self.find_candidates()
+
+        if not candidates:
+            return []
+
+        scratch = self.make_scratch_copy()
+
+        try:
+            cost_before = self.measure(scratch)
+            result = []
+
+            for candidate in candidates:
+                try:
+                    scratch.execute(candidate.sql)
+                except sqlite3.Error:
+                    continue
+
+                try:
+                    candidate.cost_before = cost_before
+                    candidate.cost_after = self.measure(scratch)
+                finally:
+                    scratch.execute("DROP INDEX %s" % (quote_identifier(candidate.name),))
+
+                if candidate.benefit > 0:
+                    result.append(candidate)
+        finally:
+            scratch.close()
+
+        result.sort(key=lambda x: x.benefit, reverse=True)
+
+        return result
+
+def format_index_report(recommendations):
+    """
+        Format the result of :any:`IndexAdvisor.analyze` as human-readable text.
+
+        :param recommendations: `list` of :any:`IndexRecommendation`
+
+        :returns: `str`
+    """
+
+    if not recommendations:
+        return "No index recommendations\n"
+
+    lines = []
+
+    for i, rec in enumerate(recommendations, 1):
+        speedup = rec.speedup
+        speedup = "%.2fx" % (speedup,) if speedup is not None else "inf"
+
+        lines.append("%d. %s;" % (i, rec.sql))
+        lines.append("   cost: %s -> %s (%s)" % (rec.cost_before, rec.cost_after, speedup))
+
+        for reason in rec.reasons:
+            lines.append("   plan: %s" % (reason,))
+
+        for statement in rec.statements:
+            lines.append("   used by: %s" % (statement,))
+
+    return "\n".join(lines) + "\n"
+
+def main(argv=None):
+    """Command line interface: ``python -m s3m replay LOG DATABASE``"""
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m s3m", description=__doc__.strip())
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    replay_parser = subparsers.add_parser("replay", help="replay a statement log")
+    replay_parser.add_argument("log", help="log written by StatementRecorder")
+    replay_parser.add_argument("database", help="path to the database")
+    replay_parser.add_argument("--timed", action="store_true",
+                               help="replay with the original timing instead of as fast as possible")
+    replay_parser.add_argument("--speed", type=float, default=1.0,
+                               help="timing multiplier for --timed (default: 1.0)")
+    replay_parser.add_argument("--in-place", action="store_true",
+                               help="replay against the database itself instead of a temporary copy")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "replay":
+        report = replay(args.log, args.database, timed=args.timed,
+                        speed=args.speed, copy=not args.in_place)
+        sys.stdout.write(report.format())
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
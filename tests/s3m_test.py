@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import datetime
+import decimal
+import io
 import os
 import sqlite3
 import sys
 import threading
+import time
 import unittest
+import unittest.mock
 
 import s3m
 
@@ -16,10 +21,12 @@ class S3MTestCase(unittest.TestCase):
         self.n_connections = 25
         self.db_path = "s3m_test.db"
 
-        try:
-            os.remove(self.db_path)
-        except FileNotFoundError:
-            pass
+        # WAL mode tests leave the -wal and -shm files behind
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            try:
+                os.remove(self.db_path + suffix)
+            except FileNotFoundError:
+                pass
 
     def insert_func(self, *args, **kwargs):
         conn = self.connect_db(*args, **kwargs)
@@ -113,6 +120,57 @@ class S3MTestCase(unittest.TestCase):
         conn1.commit()
         conn2.commit()
 
+    def test_shared_memory(self):
+        uri = "file:s3m_shared_memory?mode=memory&cache=shared"
+
+        conn1 = self.connect_db(uri, uri=True)
+        conn2 = self.connect_db(uri, uri=True)
+        conn3 = self.connect_db("file:s3m_private_memory?mode=memory", uri=True)
+
+        self.assertIs(conn1.db_state, conn2.db_state)
+        self.assertIsInstance(conn1.db_state, s3m.DBState)
+        self.assertIsInstance(conn3.db_state, s3m.FakeDBState)
+        self.assertTrue(conn1.in_memory)
+
+        conn1.execute("CREATE TABLE a(id INTEGER)")
+
+        def func():
+            conn = self.connect_db(uri, uri=True)
+
+            for i in range(25):
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("INSERT INTO a VALUES(?)", (i,))
+                conn.commit()
+
+        threads = [threading.Thread(target=func) for i in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(conn2.execute("SELECT COUNT(*) FROM a").fetchone(), (100,))
+
+    def test_file_uri(self):
+        conn1 = self.connect_db(self.db_path)
+        conn1.execute("CREATE TABLE a(id INTEGER)")
+
+        path = os.path.abspath(self.db_path)
+        conn2 = self.connect_db("file:%s?mode=rw" % (path,), uri=True)
+        conn3 = self.connect_db("file:%s?mode=ro" % (path,), uri=True)
+
+        self.assertEqual(conn2.path, "file:%s?mode=rw" % (s3m.normalize_path(path),))
+        self.assertIs(conn1.db_state, conn2.db_state)
+        self.assertIsInstance(conn3.db_state, s3m.FakeDBState)
+
+        conn2.execute("INSERT INTO a VALUES(1)")
+
+        self.assertEqual(conn3.execute("SELECT id FROM a").fetchall(), [(1,)])
+
+        with self.assertRaises(sqlite3.OperationalError):
+            conn3.execute("INSERT INTO a VALUES(2)")
+
     def test_sharing(self):
         conn = self.connect_db(":memory:", check_same_thread=False)
 
@@ -183,10 +241,822 @@ class S3MTestCase(unittest.TestCase):
                 with conn:
                     conn.close()
 
-    def tearDown(self):
+    def test_normalize_statement(self):
+        self.assertEqual(s3m.normalize_statement("SELECT a FROM b WHERE c = 'x' AND d > 5.5"),
+                         "SELECT a FROM b WHERE c = ? AND d > ?")
+        self.assertEqual(s3m.normalize_statement("DELETE FROM b WHERE c IN (1, 2, 3);"),
+                         "DELETE FROM b WHERE c IN (?)")
+
+    def test_index_advisor(self):
+        conn = self.connect_db(isolation_level=None)
+        collector = s3m.StatementCollector()
+
+        conn.execute("CREATE TABLE a(id INTEGER, b INTEGER, c TEXT)")
+        conn.executemany("INSERT INTO a VALUES(?, ?, ?)",
+                         [(i, i % 10, str(i)) for i in range(1000)])
+
+        conn.set_trace_callback(collector)
+
+        for i in range(10):
+            conn.execute("SELECT c FROM a WHERE b = %d" % (i,)).fetchall()
+
+        conn.set_trace_callback(None)
+
+        advisor = s3m.IndexAdvisor(conn, collector.statements)
+        self.assertEqual(len(advisor.workload), 1)
+
+        recommendations = advisor.analyze()
+
+        self.assertEqual(len(recommendations), 1)
+        self.assertEqual(recommendations[0].table, "a")
+        self.assertEqual(recommendations[0].columns, ("b",))
+        self.assertLess(recommendations[0].cost_after, recommendations[0].cost_before)
+        self.assertIn("CREATE INDEX", s3m.format_index_report(recommendations))
+
+        # The advisor must not touch the original database
+        self.assertEqual(conn.execute("PRAGMA index_list(a)").fetchall(), [])
+
+    def test_checkpoint_scheduler(self):
+        conn = self.connect_db(isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA wal_autocheckpoint=0")
+        conn.execute("CREATE TABLE a(id INTEGER)")
+        conn.executemany("INSERT INTO a VALUES(?)", [(i,) for i in range(1000)])
+
+        scheduler = conn.start_checkpoint_scheduler(interval=0.01, idle_time=0.0)
+
+        try:
+            self.assertIs(conn.start_checkpoint_scheduler(), scheduler)
+
+            for i in range(500):
+                if scheduler.checkpoint_count:
+                    break
+
+                time.sleep(0.01)
+
+            metrics = scheduler.metrics()
+            self.assertGreater(metrics["checkpoint_count"], 0)
+            self.assertGreater(metrics["mode_counts"]["PASSIVE"], 0)
+            self.assertIsNotNone(metrics["last_duration"])
+        finally:
+            conn.stop_checkpoint_scheduler()
+
+        self.assertFalse(scheduler.running)
+        self.assertIsNone(conn.db_state.checkpoint_scheduler)
+
+    def test_checkpoint_scheduler_escalation(self):
+        conn = self.connect_db(isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA wal_autocheckpoint=0")
+        conn.execute("CREATE TABLE a(id INTEGER)")
+        conn.executemany("INSERT INTO a VALUES(?)", [(i,) for i in range(1000)])
+
+        scheduler = s3m.CheckpointScheduler(conn.db_state, conn.path, idle_time=3600, truncate_size=1)
+        connection = sqlite3.connect(conn.path, isolation_level=None)
+
+        try:
+            self.assertTrue(scheduler.tick(connection))
+        finally:
+            connection.close()
+
+        self.assertEqual(scheduler.mode_counts["TRUNCATE"], 1)
+        self.assertEqual(scheduler.wal_size, 0)
+
+    def test_checkpoint_scheduler_unchanged_wal(self):
+        conn = self.connect_db(isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA wal_autocheckpoint=0")
+        conn.execute("CREATE TABLE a(id INTEGER)")
+        conn.executemany("INSERT INTO a VALUES(?)", [(i,) for i in range(1000)])
+
+        scheduler = s3m.CheckpointScheduler(conn.db_state, conn.path, idle_time=0.0)
+        connection = sqlite3.connect(conn.path, isolation_level=None)
+
+        try:
+            self.assertTrue(scheduler.tick(connection))
+            self.assertEqual(scheduler.checkpoint_count, 1)
+            self.assertGreater(scheduler.wal_size, 0)
+
+            # The WAL has already been checkpointed
+            self.assertTrue(scheduler.tick(connection))
+            self.assertEqual(scheduler.checkpoint_count, 1)
+
+            conn.executemany("INSERT INTO a VALUES(?)", [(i,) for i in range(5000)])
+            self.assertTrue(scheduler.tick(connection))
+            self.assertEqual(scheduler.checkpoint_count, 2)
+        finally:
+            connection.close()
+
+    def test_maintenance_scheduler(self):
+        conn = self.connect_db(isolation_level=None)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("CREATE TABLE a(id INTEGER, data TEXT)")
+        conn.execute("CREATE INDEX a_id_idx ON a(id)")
+        conn.executemany("INSERT INTO a VALUES(?, ?)", [(i, "x" * 1000) for i in range(200)])
+        conn.execute("DELETE FROM a WHERE id < 150")
+
+        self.assertGreater(conn.execute("PRAGMA freelist_count").fetchone()[0], 0)
+
+        scheduler = s3m.MaintenanceScheduler(conn.db_state, conn.path, idle_time=0.0, vacuum_pages=10)
+        connection = sqlite3.connect(conn.path, isolation_level=None)
+
+        try:
+            # Someone is waiting for the database => no maintenance
+            conn.db_state.waiting += 1
+            self.assertTrue(scheduler.tick(connection))
+            self.assertEqual(scheduler.slice_count, 0)
+            conn.db_state.waiting -= 1
+
+            self.assertTrue(scheduler.tick(connection))
+        finally:
+            connection.close()
+
+        self.assertEqual(scheduler.cycle_count, 1)
+        self.assertEqual(scheduler.pending, [])
+        self.assertEqual(conn.execute("PRAGMA freelist_count").fetchone()[0], 0)
+        self.assertTrue(conn.execute("SELECT * FROM sqlite_stat1").fetchall())
+
+        # The next cycle is not due yet
+        connection = sqlite3.connect(conn.path, isolation_level=None)
+
+        try:
+            slice_count = scheduler.slice_count
+            self.assertTrue(scheduler.tick(connection))
+            self.assertEqual(scheduler.slice_count, slice_count)
+        finally:
+            connection.close()
+
+    def test_maintenance_scheduler_thread(self):
+        conn = self.connect_db(isolation_level=None)
+        conn.execute("CREATE TABLE a(id INTEGER)")
+
+        scheduler = conn.start_maintenance_scheduler(interval=0.01, idle_time=0.0)
+
+        try:
+            for i in range(500):
+                if scheduler.cycle_count:
+                    break
+
+                time.sleep(0.01)
+
+            self.assertEqual(scheduler.metrics()["cycle_count"], 1)
+        finally:
+            conn.stop_maintenance_scheduler()
+
+        self.assertFalse(scheduler.running)
+
+    def test_converters(self):
+        conn = self.connect_db(":memory:")
+        conn.execute("CREATE TABLE a(id INTEGER, created TEXT, data TEXT, status TEXT)")
+        conn.executemany("INSERT INTO a VALUES(?, ?, ?, ?)",
+                         [(i, "2018-01-%02d 12:00:00" % (i + 1,), '{"n": %d}' % (i,),
+                           "ok" if i % 2 else None) for i in range(10)])
+
+        calls = []
+
+        def convert_status(values):
+            calls.append(values)
+            return [v.upper() for v in values]
+
+        conn.register_converter(s3m.convert_json, column="data")
+        conn.register_converter(s3m.convert_timestamps, type="timestamp")
+        conn.register_converter(convert_status, column="status", cache=True)
+
+        cur = conn.execute('SELECT id, created AS "created [timestamp]", data, status FROM a ORDER BY id')
+        self.assertEqual([c[0] for c in cur.description], ["id", "created", "data", "status"])
+
+        row = cur.fetchone()
+        self.assertEqual(row, (0, datetime.datetime(2018, 1, 1, 12), {"n": 0}, None))
+
+        rows = cur.fetchmany(4)
+        self.assertEqual(rows[0], (1, datetime.datetime(2018, 1, 2, 12), {"n": 1}, "OK"))
+        self.assertEqual(calls[-1], ["ok"])
+
+        rows = list(cur)
+        self.assertEqual(len(rows), 5)
+        self.assertEqual([r[3] for r in rows], ["OK", None, "OK", None, "OK"])
+
+        # Conversion doesn't apply without the type annotation
+        row = conn.execute("SELECT created FROM a WHERE id = 0").fetchone()
+        self.assertEqual(row, ("2018-01-01 12:00:00",))
+
+    def test_converters_row_factory(self):
+        conn = self.connect_db(":memory:")
+        conn.row_factory = sqlite3.Row
+        conn.register_converter(s3m.convert_decimals, column="price")
+
+        row = conn.execute("SELECT '1.10' AS price, 1 AS id").fetchall()[0]
+
+        self.assertIsInstance(row, sqlite3.Row)
+        self.assertEqual(row["price"], decimal.Decimal("1.10"))
+        self.assertEqual(row["id"], 1)
+
+    def test_converters_dict_factory(self):
+        def dict_factory(cursor, row):
+            return {column[0]: value for column, value in zip(cursor.description, row)}
+
+        conn = self.connect_db(":memory:")
+        conn.row_factory = dict_factory
+        conn.register_converter(s3m.convert_decimals, column="price")
+
+        sql = "SELECT '1.10' AS price, 1 AS id UNION ALL SELECT '2.5', 2"
+        expected = [{"price": decimal.Decimal("1.10"), "id": 1}, {"price": decimal.Decimal("2.5"), "id": 2}]
+
+        self.assertEqual(conn.execute(sql).fetchall(), expected)
+        self.assertEqual(conn.execute(sql).fetchone(), expected[0])
+        self.assertEqual(conn.execute(sql).fetchmany(2), expected)
+        self.assertEqual(conn.cursor(prefetch=True).execute(sql).fetchall(), expected)
+
+    def test_recorder_replay(self):
+        log_path = "s3m_test.log"
+        self.addCleanup(os.remove, log_path)
+
+        conn = self.connect_db(isolation_level=None)
+        conn.execute("CREATE TABLE a(id INTEGER)")
+
+        with s3m.StatementRecorder(log_path) as recorder:
+            conn.start_recording(recorder)
+
+            def func():
+                conn2 = self.connect_db()
+                conn2.start_recording(recorder)
+                conn2.executemany("INSERT INTO a VALUES(?)", ((i,) for i in range(10)))
+                conn2.commit()
+
+            thread = threading.Thread(target=func)
+            thread.start()
+            thread.join()
+
+            conn.execute("SELECT id FROM a WHERE id > ?", (5,)).fetchall()
+
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("SELECT * FROM nonexistent")
+
+            conn.stop_recording()
+            conn.execute("SELECT 1")
+
+        connections, events = s3m.read_recording(log_path)
+
+        self.assertEqual(len(connections), 2)
+        self.assertEqual([e.kind for e in events], ["executemany", "commit", "execute", "execute"])
+        self.assertEqual(events[0].params, [(i,) for i in range(10)])
+        self.assertEqual(events[2].params, (5,))
+        self.assertIsNotNone(events[3].error)
+        self.assertNotEqual(events[0].thread_id, events[2].thread_id)
+
+        report = s3m.replay(log_path, self.db_path)
+
+        self.assertEqual(report.count, 4)
+        self.assertEqual(report.error_count, 1)
+        self.assertEqual(len(report.latencies), 4)
+
+        # The original database is not modified
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM a").fetchone(), (10,))
+
+        output = io.StringIO()
+
+        with unittest.mock.patch("sys.stdout", output):
+            self.assertEqual(s3m.main(["replay", "--timed", "--speed", "10", log_path, self.db_path]), 0)
+
+        self.assertIn("throughput", output.getvalue())
+
+    def test_recorder_transaction(self):
+        log_path = "s3m_test.log"
+        self.addCleanup(os.remove, log_path)
+
+        conn = self.connect_db()
+        conn.execute("CREATE TABLE a(id INTEGER)")
+        conn.commit()
+
+        with s3m.StatementRecorder(log_path) as recorder:
+            conn.start_recording(recorder)
+
+            with conn.transaction():
+                conn.execute("INSERT INTO a VALUES(1)")
+
+            with self.assertRaises(ValueError):
+                with conn.transaction("DEFERRED"):
+                    conn.execute("INSERT INTO a VALUES(2)")
+                    raise ValueError
+
+            conn.stop_recording()
+
+        connections, events = s3m.read_recording(log_path)
+
+        self.assertEqual([(e.kind, e.sql) for e in events],
+                         [("execute", "BEGIN IMMEDIATE"), ("execute", "INSERT INTO a VALUES(1)"), ("commit", None),
+                          ("execute", "BEGIN DEFERRED"), ("execute", "INSERT INTO a VALUES(2)"), ("rollback", None)])
+        self.assertEqual(conn.execute("SELECT id FROM a").fetchall(), [(1,)])
+
+    def test_attach(self):
+        other_path = "s3m_test2.db"
+        self.addCleanup(os.remove, other_path)
+
+        conn1 = self.connect_db(isolation_level=None, lock_timeout=0.05)
+        conn2 = self.connect_db(other_path, isolation_level=None, lock_timeout=0.05)
+
+        conn1.execute("CREATE TABLE a(id INTEGER)")
+        conn2.execute("CREATE TABLE b(id INTEGER)")
+
+        conn1.execute("ATTACH DATABASE ? AS other", (other_path,))
+
+        self.assertEqual(list(conn1.attached), ["other"])
+        self.assertIs(conn1.attached["other"], conn2.db_state)
+
+        self.assertEqual(conn1.schemas_for("INSERT INTO other.b SELECT id FROM a"), {"other"})
+        self.assertEqual(conn1.schemas_for("SELECT * FROM b"), {"other"})
+        self.assertEqual(conn1.schemas_for("SELECT * FROM a WHERE id = ?"), set())
+
+        # Statements that don't touch the attached database don't wait for it
+        conn2.execute("BEGIN IMMEDIATE")
+        conn1.execute("INSERT INTO a VALUES(1)")
+
+        with self.assertRaises(s3m.LockTimeoutError):
+            conn1.execute("INSERT INTO other.b VALUES(1)")
+
+        conn2.commit()
+
+        # The transaction lock of the attached database is kept until the end of the transaction
+        conn1.execute("BEGIN")
+        conn1.execute("INSERT INTO other.b VALUES(2)")
+
+        def func():
+            with self.assertRaises(s3m.LockTimeoutError):
+                conn2.execute("BEGIN IMMEDIATE")
+
+        thread = threading.Thread(target=func)
+        thread.start()
+        thread.join()
+
+        conn1.commit()
+        conn2.execute("BEGIN IMMEDIATE")
+        conn2.commit()
+
+        # The cached schemas are invalidated by DDL
+        conn1.execute("CREATE TABLE b(id INTEGER)")
+        self.assertEqual(conn1.schemas_for("SELECT * FROM b"), set())
+        conn1.execute("DROP TABLE main.b")
+        self.assertEqual(conn1.schemas_for("SELECT * FROM b"), {"other"})
+
+        conn1.execute("DETACH DATABASE other")
+        self.assertEqual(conn1.attached, {})
+
+    def test_attach_lock_order(self):
+        other_path = "s3m_test2.db"
+        self.addCleanup(os.remove, other_path)
+
+        conn1 = self.connect_db(isolation_level=None, lock_timeout=5)
+        conn2 = self.connect_db(other_path, isolation_level=None, lock_timeout=5)
+        conn3 = self.connect_db(isolation_level=None, lock_timeout=5)
+
+        conn1.execute("CREATE TABLE a(id INTEGER)")
+        conn2.execute("CREATE TABLE b(id INTEGER)")
+        conn2.execute("ATTACH DATABASE ? AS other", (self.db_path,))
+
+        conn3.execute("BEGIN")
+        conn3.execute("INSERT INTO a VALUES(1)")
+
+        # Commit doesn't wait for the attached databases the connection isn't writing to
+        conn2.execute("INSERT INTO b VALUES(1)")
+        conn2.commit()
+
+        # Waiting for a lock that comes earlier in the locking order could deadlock
+        start_time = time.monotonic()
+        conn2.acquire(None, set())
+
         try:
-            os.remove(self.db_path)
-        except FileNotFoundError:
+            with self.assertRaises(s3m.LockOrderError):
+                conn2.execute("INSERT INTO other.a VALUES(2)")
+        finally:
+            conn2.release()
+
+        self.assertLess(time.monotonic() - start_time, 1.0)
+        conn3.commit()
+
+        self.assertEqual(conn2.execute("SELECT id FROM other.a").fetchall(), [(1,)])
+
+    def test_attach_cross_transactions(self):
+        other_path = "s3m_test2.db"
+        self.addCleanup(os.remove, other_path)
+
+        conn1 = self.connect_db()
+        conn2 = self.connect_db(other_path)
+
+        conn1.execute("CREATE TABLE a(id INTEGER)")
+        conn2.execute("CREATE TABLE b(id INTEGER)")
+        conn1.commit()
+        conn2.commit()
+
+        errors = []
+
+        def func(path, other_path, explicit):
+            conn = self.connect_db(path)
+            conn.execute("ATTACH DATABASE ? AS other", (other_path,))
+
+            try:
+                for i in range(30):
+                    # Both tables are written to in the order main, other
+                    if explicit:
+                        conn.execute("BEGIN")
+
+                    conn.execute("INSERT INTO main.%s VALUES(?)" % ("a" if path == self.db_path else "b",), (i,))
+                    conn.execute("INSERT INTO other.%s VALUES(?)" % ("b" if path == self.db_path else "a",), (i,))
+                    conn.commit()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=func, args=args)
+                   for args in [(self.db_path, other_path, False), (self.db_path, other_path, True),
+                                (other_path, self.db_path, False), (other_path, self.db_path, True)]]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(conn1.execute("SELECT COUNT(*) FROM a").fetchone(), (120,))
+        self.assertEqual(conn2.execute("SELECT COUNT(*) FROM b").fetchone(), (120,))
+
+    def test_prefetch(self):
+        conn = self.connect_db(isolation_level=None, prefetch_memory_limit=4096)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE a(id INTEGER, data TEXT)")
+        conn.executemany("INSERT INTO a VALUES(?, ?)", [(i, "x" * 100) for i in range(1000)])
+        conn.row_factory = sqlite3.Row
+
+        checkpointer = sqlite3.connect(self.db_path, timeout=0, isolation_level=None)
+        self.addCleanup(checkpointer.close)
+
+        cur = conn.cursor(prefetch=True)
+        cur.execute("SELECT id, data FROM a ORDER BY id")
+
+        self.assertTrue(cur._buffer.spilled)
+
+        # The statement doesn't hold the read lock anymore
+        self.assertEqual(checkpointer.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0], 0)
+
+        row = cur.fetchone()
+        self.assertIsInstance(row, sqlite3.Row)
+        self.assertEqual(row["id"], 0)
+        self.assertEqual([r["id"] for r in cur.fetchmany(3)], [1, 2, 3])
+        self.assertEqual([r["id"] for r in cur], list(range(4, 1000)))
+        self.assertEqual(cur.fetchall(), [])
+
+        # Without prefetching, the unfinished statement blocks the checkpoint
+        conn.executemany("INSERT INTO a VALUES(?, ?)", [(i, "x") for i in range(10)])
+
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM a")
+        cur.fetchone()
+
+        self.assertEqual(checkpointer.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0], 1)
+
+        cur.close()
+
+    def test_cursor_keeps_connection(self):
+        cur = self.connect_db(":memory:").execute("SELECT 1")
+
+        self.assertEqual(cur.fetchone(), (1,))
+        self.assertFalse(hasattr(cur, "__dict__"))
+        self.assertFalse(hasattr(cur.connection, "__dict__"))
+
+    def test_changefeed(self):
+        conn = self.connect_db()
+        conn.execute("CREATE TABLE a(id INTEGER PRIMARY KEY, value TEXT)")
+        conn.enable_changefeed(["a"])
+
+        self.assertEqual(conn.changefeed_seq(), 0)
+
+        with conn.transaction():
+            conn.executemany("INSERT INTO a VALUES(?, ?)", [(i, str(i)) for i in range(5)])
+
+        conn.execute("UPDATE a SET value = 'x' WHERE id = 1")
+        conn.execute("UPDATE a SET id = 10 WHERE id = 2")
+        conn.execute("DELETE FROM a WHERE id = 3")
+
+        changes = [(c.table, c.rowid, c.op) for c in conn.changes_since(0, batch_size=2)]
+        self.assertEqual(changes[:5], [("a", i, "I") for i in range(5)])
+        self.assertEqual(changes[5:], [("a", 1, "U"), ("a", 2, "D"), ("a", 10, "U"), ("a", 3, "D")])
+
+        seq = conn.changefeed_seq()
+        self.assertEqual(seq, 9)
+        self.assertEqual(list(conn.changes_since(seq)), [])
+
+        for change in conn.changes_since(5, batch_size=3, consumer="cache"):
             pass
 
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM s3m_changelog").fetchone(), (0,))
+
+        conn.disable_changefeed(["a"])
+        conn.execute("DELETE FROM a")
+        self.assertEqual(conn.changefeed_seq(), 9)
+
+        conn.execute("CREATE TABLE b(id INTEGER PRIMARY KEY) WITHOUT ROWID")
+        self.assertRaises(s3m.S3MError, conn.enable_changefeed, ["b"])
+
+    def test_admission_control(self):
+        conn1 = self.connect_db()
+        conn2 = self.connect_db()
+        conn3 = self.connect_db(lock_timeout=0.01, priority=1)
+
+        controller = s3m.AdmissionController(max_queue_depth=0)
+        self.assertIsNone(conn1.set_admission_control(controller))
+        self.assertIs(conn2.db_state.admission, controller)
+
+        with conn1:
+            self.assertRaises(s3m.OverloadedError, conn2.acquire)
+
+            controller.max_queue_depth = None
+            controller.max_wait = 0.5
+            controller.priority_limits[1] = (None, 10.0)
+            controller.hold_time = 0.0
+            controller.transaction_hold_time = 1.0
+
+            # conn2 queues for the transaction lock, so the transaction lock hold time is used
+            with self.assertRaises(s3m.OverloadedError) as cm:
+                conn2.execute("SELECT 1")
+
+            self.assertEqual(cm.exception.queue_depth, 0)
+            self.assertEqual(cm.exception.estimated_wait, 1.0)
+
+            # Admitted, but the lock isn't released in time
+            self.assertRaises(s3m.LockTimeoutError, conn3.acquire)
+
+        self.assertEqual((controller.admitted, controller.rejected), (1, 2))
+        self.assertLess(controller.transaction_hold_time, 1.0)
+        self.assertGreater(controller.hold_time, 0.0)
+
+        conn2.execute("SELECT 1")
+        self.assertEqual(conn2.with_count, 0)
+
+        # Threads sharing a connection are subject to admission control too
+        controller.max_queue_depth = 0
+        entered = threading.Event()
+        done = threading.Event()
+
+        def hold():
+            with conn1:
+                entered.set()
+                done.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        entered.wait(5)
+
+        try:
+            self.assertRaises(s3m.OverloadedError, conn1.acquire)
+        finally:
+            done.set()
+            thread.join()
+
+        self.assertEqual(conn1.with_count, 0)
+        self.assertIs(conn1.set_admission_control(None), controller)
+
+    def test_compression(self):
+        conn = self.connect_db()
+        conn.execute("CREATE TABLE a(id INTEGER PRIMARY KEY, data TEXT, raw BLOB)")
+
+        text = "abcdefgh" * 100
+        blob = s3m.COMPRESSION_MAGIC + b"not compressed"
+
+        conn.execute("INSERT INTO a VALUES(1, 'old %s', NULL)" % (text,))
+        conn.enable_compression("a", "data")
+        conn.enable_compression("A", "raw", "lzma", threshold=0)
+        conn.execute("INSERT INTO a(id, data) VALUES(?, ?)", (2, text))
+        conn.executemany("INSERT INTO a(id, data, raw) VALUES(:id, :data, :raw)",
+                         [{"id": 3, "data": "short", "raw": blob}])
+        conn.execute("UPDATE a SET raw = ? WHERE id = ?", (text.encode("utf8"), 2))
+
+        stored = dict(conn.connection.execute("SELECT id, data FROM a"))
+        self.assertTrue(stored[2].startswith(s3m.COMPRESSION_MAGIC))
+        self.assertLess(len(stored[2]), len(text))
+        self.assertEqual(stored[3], "short")
+
+        rows = conn.execute("SELECT id, data, raw FROM a ORDER BY id").fetchall()
+        self.assertEqual(rows, [(1, "old " + text, None), (2, text, text.encode("utf8")), (3, "short", blob)])
+
+        self.assertEqual(conn.compress_existing("a", "data", batch_size=2), 1)
+        self.assertTrue(conn.connection.execute("SELECT data FROM a WHERE id = 1").fetchone()[0]
+                        .startswith(s3m.COMPRESSION_MAGIC))
+        self.assertEqual(conn.execute("SELECT data FROM a WHERE id = 1").fetchone(), ("old " + text,))
+
+        compressor = conn.train_compression_dictionary("a", "data")
+        conn.enable_compression("a", "data", compressor, threshold=16)
+        conn.execute("INSERT INTO a(id, data) VALUES(4, ?)", ("old " + text[:64],))
+        self.assertEqual(conn.connection.execute("SELECT data FROM a WHERE id = 4").fetchone()[0][5],
+                         s3m.DictCompressor.codec_id)
+        self.assertEqual(conn.execute("SELECT data FROM a WHERE id = 4").fetchone(), ("old " + text[:64],))
+
+        # Aliases are matched only if they are registered
+        self.assertTrue(conn.execute("SELECT data AS d FROM a WHERE id = 2").fetchone()[0]
+                        .startswith(s3m.COMPRESSION_MAGIC))
+        conn.enable_compression("a", "data", compressor, threshold=16, aliases=["D"])
+        self.assertEqual(conn.execute("SELECT data AS d FROM a WHERE id = 2").fetchone(), (text,))
+
+    def test_migration(self):
+        conn = self.connect_db()
+        conn.execute("CREATE TABLE a(id INTEGER PRIMARY KEY, value INTEGER, name TEXT)")
+        conn.executemany("INSERT INTO a VALUES(?, ?, ?)", [(i, i, "n%04d" % (i,)) for i in range(1000)])
+        conn.execute("CREATE INDEX a_name ON a(name)")
+
+        sql = "UPDATE a SET value = value * 2 WHERE rowid BETWEEN :start AND :end"
+        migration = s3m.Migration(conn, "double", "a", sql, batch_size=100, max_batch_size=100)
+
+        self.assertFalse(migration.run(max_batches=2))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM a WHERE value != id").fetchone(), (199,))
+
+        # Resumed from the saved progress
+        migration = conn.migrate("double", "a", sql, batch_size=100)
+        self.assertTrue(migration.done)
+        self.assertEqual(migration.rows, 1000)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM a WHERE value != 2 * id").fetchone(), (0,))
+
+        self.assertEqual(conn.migrate("double", "a", sql).batches, migration.batches)
+
+        def delete(connection, start, end):
+            return connection.execute("DELETE FROM a WHERE name BETWEEN ? AND ? AND id % 2 = 0",
+                                      (start, end)).rowcount
+
+        migration = conn.migrate("delete", "a", delete, key="name", batch_size=10, target_time=1e-9,
+                                 min_batch_size=5)
+        self.assertEqual(migration.rows, 500)
+        self.assertEqual(migration.batch_size, 5)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM a").fetchone(), (500,))
+
+    def test_pipeline(self):
+        conn = self.connect_db()
+        conn.execute("CREATE TABLE a(id INTEGER PRIMARY KEY, value TEXT)")
+
+        with conn.pipeline() as p:
+            insert = p.executemany("INSERT INTO a VALUES(?, ?)", [(1, "a"), (2, "b")])
+            select = p.execute("SELECT value FROM a ORDER BY id")
+
+            self.assertRaises(s3m.S3MError, select.result)
+
+        self.assertEqual(insert.rowcount, 2)
+        self.assertEqual(select.fetchall(), [("a",), ("b",)])
+        self.assertEqual(select.fetchone(), ("a",))
+        self.assertEqual(select.description[0][0], "value")
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            with conn.pipeline(transaction=True) as p:
+                update = p.execute("UPDATE a SET value = 'c'")
+                insert = p.execute("INSERT INTO a VALUES(1, 'd')")
+                select = p.execute("SELECT 1")
+
+        self.assertEqual(update.rowcount, 2)
+        self.assertRaises(sqlite3.IntegrityError, insert.result)
+        self.assertRaises(sqlite3.IntegrityError, select.result)
+        self.assertEqual(conn.execute("SELECT value FROM a").fetchall(), [("a",), ("b",)])
+        self.assertFalse(conn.in_transaction)
+
+    def test_lazy_connections(self):
+        manager = s3m.HandleManager(max_handles=2)
+        conn1, conn2 = [self.connect_db(lazy=True, handle_manager=manager) for i in range(2)]
+        conn3 = self.connect_db(lazy=True, handle_manager=manager, lock_transactions=False)
+
+        self.assertIsNone(conn1.connection)
+        self.assertRaises(s3m.S3MError, self.connect_db, ":memory:", lazy=True)
+
+        conn1.create_function("double", 1, lambda x: x * 2)
+        conn1.execute("PRAGMA cache_size = 123")
+        conn1.execute("CREATE TABLE a(id INTEGER)")
+        cur = conn1.execute("SELECT double(21)")
+
+        conn2.execute("BEGIN")
+        conn2.execute("INSERT INTO a VALUES(1)")
+        conn3.execute("SELECT 1")
+
+        # conn2 is in a transaction, so conn1 is evicted
+        self.assertIsNone(conn1.connection)
+        self.assertIsNotNone(conn2.connection)
+        self.assertEqual(cur.fetchone(), (42,))
+
+        conn2.execute("COMMIT")
+
+        self.assertEqual(conn1.execute("SELECT double(id) FROM a").fetchall(), [(2,)])
+        self.assertEqual(conn1.execute("PRAGMA cache_size").fetchone(), (123,))
+        self.assertEqual(len(manager), 2)
+
+        stats = manager.stats()
+        self.assertEqual((stats["opens"], stats["reopens"], stats["evictions"]), (4, 1, 2))
+        self.assertGreater(stats["max_reopen_time"], 0.0)
+
+        # Cursors that haven't run a statement yet
+        cur = conn3.cursor()
+        self.assertEqual((cur.description, cur.rowcount, cur.lastrowid), (None, -1, None))
+        self.assertEqual((cur.fetchone(), cur.fetchmany(), cur.fetchall()), (None, [], []))
+
+        # Fetching after the handle has been evicted
+        cur = conn3.execute("INSERT INTO a VALUES(2)")
+        self.assertTrue(conn3.evict())
+        self.assertEqual(cur.fetchall(), [])
+
+        # Only settings and successful statements are repeated
+        conn1.execute("PRAGMA foreign_keys(1)")
+        conn1.execute("PRAGMA table_info(a)")
+        conn1.execute("PRAGMA integrity_check(5)")
+        conn1.execute("PRAGMA user_version = 5")
+
+        with self.assertRaises(sqlite3.OperationalError):
+            conn1.execute("ATTACH ? AS other", (os.path.join("nonexistent", "other.db"),))
+
+        self.assertEqual(list(conn1.setup), [("create_function", "double", 1),
+                                             ("pragma", "CACHE_SIZE"), ("pragma", "FOREIGN_KEYS")])
+
+        # A setting that can't be repeated fails only once
+        self.assertTrue(conn1.evict())
+        conn1.configure("broken", lambda connection: connection.execute("SELECT * FROM nonexistent"))
+        self.assertRaises(sqlite3.OperationalError, conn1.execute, "SELECT 1")
+        self.assertEqual(conn1.execute("PRAGMA foreign_keys").fetchone(), (1,))
+        self.assertNotIn("broken", conn1.setup)
+
+        # The setup is repeated with the database lock held
+        locked = []
+        db_state = conn1.db_state
+
+        def check_lock(connection):
+            def func():
+                acquired = db_state.lock.acquire(False)
+                locked.append(not acquired)
+
+                if acquired:
+                    db_state.lock.release()
+
+            thread = threading.Thread(target=func)
+            thread.start()
+            thread.join()
+
+        self.assertTrue(conn1.evict())
+        conn1.configure("check_lock", check_lock)
+        conn1.isolation_level  # Reopens the handle outside of acquire()
+        self.assertEqual(locked, [True])
+
+        # TEMP objects keep the handle open
+        conn1.execute("CREATE TEMP TABLE t(id INTEGER)")
+        self.assertFalse(conn1.evict())
+        conn1.execute("DROP TABLE temp.t")
+
+        # Statements run by executescript() are repeated too
+        other_path = "s3m_test2.db"
+        self.addCleanup(os.remove, other_path)
+
+        conn1.executescript("ATTACH '%s' AS oth; CREATE TABLE oth.t(id INTEGER); PRAGMA recursive_triggers = 1;" %
+                            (other_path,))
+        self.assertTrue(conn1.evict())
+        self.assertEqual(conn1.execute("SELECT * FROM oth.t").fetchall(), [])
+        self.assertEqual(conn1.execute("PRAGMA recursive_triggers").fetchone(), (1,))
+        self.assertEqual(list(conn1.attached), ["oth"])
+
+        conn1.close()
+        self.assertEqual(len(manager), 1)
+
+    def test_warmup(self):
+        conn = self.connect_db()
+        conn.execute("CREATE TABLE a(id INTEGER PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE b(id INTEGER PRIMARY KEY)")
+        conn.executemany("INSERT INTO a VALUES(?, ?)", [(i, "x" * 100) for i in range(1000)])
+        conn.execute("CREATE INDEX a_value ON a(value)")
+
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+
+        try:
+            n_pages = conn.execute("SELECT COUNT(*) FROM dbstat WHERE name IN ('a', 'a_value')").fetchone()[0]
+        except sqlite3.OperationalError:
+            self.skipTest("SQLite is compiled without the dbstat virtual table")
+
+        warmup = conn.warmup(tables=["a"], indexes=["a_value"], background=False)
+        self.assertIsNone(warmup.error)
+        self.assertEqual(warmup.pages, n_pages)
+        self.assertEqual(warmup.bytes, n_pages * page_size)
+
+        warmup = conn.warmup(tables=["a"], budget=2 * page_size, background=False)
+        self.assertEqual(warmup.pages, 2)
+
+        # dbstat isn't enumerated beyond the budget
+        warmup = s3m.Warmup(self.db_path, page_size, tables=["a"], budget=2 * page_size)
+        self.assertEqual(sum(size for offset, size in warmup.get_ranges(os.path.getsize(self.db_path))),
+                         2 * page_size)
+
+        conn.execute("PRAGMA mmap_size = %d" % (4 * page_size,))
+        self.assertEqual(conn.warmup(background=False).pages, 4)
+
+        conn2 = self.connect_db(warmup=True)
+        self.assertTrue(conn2.last_warmup.join(5))
+        self.assertEqual(conn2.last_warmup.bytes, os.path.getsize(self.db_path))
+
+        self.assertRaises(s3m.S3MError, self.connect_db(":memory:").warmup)
+
+    def tearDown(self):
+        # WAL mode tests leave the -wal and -shm files behind
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            try:
+                os.remove(self.db_path + suffix)
+            except FileNotFoundError:
+                pass
+
         self.assertEqual(len(s3m.DB_STATES), 0)